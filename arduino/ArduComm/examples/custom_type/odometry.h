@@ -1,18 +1,14 @@
-/* This file defines a custom type and its serialization methods.
-*
-* The custom "complex" type is Odometry, defined in the odometry.ino file.
-* The Odometry object is composed by a Pose defining a pose,
-* a Vector3 for linear velocity and a Vector3 for angular velocity.
-*
-*  Author:  Francisco Miguel Moreno
-*  Email:   butakus@gmail.com
-*  Version: 0.2
-*  Date:    January 2023
+/* Message types generated from the schema of the host library (arducomm.serialization.schema).
+*  Do not edit this file. Change the schema and generate it again.
 */
 
+#ifndef ARDUCOMM__ODOMETRY_H
+#define ARDUCOMM__ODOMETRY_H
+
 #include <arducomm/serialization.h>
-#include <arducomm/types/pose.h>
 #include <arducomm/types/vector3.h>
+#include <arducomm/types/quaternion.h>
+#include <arducomm/types/pose.h>
 
 class Odometry
 {
@@ -21,25 +17,19 @@ public:
     Vector3 linear_vel;
     Vector3 angular_vel;
     // Payload size
-    const static uint8_t size = Pose::size + 2*Vector3::size;
+    static constexpr uint8_t size = 52;
 
     Odometry() : pose(), linear_vel(), angular_vel()
     {
     }
 
-    Odometry(const Pose& pose, const Vector3& linear_vel, const Vector3& angular_vel)
+    Odometry(const Pose& pose, const Vector3& linear_vel, const Vector3& angular_vel) : pose(pose), linear_vel(linear_vel), angular_vel(angular_vel)
     {
-        this->pose = pose;
-        this->linear_vel = linear_vel;
-        this->angular_vel = angular_vel;
     }
 
     ~Odometry(){}
 };
 
-/* Below are defined the serialization and parsing methods for the Odometry class.
-   Note that we can reuse the serialization methods already implemented for other clases.
-*/
 namespace serialization
 {
 
@@ -69,3 +59,4 @@ public:
 
 } // namespace serialization
 
+#endif
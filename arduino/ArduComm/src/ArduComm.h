@@ -1,6 +1,7 @@
 /* Library that implements a data-layer communication protocol between the Arduino and a computer via serial.
 *  
 *  The communication protocol is based on HLDLC with ARQ-StopAndWait error control.
+*  The host can also negotiate a windowed ARQ mode (Go-Back-N) for the frames it sends.
 *
 *  Note: Works only on version 1.0 and above of Arduino IDE. (only arduino.h)
 *
@@ -22,6 +23,18 @@ constexpr uint8_t MAX_RETRIES = 3;
 constexpr uint8_t START_FLAG = 0x7E;
 constexpr uint8_t ESCAPE_FLAG = 0x7D;
 constexpr uint8_t ACK_COMMAND = 0x01;
+// Max number of frames that the host can send without waiting for their ACKs
+constexpr uint8_t MAX_WINDOW_SIZE = 127;
+// Size of the serial input buffer, reported to the host for the flow control
+#ifdef SERIAL_RX_BUFFER_SIZE
+constexpr uint8_t RX_BUFFER_SIZE = SERIAL_RX_BUFFER_SIZE > 255 ? 255 : SERIAL_RX_BUFFER_SIZE;
+#else
+constexpr uint8_t RX_BUFFER_SIZE = 64;
+#endif
+// Number of bytes read from the input buffer before reporting them to the host
+constexpr uint8_t CREDIT_THRESHOLD = RX_BUFFER_SIZE / 2;
+// Time (microseconds) without new bytes before reporting the bytes read that were not reported yet
+constexpr unsigned long CREDIT_IDLE_TIME = 1000;
 
 typedef enum tx_error : uint8_t
 {
@@ -37,6 +50,19 @@ typedef enum ack_value : uint8_t
     ACK_RETRY
 } ACKValue;
 
+/* Types of ACK frames. Plain ACKs do not include the type byte */
+typedef enum ack_type : uint8_t
+{
+    ACK_TYPE_PLAIN = 0,
+    ACK_TYPE_NACK,           // Windowed ARQ: frames before seq received, frame seq must be sent again
+    ACK_TYPE_WINDOW_REQUEST, // Host requests the windowed ARQ mode
+    ACK_TYPE_WINDOW_REPLY,   // Reply to the request with the accepted window size
+    ACK_TYPE_FLOW_REQUEST,   // Host requests the credit-based flow control (or disables it)
+    ACK_TYPE_FLOW_REPLY,     // Reply to the request with the size of the input and frame buffers
+    ACK_TYPE_CREDIT,         // Total number of bytes read from the input buffer (mod 256)
+    ACK_TYPE_CREDIT_REQUEST  // Host requests a credit report (the last one did not arrive)
+} ACKType;
+
 enum frame_index : uint8_t
 {
     FLAG = 0,
@@ -66,6 +92,12 @@ public:
         sent_seq_ = 0;
         last_ack_ = ACK_UNSET;
         retries_ = 0;
+        window_size_ = 0;
+        expected_seq_ = 0;
+        flow_control_ = 0;
+        read_count_ = 0;
+        reported_count_ = 0;
+        last_read_time_ = 0;
     }
     ~ArduCommT(){}
 
@@ -92,8 +124,22 @@ public:
         // Read all bytes in the serial buffer
         while (serial_->available())
         {
+            if (buffer_index_ >= BUFFER_SIZE)
+            {
+                // The frame does not fit in the buffer. Drop it.
+                buffer_index_ = 0;
+            }
             // Read first byte into the buffer
             in_buffer_[buffer_index_++] = serial_->read();
+            if (flow_control_)
+            {
+                last_read_time_ = micros();
+                if ((uint8_t)(++read_count_ - reported_count_) >= CREDIT_THRESHOLD)
+                {
+                    // Tell the host that there is room for more bytes
+                    send_credit(0);
+                }
+            }
             if (in_buffer_[0] != START_FLAG)
             {
                 // Broken frame. The buffer will never contain a full packet.
@@ -128,6 +174,11 @@ public:
                 escape_received_ = 0;
             }
         }
+        if (flow_control_ && read_count_ != reported_count_ && (micros() - last_read_time_) >= CREDIT_IDLE_TIME)
+        {
+            // The host might be waiting for these credits to write the next frame
+            send_credit(0);
+        }
         // If no more bytes available to read, return 0 (no full frame available yet)
         return 0;
     }
@@ -211,6 +262,9 @@ public:
         return payload_size_;
     }
 
+    /* Window size negotiated by the host. 0 if the host uses Stop-and-Wait */
+    inline uint8_t get_window_size() const {return window_size_;}
+
     /* Add a new callback to process received messages.
        All packet frames with the specified command will be parsed and processed by the given callback function.
        The template param T defines the type of the messages for this callback, necessary for the parsing.
@@ -233,6 +287,14 @@ private:
     uint8_t sent_seq_;
     ACKValue last_ack_;
     uint8_t retries_;
+    // Windowed ARQ (receiver side). Window size 0 means Stop-and-Wait.
+    uint8_t window_size_;
+    uint8_t expected_seq_;
+    // Flow control. Number of bytes read (mod 256) and last number reported to the host.
+    uint8_t flow_control_;
+    uint8_t read_count_;
+    uint8_t reported_count_;
+    unsigned long last_read_time_;
 
     arducomm::Subscriber_* subscribers_[NUM_CALLBACKS];
 
@@ -241,7 +303,29 @@ private:
     {
         uint8_t new_packet = 0;
 
-        if (in_buffer_[COMMAND] == ACK_COMMAND)
+        if (in_buffer_[COMMAND] == ACK_COMMAND && buffer_index_ > 4 && in_buffer_[PAYLOAD] == ACK_TYPE_WINDOW_REQUEST)
+        {
+            // The host wants to use windowed ARQ. The sequence number is the next frame to expect.
+            window_size_ = buffer_index_ > 5 ? min(in_buffer_[PAYLOAD + 1], MAX_WINDOW_SIZE) : 0;
+            expected_seq_ = in_buffer_[SEQ_NUMBER];
+            send_ack(expected_seq_, ACK_TYPE_WINDOW_REPLY, 1, &window_size_);
+        }
+        else if (in_buffer_[COMMAND] == ACK_COMMAND && buffer_index_ > 4 && in_buffer_[PAYLOAD] == ACK_TYPE_FLOW_REQUEST)
+        {
+            // The host wants to use flow control (unless the data is 0, sent by hosts that do not use it).
+            // Report the buffer sizes and start counting the bytes read.
+            uint8_t buffer_sizes[2] = {RX_BUFFER_SIZE, BUFFER_SIZE > 255 ? 255 : BUFFER_SIZE};
+            flow_control_ = buffer_index_ > 5 ? in_buffer_[PAYLOAD + 1] != 0 : 1;
+            read_count_ = 0;
+            reported_count_ = 0;
+            send_ack(in_buffer_[SEQ_NUMBER], ACK_TYPE_FLOW_REPLY, 2, buffer_sizes);
+        }
+        else if (in_buffer_[COMMAND] == ACK_COMMAND && buffer_index_ > 4 && in_buffer_[PAYLOAD] == ACK_TYPE_CREDIT_REQUEST)
+        {
+            // The host did not receive the last report. Reply with the request sequence number.
+            send_credit(in_buffer_[SEQ_NUMBER]);
+        }
+        else if (in_buffer_[COMMAND] == ACK_COMMAND)
         {
             // Received an ACK frame. Set the ack value.
             if (in_buffer_[SEQ_NUMBER] == sent_seq_)
@@ -271,16 +355,29 @@ private:
             uint16_t computed_checksum = checksum(in_buffer_[SEQ_NUMBER], command_, payload_size_, payload_);
 
             // Send ACK
-            if (received_checksum != computed_checksum)
+            if (window_size_ && in_buffer_[SEQ_NUMBER] != expected_seq_)
+            {
+                // Go-Back-N: discard out of order frames and repeat the last ACK
+                send_ack(expected_seq_);
+            }
+            else if (received_checksum != computed_checksum)
             {
                 // Retry
-                send_ack(in_buffer_[SEQ_NUMBER]);
+                if (window_size_)
+                {
+                    send_ack(expected_seq_, ACK_TYPE_NACK);
+                }
+                else
+                {
+                    send_ack(in_buffer_[SEQ_NUMBER]);
+                }
             }
             else
             {
                 // Packet RX ok
                 new_packet = 1;
-                send_ack((in_buffer_[SEQ_NUMBER] + 1) % 256);
+                expected_seq_ = (in_buffer_[SEQ_NUMBER] + 1) % 256;
+                send_ack(expected_seq_);
             }
         }
 
@@ -319,8 +416,10 @@ private:
         return error;
     }
 
-    /* Send an ACK response */
-    void send_ack(uint8_t seq_number)
+    /* Send an ACK response.
+       ACKs other than ACK_TYPE_PLAIN include the type byte and the data of their type.
+    */
+    void send_ack(uint8_t seq_number, ACKType ack_type = ACK_TYPE_PLAIN, uint8_t data_size = 0, const uint8_t data[] = NULL)
     {
         // Send all bytes, escaping if necessary
         // Start flag
@@ -332,10 +431,32 @@ private:
         // Command
         serial_->write(ACK_COMMAND);
 
+        // ACK type and data
+        if (ack_type != ACK_TYPE_PLAIN)
+        {
+            write_escaped(ack_type);
+        }
+        for (uint8_t i = 0; i < data_size; ++i)
+        {
+            write_escaped(data[i]);
+        }
+
         // End flag
         serial_->write(START_FLAG);
     }
 
+    /* Report the bytes read to the host, protected with the FCS.
+       seq_number is the sequence number of the request it replies to, or 0.
+    */
+    void send_credit(uint8_t seq_number)
+    {
+        uint8_t report[2] = {ACK_TYPE_CREDIT, read_count_};
+        uint16_t fcs = checksum(seq_number, ACK_COMMAND, 2, report);
+        uint8_t data[3] = {read_count_, (uint8_t)(fcs >> 8), (uint8_t)(fcs & 0xFF)};
+        reported_count_ = read_count_;
+        send_ack(seq_number, ACK_TYPE_CREDIT, 3, data);
+    }
+
     /* Write a byte to the serial interface, escaping if necessary */
     void write_escaped(uint8_t data_byte)
     {
@@ -0,0 +1,74 @@
+""" End to end benchmarks over a simulated serial link (see arducomm.simulator).
+    The line has no transmission time or latency, so the results measure the software only.
+"""
+from time import time
+from threading import Event
+from arducomm import ArduComm
+from arducomm.simulator import LinkSimulator
+
+ECHO_COMMAND = 0x20
+PAYLOAD_SIZE = 32
+NUM_PACKETS = 500
+NUM_ROUND_TRIPS = 200
+
+
+def echo_handler(command, payload):
+    """ The simulated Arduino replies to the echo command with the same payload """
+    if command == ECHO_COMMAND:
+        return command + 1, payload
+    return None
+
+
+def percentile(values, p):
+    """ p-th percentile of the values, or None if there are none """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_throughput(num_packets=NUM_PACKETS, payload_size=PAYLOAD_SIZE, window_size=1, flow_control=False):
+    """ Packets per second sent to the simulated Arduino.
+        Windows of several frames need flow control, or they overflow the input buffer of the Arduino.
+    """
+    payload = bytes(payload_size)
+    with LinkSimulator(baudrate=None) as sim:
+        comm = ArduComm(None, port=sim.port, window_size=window_size, flow_control=flow_control)
+        comm.start()
+        # The first packet negotiates the modes
+        comm.send(ECHO_COMMAND - 1, payload)
+        t1 = time()
+        sent = sum(comm.send(ECHO_COMMAND - 1, payload) for i in range(num_packets))
+        flushed = comm.flush()
+        elapsed = time() - t1
+        comm.stop()
+    return {'packets': num_packets, 'sent': sent, 'flushed': flushed, 'seconds': elapsed, 'packets_per_second': sent / elapsed}
+
+
+def bench_round_trip(num_round_trips=NUM_ROUND_TRIPS, payload_size=PAYLOAD_SIZE):
+    """ Time (milliseconds) from sending a packet until its echo arrives """
+    payload = bytes(payload_size)
+    echo = Event()
+    with LinkSimulator(echo_handler, baudrate=None) as sim:
+        comm = ArduComm(lambda command, payload: echo.set(), port=sim.port)
+        comm.start()
+        round_trips = []
+        for i in range(num_round_trips):
+            echo.clear()
+            t1 = time()
+            if comm.send(ECHO_COMMAND, payload) and echo.wait(1.0):
+                round_trips.append((time() - t1) * 1e3)
+        comm.stop()
+    return {
+        'round_trips': len(round_trips),
+        'p50_ms': percentile(round_trips, 50),
+        'p99_ms': percentile(round_trips, 99),
+        'max_ms': max(round_trips, default=None),
+    }
+
+
+BENCHMARKS = {
+    'throughput_stop_and_wait': lambda: bench_throughput(window_size=1),
+    'throughput_window_8': lambda: bench_throughput(window_size=8, flow_control=True),
+    'round_trip': bench_round_trip,
+}
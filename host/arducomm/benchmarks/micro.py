@@ -0,0 +1,167 @@
+""" Microbenchmarks of the framing, checksum and serialization functions.
+    Each benchmark returns a dict with the time (microseconds) of each case.
+"""
+import random
+from timeit import Timer
+from arducomm import ArduComm, PacketFrame, types
+from arducomm.arducomm import FrameDecoder
+from arducomm.checksum import fletcher16, crc16
+from arducomm.simulator import LinkSimulator
+
+PAYLOAD_SIZES = (0, 16, 64, 255)
+REPEAT = 5
+
+
+def measure(function, repeat=REPEAT):
+    """ Time the function and return the best and median time per call (microseconds) """
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    times = sorted(t / number * 1e6 for t in timer.repeat(repeat, number))
+    return {'best_us': times[0], 'median_us': times[len(times) // 2]}
+
+
+def random_payload(size, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for i in range(size))
+
+
+def bench_serialize():
+    """ PacketFrame.serialize with random payloads and with payloads full of flags (all escaped) """
+    results = {}
+    for size in PAYLOAD_SIZES:
+        frame = PacketFrame(1, 5, random_payload(size))
+        results[F"random_{size}"] = measure(frame.serialize)
+        frame = PacketFrame(1, 5, bytes([0x7E]) * size)
+        results[F"escaped_{size}"] = measure(frame.serialize)
+    return results
+
+
+def bench_decode():
+    """ FrameDecoder.decode (find the flags and unescape) of a chunk with 10 frames """
+    results = {}
+    for size in PAYLOAD_SIZES:
+        for name, payload in (('random', random_payload(size)), ('escaped', bytes([0x7E]) * size)):
+            chunk = PacketFrame(1, 5, payload).serialize() * 10
+            decoder = FrameDecoder()
+            results[F"{name}_{size}"] = measure(lambda: decoder.decode(chunk))
+    return results
+
+
+def float_payloads(count, seed=0):
+    """ Return Imu and FloatArray payloads with random readings, like the ones of real sensors """
+    rng = random.Random(seed)
+    imus = []
+    arrays = []
+    for i in range(count):
+        orientation = types.Quaternion(*(rng.uniform(-1.0, 1.0) for j in range(4)))
+        imu = types.Imu(orientation, types.Vector3(*(rng.gauss(0.0, 0.5) for j in range(3))),
+                        types.Vector3(rng.gauss(0.0, 1.0), rng.gauss(0.0, 1.0), rng.gauss(9.8, 0.2)))
+        imus.append(imu.serialize())
+        arrays.append(types.FloatArray([rng.gauss(0.0, 100.0) for j in range(16)]).serialize())
+    return {'imu': imus, 'float_array_16': arrays}
+
+
+def bench_float_frames(num_payloads=1000):
+    """ Encode and decode frames with float payloads. Most of them do not contain any flag,
+        so they take the fast path (fast_frames is the fraction of them). The same frames are
+        also decoded in a chunk with one escaped frame, where every frame is checked for escapes.
+    """
+    results = {}
+    escaped = PacketFrame(1, 5, bytes([0x7E]) * 16).serialize()
+    for name, payloads in float_payloads(num_payloads).items():
+        frames = [PacketFrame(i % 256, 5, payload).serialize() for i, payload in enumerate(payloads)]
+        decoder = FrameDecoder()
+        decoder.decode(b''.join(frames))
+        results[F"{name}_fast_frames"] = decoder.stats.rx_fast_frames / decoder.stats.rx_frames
+        # Chunk of 10 frames without escaped bytes
+        clean = [payload for payload in payloads if PacketFrame(1, 5, payload).serialize().count(0x7D) == 0]
+        frame = PacketFrame(1, 5, clean[0])
+        chunk = b''.join(PacketFrame(1, 5, payload).serialize() for payload in clean[:10])
+        results[F"{name}_serialize"] = measure(frame.serialize)
+        results[F"{name}_decode"] = measure(lambda: decoder.decode(chunk))
+        mixed = chunk + escaped
+        results[F"{name}_decode_mixed"] = measure(lambda: decoder.decode(mixed))
+    return results
+
+
+def bench_process_frame():
+    """ ArduComm.process_frame of a packet (checksum, ACK and dispatch), with the payload copied
+        to bytes and passed as a memoryview (payload_views).
+        The ACKs are written to a simulated Arduino, which ignores them.
+    """
+    results = {}
+    with LinkSimulator(baudrate=None) as sim:
+        comm = ArduComm(None, port=sim.port)
+        comm.start()
+        for size in PAYLOAD_SIZES:
+            payload = random_payload(size)
+            data = bytearray([1, 5]) + payload + bytes(PacketFrame(1, 5, payload).checksum())
+            for views in (False, True):
+                comm.payload_views = views
+                name = 'view' if views else 'payload'
+                results[F"{name}_{size}"] = measure(lambda: comm.process_frame(data))
+        comm.stop()
+    return results
+
+
+def bench_checksum():
+    """ FCS functions and PacketFrame.checksum """
+    results = {}
+    for size in PAYLOAD_SIZES:
+        data = random_payload(size + 2)
+        frame = PacketFrame(1, 5, data[2:])
+        results[F"fletcher16_{size}"] = measure(lambda: fletcher16(data))
+        results[F"crc16_{size}"] = measure(lambda: crc16(data))
+        results[F"packet_checksum_{size}"] = measure(frame.checksum)
+    return results
+
+
+def type_samples():
+    """ Return a sample object of each type in arducomm.types """
+    return {
+        'FloatArray': types.FloatArray([float(i) for i in range(16)]),
+        'Vector2': types.Vector2(1.0, 2.0),
+        'Vector3': types.Vector3(1.0, 2.0, 3.0),
+        'Quaternion': types.Quaternion(0.0, 0.0, 0.0, 1.0),
+        'Pose2D': types.Pose2D(1.0, 2.0, 0.5),
+        'Pose': types.Pose(types.Vector3(1.0, 2.0, 3.0), types.Quaternion(0.0, 0.0, 0.0, 1.0)),
+        'Imu': types.Imu(types.Quaternion(0.0, 0.0, 0.0, 1.0), types.Vector3(1.0, 2.0, 3.0), types.Vector3(4.0, 5.0, 6.0)),
+    }
+
+
+def bench_types():
+    """ Serialize and parse each type in arducomm.types """
+    results = {}
+    for name, sample in type_samples().items():
+        buffer = sample.serialize()
+        dtype = type(sample)
+        results[F"{name}_serialize"] = measure(sample.serialize)
+        results[F"{name}_parse"] = measure(lambda: dtype().parse(buffer))
+    return results
+
+
+def bench_parse_many(num_payloads=1000):
+    """ Parse a batch of payloads of each type with parse_many (NumPy) and one by one """
+    try:
+        from arducomm.serialization import parse_many
+        parse_many([], 'uint8')
+    except ImportError:
+        return {'skipped': "NumPy is not installed"}
+    results = {}
+    for name, sample in type_samples().items():
+        payloads = [sample.serialize()] * num_payloads
+        dtype = type(sample)
+        results[F"{name}_parse_many"] = measure(lambda: parse_many(payloads, dtype))
+        results[F"{name}_parse_each"] = measure(lambda: [dtype().parse(payload) for payload in payloads])
+    return results
+
+
+BENCHMARKS = {
+    'serialize': bench_serialize,
+    'decode': bench_decode,
+    'float_frames': bench_float_frames,
+    'process_frame': bench_process_frame,
+    'checksum': bench_checksum,
+    'types': bench_types,
+    'parse_many': bench_parse_many,
+}
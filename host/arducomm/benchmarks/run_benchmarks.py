@@ -0,0 +1,61 @@
+""" Run the benchmarks and write the results in a JSON file, to compare them between releases.
+
+    Usage: python run_benchmarks.py [-o results.json] [-b serialize types round_trip ...]
+"""
+import sys
+import json
+import logging
+import platform
+from datetime import datetime
+import micro
+import e2e
+
+BENCHMARKS = dict(micro.BENCHMARKS, **e2e.BENCHMARKS)
+
+
+def arducomm_version():
+    """ Version of the installed arducomm package (None if it is not installed or Python < 3.8) """
+    try:
+        from importlib.metadata import version
+        return version('arducomm')
+    except Exception:
+        return None
+
+
+def main(args):
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(F"Unknown benchmarks: {unknown}. Available: {list(BENCHMARKS)}")
+        sys.exit(1)
+
+    results = {
+        'arducomm': arducomm_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'benchmarks': {},
+    }
+    for name in names:
+        print(F"{name}:")
+        result = BENCHMARKS[name]()
+        results['benchmarks'][name] = result
+        for case, value in result.items():
+            print(F"\t{case}: {value}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(F"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description="ArduComm benchmarks")
+    parser.add_argument("-o", "--output", default=None, type=str,
+                        help="JSON file to write the results")
+    parser.add_argument("-b", "--benchmarks", nargs='*', default=None,
+                        help=F"Benchmarks to run. Default: all ({', '.join(BENCHMARKS)})")
+    args = parser.parse_args()
+    main(args)
@@ -1,13 +1,16 @@
 """ Define a custom data type and transmit it with ArduComm.
 
-The custom "complex" type is Odometry, defined in the odometry.ino file.
+The custom "complex" type is Odometry, declared with a message schema.
+The odometry.h header of the Arduino example is generated from the same schema:
+    write_header("odometry.h", Odometry)
 
 This program will send an initial Odometry object with the command 0x02.
 Then it will receive the updates from the arduino with the command 0x05.
 
 """
 from arducomm import ArduComm
-from arducomm.serialization import Serializable, parse, serialize
+from arducomm.serialization import parse, serialize
+from arducomm.serialization.schema import message
 from arducomm.types import Pose, Vector3
 from time import time, sleep
 import logging
@@ -15,33 +18,12 @@ logging.basicConfig(level=logging.INFO)
 
 BAUDRATE = 57600
 
-class Odometry(Serializable):
-    """ Odometry type definition and serialization """
-    # Size in bytes
-    size = Pose.size + 2*Vector3.size
-
-    def __init__(self, pose=Pose(), linear_vel=Vector3(), angular_vel=Vector3()):
-        self.pose = pose
-        self.linear_vel = linear_vel
-        self.angular_vel = angular_vel
-    
-    def __repr__(self):
-        return F"{self.pose.__repr__()} - {self.linear_vel.__repr__()} - {self.angular_vel.__repr__()}]"
-
-    def serialize(self):
-        """ Serialize the data contained in self.
-            Return a bytes-like object with the serialized data.
-        """
-        return serialize(self.pose) + serialize(self.linear_vel) + serialize(self.angular_vel)
-
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
-            Update the instance object and return self.
-        """
-        self.pose.parse(buffer[:Pose.size])
-        self.linear_vel.parse(buffer[Pose.size:(Pose.size + Vector3.size)])
-        self.angular_vel.parse(buffer[(Pose.size + Vector3.size):])
-        return self
+@message
+class Odometry:
+    """ Odometry type definition. The serialization is generated from the fields """
+    pose: Pose
+    linear_vel: Vector3
+    angular_vel: Vector3
 
 
 last_rx_time = 0
@@ -54,18 +36,18 @@ def comms_callback(command, payload):
     print("\t\tPayload:")
     print(F"\t\t{payload}")
 
-    # Process message
-    if command == 0x05:
-        odom = Odometry().parse(payload)
-        # Alternative:
-        # odom = parse(payload, dtype=Odometry)
-        print("##########")
-        print(F"Received an odometry update:\n{odom}")
+def odom_callback(odom):
+    # The payload of command 0x05 is already parsed into an Odometry object
+    # Alternative (inside comms_callback):
+    # odom = parse(payload, dtype=Odometry)
+    print("##########")
+    print(F"Received an odometry update:\n{odom}")
 
 def main(args):
     print(F"Serial port: {args.port}")
     print(F"Baudrate: {args.baudrate}")
     comm = ArduComm(comms_callback, port=args.port, baudrate=args.baudrate)
+    comm.subscribe(0x05, Odometry, odom_callback)
     comm.start()
     sleep(2)
 
@@ -1,3 +1,8 @@
 from .arducomm import ArduComm, PacketFrame
+from .async_arducomm import AsyncArduComm
+from .hub import ArduCommHub
 from . import serialization
+from . import checksum
+from . import stats
+from . import capture
 from . import types
@@ -2,54 +2,86 @@
     and the Arduino in Roberto over a serial port.
 
     The communication protocol is based on HLDLC with ARQ-StopAndWait error control.
+    An optional windowed ARQ mode (Go-Back-N) can be negotiated with the peer.
 """
 
 import serial
 import sys
+import heapq
 import logging
+from collections import deque
+from concurrent.futures import Future
 from time import sleep, time
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, Event, current_thread, local
+from .dispatcher import Dispatcher, QUEUE_SIZE, BLOCK
+from .subscriber import Subscriber
+from .stats import LinkStats
+from .checksum import FLETCHER16, CRC16, CRC16_LUT, FCS_FUNCTIONS, crc16
 
 # Logging setup
 logging.getLogger('ArduComm').addHandler(logging.NullHandler())
 
 # Default baudrate
 BAUDRATE = 57600
-# Maximum number of retries if the packet ACK returns with an error 
+# Maximum number of transmissions of a packet (rejected by the peer or without ACK)
 MAX_RETRIES = 3
-# Max timeout (seconds) to wait for an ACK
+# Max timeout (seconds) to wait for an ACK. It is also the initial retransmission timeout.
 TIMEOUT = 3.0
-# Time (seconds) to wait before checking if the ACK has been received
-ACK_POLL_TIME = 0.001
-# Time (seconds) to wait between each ser.inWaiting() check
+# Min retransmission timeout (seconds), to absorb the scheduling and USB latency
+MIN_RTO = 0.05
+# The retransmission timeout is multiplied by this factor after each timeout (exponential backoff)
+BACKOFF = 2.0
+# Time (seconds) to wait between each ser.inWaiting() check (polling receive mode)
 PACKET_POLL_TIME = 0.001 # seconds
-# Time (seconds) required by the Arduino to read its input buffer (64 bytes)
+# Max time (seconds) that a blocking read waits for new bytes (blocking receive mode)
+READ_TIMEOUT = 0.1
+# Size of the Arduino serial input buffer. Peers without flow control get chunks of this size.
+ARDUINO_RX_BUFFER_SIZE = 64
+# Time (seconds) required by the Arduino to read its input buffer (peers without flow control)
 ARDUINO_READ_TIME = 0.05
+# Time (seconds) without credits before requesting a credit report (plus the time to receive the peer buffer)
+CREDIT_REQUEST_TIME = 0.05
+# Max time (seconds) to wait for credits before assuming that the peer buffer is empty
+CREDIT_TIMEOUT = 1.0
+# Credits kept for the ACKs, which are written without waiting for credits
+ACK_CREDITS = 8
 
 ACK_COMMAND = 0x01
 
+# Types of ACK frames. Plain ACKs do not include the type byte (see Protocol.md)
+ACK_TYPE_PLAIN = 0x00
+ACK_TYPE_NACK = 0x01
+ACK_TYPE_WINDOW_REQUEST = 0x02
+ACK_TYPE_WINDOW_REPLY = 0x03
+ACK_TYPE_FLOW_REQUEST = 0x04
+ACK_TYPE_FLOW_REPLY = 0x05
+ACK_TYPE_CREDIT = 0x06
+ACK_TYPE_CREDIT_REQUEST = 0x07
+
+# Max number of frames that can be waiting for their ACK in windowed ARQ mode
+MAX_WINDOW_SIZE = 127
+
+# Result of waiting for the ACK of a frame
+ACK_UNSET = 0
+ACK_OK = 1
+ACK_RETRY = 2
+
 START_FLAG = 0x7E
 ESCAPE_FLAG = 0x7D
 
-CRC16_LUT = [ 
-    0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50A5, 0x60C6, 0x70E7, 0x8108, 0x9129, 0xA14A, 0xB16B, 0xC18C, 0xD1AD, 0xE1CE, 0xF1EF,
-    0x1231, 0x0210, 0x3273, 0x2252, 0x52B5, 0x4294, 0x72F7, 0x62D6, 0x9339, 0x8318, 0xB37B, 0xA35A, 0xD3BD, 0xC39C, 0xF3FF, 0xE3DE,
-    0x2462, 0x3443, 0x0420, 0x1401, 0x64E6, 0x74C7, 0x44A4, 0x5485, 0xA56A, 0xB54B, 0x8528, 0x9509, 0xE5EE, 0xF5CF, 0xC5AC, 0xD58D,
-    0x3653, 0x2672, 0x1611, 0x0630, 0x76D7, 0x66F6, 0x5695, 0x46B4, 0xB75B, 0xA77A, 0x9719, 0x8738, 0xF7DF, 0xE7FE, 0xD79D, 0xC7BC,
-    0x48C4, 0x58E5, 0x6886, 0x78A7, 0x0840, 0x1861, 0x2802, 0x3823, 0xC9CC, 0xD9ED, 0xE98E, 0xF9AF, 0x8948, 0x9969, 0xA90A, 0xB92B,
-    0x5AF5, 0x4AD4, 0x7AB7, 0x6A96, 0x1A71, 0x0A50, 0x3A33, 0x2A12, 0xDBFD, 0xCBDC, 0xFBBF, 0xEB9E, 0x9B79, 0x8B58, 0xBB3B, 0xAB1A,
-    0x6CA6, 0x7C87, 0x4CE4, 0x5CC5, 0x2C22, 0x3C03, 0x0C60, 0x1C41, 0xEDAE, 0xFD8F, 0xCDEC, 0xDDCD, 0xAD2A, 0xBD0B, 0x8D68, 0x9D49,
-    0x7E97, 0x6EB6, 0x5ED5, 0x4EF4, 0x3E13, 0x2E32, 0x1E51, 0x0E70, 0xFF9F, 0xEFBE, 0xDFDD, 0xCFFC, 0xBF1B, 0xAF3A, 0x9F59, 0x8F78,
-    0x9188, 0x81A9, 0xB1CA, 0xA1EB, 0xD10C, 0xC12D, 0xF14E, 0xE16F, 0x1080, 0x00A1, 0x30C2, 0x20E3, 0x5004, 0x4025, 0x7046, 0x6067,
-    0x83B9, 0x9398, 0xA3FB, 0xB3DA, 0xC33D, 0xD31C, 0xE37F, 0xF35E, 0x02B1, 0x1290, 0x22F3, 0x32D2, 0x4235, 0x5214, 0x6277, 0x7256,
-    0xB5EA, 0xA5CB, 0x95A8, 0x8589, 0xF56E, 0xE54F, 0xD52C, 0xC50D, 0x34E2, 0x24C3, 0x14A0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
-    0xA7DB, 0xB7FA, 0x8799, 0x97B8, 0xE75F, 0xF77E, 0xC71D, 0xD73C, 0x26D3, 0x36F2, 0x0691, 0x16B0, 0x6657, 0x7676, 0x4615, 0x5634,
-    0xD94C, 0xC96D, 0xF90E, 0xE92F, 0x99C8, 0x89E9, 0xB98A, 0xA9AB, 0x5844, 0x4865, 0x7806, 0x6827, 0x18C0, 0x08E1, 0x3882, 0x28A3,
-    0xCB7D, 0xDB5C, 0xEB3F, 0xFB1E, 0x8BF9, 0x9BD8, 0xABBB, 0xBB9A, 0x4A75, 0x5A54, 0x6A37, 0x7A16, 0x0AF1, 0x1AD0, 0x2AB3, 0x3A92,
-    0xFD2E, 0xED0F, 0xDD6C, 0xCD4D, 0xBDAA, 0xAD8B, 0x9DE8, 0x8DC9, 0x7C26, 0x6C07, 0x5C64, 0x4C45, 0x3CA2, 0x2C83, 0x1CE0, 0x0CC1,
-    0xEF1F, 0xFF3E, 0xCF5D, 0xDF7C, 0xAF9B, 0xBFBA, 0x8FD9, 0x9FF8, 0x6E17, 0x7E36, 0x4E55, 0x5E74, 0x2E93, 0x3EB2, 0x0ED1, 0x1EF0
-]
+# Byte sequences used to escape the flags in bulk
+START_FLAG_BYTES = bytes([START_FLAG])
+ESCAPE_FLAG_BYTES = bytes([ESCAPE_FLAG])
+ESCAPED_START_FLAG = bytes([ESCAPE_FLAG, START_FLAG ^ (1 << 5)])
+ESCAPED_ESCAPE_FLAG = bytes([ESCAPE_FLAG, ESCAPE_FLAG ^ (1 << 5)])
+# End flag of a frame followed by the start flag of the next one (the frames never contain flags)
+FRAME_BOUNDARY = bytes([START_FLAG, START_FLAG])
+
+# Bytes of a frame that are not payload (flags, seq number, command and FCS)
+FRAME_OVERHEAD = 6
 
+# Max size of a frame, if all the bytes (seq number, command, 255 bytes of payload and FCS) are escaped
+MAX_FRAME_SIZE = 2 + 2 * (2 + 255 + 2)
 
 def check_flag_conflict(val):
     """ Check if the byte conflicts with one of the flags """
@@ -70,109 +102,859 @@ def escape_byte(val):
         escaped_data.append(val)
     return bytearray(escaped_data)
 
+def escape(data):
+    """ Escape the flags in the data (bytes or bytearray) with bulk replaces.
+        The data is returned as is if there is nothing to escape.
+    """
+    if ESCAPE_FLAG in data:
+        # Escape flags must be replaced first, so the ones added next are not escaped again
+        data = data.replace(ESCAPE_FLAG_BYTES, ESCAPED_ESCAPE_FLAG)
+    if START_FLAG in data:
+        data = data.replace(START_FLAG_BYTES, ESCAPED_START_FLAG)
+    return data
+
+def unescape(data):
+    """ Restore the escaped bytes of a frame and return them as a bytearray.
+        The data is scanned with bytes.find, so unescaped runs are copied in bulk.
+        A bytearray without escaped bytes is returned as is, without copying it.
+    """
+    i = data.find(ESCAPE_FLAG)
+    if i < 0:
+        return data if isinstance(data, bytearray) else bytearray(data)
+    if data.count(ESCAPE_FLAG) == data.count(ESCAPED_START_FLAG) + data.count(ESCAPED_ESCAPE_FLAG):
+        # Only the flags are escaped, so both sequences can be replaced in bulk. The escaped start flags go
+        # first: replacing the escaped escape flags first could create new escaped start flags (7D 5D 5E).
+        return bytearray(data.replace(ESCAPED_START_FLAG, START_FLAG_BYTES).replace(ESCAPED_ESCAPE_FLAG, ESCAPE_FLAG_BYTES))
+    unescaped_data = bytearray(data[:i])
+    while i >= 0:
+        if i + 1 >= len(data):
+            # Trailing escape flag with nothing to invert. Drop it.
+            break
+        unescaped_data.append(invert_bit_5(data[i + 1]))
+        j = data.find(ESCAPE_FLAG, i + 2)
+        unescaped_data += data[i + 2:j] if j >= 0 else data[i + 2:]
+        i = j
+    return unescaped_data
+
+
+class FrameDecoder(object):
+    """ Incremental frame decoder.
+        Bytes are fed in chunks of any size (as returned by ser.read) and the complete
+        frames found between START_FLAGs are returned already unescaped, without the flags.
+        Incomplete frames are kept in the internal buffer until the closing flag arrives.
+        Each frame is a new bytearray, split from the buffer (and only unescaped if it has escaped
+        bytes), so it can be kept (or viewed) after the next chunk is decoded.
+        The bytes, frames and errors are counted in stats (a LinkStats object).
+    """
+    def __init__(self, stats=None):
+        # Bytes of the frame currently being received (starting with a START_FLAG)
+        self.buffer = bytearray()
+        self.stats = stats if stats is not None else LinkStats()
+
+    def reset(self):
+        """ Drop the partial frame stored in the buffer """
+        self.buffer.clear()
+
+    def decode(self, chunk):
+        """ Add the chunk of bytes to the buffer and return a list with the complete frames.
+            Each frame is a bytearray with the unescaped data between the flags.
+        """
+        stats = self.stats
+        stats.rx_bytes += len(chunk)
+        buffer = self.buffer
+        buffer += chunk
+        if not buffer:
+            return []
+        if buffer[0] != START_FLAG:
+            # Broken frame. Drop bytes until a START_FLAG arrives
+            stats.rx_broken_frames += 1
+            logging.warn(F"Broken frame. Current buffer: {[i for i in buffer]}")
+            start = buffer.find(START_FLAG)
+            if start < 0:
+                buffer.clear()
+                return []
+            del buffer[:start]
+
+        # The first chunk is always empty (buffer starts with a flag) and the last one is
+        # the incomplete frame that is still being received.
+        chunks = buffer.split(bytes([START_FLAG]))
+        frames = []
+        for frame_data in chunks[1:-1]:
+            if len(frame_data) > 1:
+                frames.append(frame_data)
+            elif frame_data:
+                # We received a start flag but the frame is too small to contain a full frame
+                stats.rx_short_frames += 1
+                logging.warn(F"Packet frame too small. Current buffer: {[START_FLAG] + [i for i in frame_data]}")
+            # Empty chunks are ghost frames (between end_flag and start_flag). Skip them.
+        stats.rx_frames += len(frames)
+
+        # Most frames have no escaped bytes, so the complete frames are scanned once to skip unescaping them
+        if buffer.find(ESCAPE_FLAG, 0, len(buffer) - len(chunks[-1])) < 0:
+            stats.rx_fast_frames += len(frames)
+        else:
+            for i, frame_data in enumerate(frames):
+                data = unescape(frame_data)
+                if data is frame_data:
+                    stats.rx_fast_frames += 1
+                else:
+                    stats.rx_escape_bytes += len(frame_data) - len(data)
+                    frames[i] = data
+
+        # Assume the last flag is the start of the next frame
+        if len(chunks) > 2:
+            self.buffer = bytearray([START_FLAG]) + chunks[-1]
+        return frames
+
+
+class FrameEncoder(object):
+    """ Build the frames in a preallocated buffer, so the only new object is the returned bytes.
+        The buffer is reused for every frame, so each thread must use its own encoder (see get_encoder).
+    """
+    def __init__(self):
+        self.buffer = bytearray(MAX_FRAME_SIZE)
+        self.view = memoryview(self.buffer)
+        self.buffer[0] = START_FLAG
+
+    def encode(self, seq_number, command, payload, fcs=FLETCHER16):
+        """ Return the bytes of a packet frame with the given data and its FCS """
+        buffer = self.buffer
+        end = 3 + len(payload)
+        buffer[1] = seq_number
+        buffer[2] = command
+        self.view[3:end] = payload
+        checksum = FCS_FUNCTIONS[fcs](self.view[1:end])
+        buffer[end] = checksum >> 8
+        buffer[end + 1] = checksum & 0xFF
+        return self.finish(end + 2)
+
+    def encode_ack(self, seq_number, ack_type=ACK_TYPE_PLAIN, data=b''):
+        """ Return the bytes of an ACK frame """
+        buffer = self.buffer
+        end = 3
+        buffer[1] = seq_number
+        buffer[2] = ACK_COMMAND
+        if ack_type != ACK_TYPE_PLAIN:
+            buffer[3] = ack_type
+            end = 4 + len(data)
+            self.view[4:end] = data
+        return self.finish(end)
+
+    def finish(self, end):
+        """ Escape the data in the buffer (up to end), add the end flag and return the frame bytes """
+        buffer = self.buffer
+        if buffer.find(START_FLAG, 1, end) >= 0 or buffer.find(ESCAPE_FLAG, 1, end) >= 0:
+            escaped_data = escape(bytes(self.view[1:end]))
+            end = 1 + len(escaped_data)
+            self.view[1:end] = escaped_data
+        buffer[end] = START_FLAG
+        return bytes(self.view[:end + 1])
+
+
+def readonly(view):
+    """ Return a read-only version of a memoryview (toreadonly is not available in Python 3.7) """
+    return view.toreadonly() if hasattr(view, 'toreadonly') else view
+
+
+# Frame encoder of each thread
+_thread_data = local()
+
+def get_encoder():
+    """ Return the FrameEncoder of the current thread """
+    try:
+        return _thread_data.encoder
+    except AttributeError:
+        _thread_data.encoder = FrameEncoder()
+        return _thread_data.encoder
+
+
 class PacketFrame(object):
-    """ Class to implement the packet frame functionality """
-    def __init__(self, seq_number, command, payload):
+    """ Class to implement the packet frame functionality.
+        fcs selects the algorithm of the frame check sequence (FLETCHER16 or CRC16).
+    """
+    def __init__(self, seq_number, command, payload, fcs=FLETCHER16):
         self.seq_number = seq_number & 0xFF
         self.command = command & 0xFF
         if len(payload) > 255:
             raise ValueError(F"Payload cannot have more than 255 bytes. Current payload length is {len(payload)}")
+        if fcs not in FCS_FUNCTIONS:
+            raise ValueError(F"Unknown FCS algorithm: '{fcs}'")
         self.payload = bytearray(payload)
+        self.fcs = fcs
 
     def serialize(self):
         """ Convert the object to a byte string to send it over the serial port and add the checksum """
-        data = []
-        # Start
-        data.append(START_FLAG)
-
-        # Sequence number
-        data += escape_byte(self.seq_number)
-        # Command
-        data += escape_byte(self.command)
-        # Payload
-        for payload_b in self.payload:
-            data += escape_byte(payload_b)
-
-        # Checksum
-        checksum_msb, checksum_lsb = self.checksum()
-        data += escape_byte(checksum_msb)
-        data += escape_byte(checksum_lsb)
-
-        # End
-        data.append(START_FLAG)
-
-        return data
+        return get_encoder().encode(self.seq_number, self.command, self.payload, self.fcs)
 
     def crc16(self):
-        """ CRC-16 (CCITT) implemented with a precomputed lookup table.
-            Currently not used as 16-bit Fletcher's is faster.
-        """
-        crc = 0xFFFF
-        crc = (crc << 8) ^ CRC16_LUT[(crc >> 8) ^ self.seq_number]
-        crc &= 0xFFFF # important, crc must stay 16bits all the way through
-        crc = (crc << 8) ^ CRC16_LUT[(crc >> 8) ^ self.command]
-        crc &= 0xFFFF
-        for payload_byte in self.payload:
-            crc = (crc << 8) ^ CRC16_LUT[(crc >> 8) ^ payload_byte]
-            crc &= 0xFFFF
-        return crc
+        """ CRC-16 (CCITT) of the data (see checksum.crc16) """
+        return crc16(bytes([self.seq_number, self.command]) + self.payload)
 
     def checksum(self):
-        """ Compute the 16bit Fletcher's checksum of the data """
-        lsb = 0
-        msb = 0
-        data = bytearray([self.seq_number, self.command]) + self.payload
-        for i in range(len(data)):
-            lsb += data[i]
-            msb += lsb
-            if i % 16 == 0:
-                # Do a reduction each 16 bytes
-                lsb = (lsb & 0xFF) + (lsb >> 8)
-                msb = (msb & 0xFF) + (msb >> 8)
-        # Last double reduction to add the carry
-        lsb = (lsb & 0xFF) + (lsb >> 8)
-        lsb = (lsb & 0xFF) + (lsb >> 8)
-        msb = (msb & 0xFF) + (msb >> 8)
-        msb = (msb & 0xFF) + (msb >> 8)
-        return msb, lsb
+        """ Compute the frame check sequence of the data with the frame's FCS algorithm.
+            Return the (msb, lsb) bytes.
+        """
+        fcs = FCS_FUNCTIONS[self.fcs](bytes([self.seq_number, self.command]) + self.payload)
+        return fcs >> 8, fcs & 0xFF
 
 
 class ACKFrame(PacketFrame):
-    """ Class to implement the ACK frame functionality """
-    def __init__(self, seq_number):
+    """ Class to implement the ACK frame functionality.
+        ACKs other than ACK_TYPE_PLAIN carry the type byte and its optional data after the command.
+    """
+    def __init__(self, seq_number, ack_type=ACK_TYPE_PLAIN, data=[]):
         self.seq_number = seq_number
         self.command = ACK_COMMAND
+        self.ack_type = ack_type
+        self.data = bytearray(data)
 
     def serialize(self):
-        """ Convert the object to a byte string to send it over the serial port and add the checksum """
-        data = []
-        # Start
-        data.append(START_FLAG)
+        """ Convert the object to a byte string to send it over the serial port """
+        return get_encoder().encode_ack(self.seq_number, self.ack_type, self.data)
+
+
+class FlowControl(object):
+    """ Credit-based flow control for a peer with a small input buffer (see Protocol.md).
+        The sender starts with one credit for each byte of the peer buffer and spends them as it
+        writes. The peer reports the total number of bytes it has read (mod 256) in CREDIT frames.
+        Reports with more bytes than the ones written are rejected (the FCS is checked by the link).
+
+        Whole frames are written when they fit in the peer buffer, so the writes only stop
+        between frames. If the credits run out there and no report arrives for request_time seconds
+        (it was lost, or the bytes were lost on the line and will never be read), request(seq_number)
+        writes a CREDIT_REQUEST and returns its size. When the peer replies, it has read everything
+        written before the request, so the credits are set again from the bytes written after it.
+        If the peer does not reply before timeout (or a larger frame stops in the middle), the peer
+        buffer is assumed to be empty.
+    """
+    def __init__(self, buffer_size, timeout=CREDIT_TIMEOUT, stats=None, request=None, request_time=CREDIT_REQUEST_TIME):
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.stats = stats if stats is not None else LinkStats()
+        self.request = request
+        self.request_time = request_time
+        # Packets leave some room in the peer buffer for the ACKs
+        self.reserved = min(ACK_CREDITS, buffer_size // 2)
+        self.credits = buffer_size
+        self.read_total = 0
+        # Total number of bytes written, and the number when the last request was written
+        self.write_total = 0
+        self.request_total = 0
+        # Sequence number of the request waiting for its reply (0 if there is none)
+        self.request_seq = 0
+        self.cond = Condition()
+
+    def grant(self, seq_number, read_total):
+        """ Process a credit report with the total number of bytes read by the peer.
+            seq_number is the sequence number of the request it replies to, or 0.
+        """
+        with self.cond:
+            if seq_number and seq_number == self.request_seq:
+                # Reply to the last request. The bytes written before it were read or lost.
+                self.credits = self.buffer_size - (self.write_total - self.request_total)
+                self.request_seq = 0
+            else:
+                read = (read_total - self.read_total) % 256
+                if read > self.buffer_size - self.credits:
+                    # More bytes than the ones in the peer buffer. The report is corrupted or stale.
+                    self.stats.credit_errors += 1
+                    logging.warn(F"Invalid credit report ({read} bytes read). Ignoring it.")
+                    return
+                self.credits += read
+            self.read_total = read_total
+            self.cond.notify_all()
+
+    def take(self, data, boundary=True):
+        """ Wait until there are credits available for the next frame of data (the serialized frames)
+            and spend them. Return the number of bytes that can be written: as many whole frames as
+            there are credits, or part of a frame that does not fit in the peer buffer.
+            boundary is False if data starts in the middle of a frame (no requests can be written).
+        """
+        with self.cond:
+            # Wait for the first frame (or the rest of it), unless it is larger than the buffer
+            needed = min(data.find(START_FLAG, 1 if boundary else 0) + 1 or len(data), self.buffer_size - self.reserved)
+            now = time()
+            deadline = now + self.timeout
+            request_time = now + self.request_time if self.request is not None and boundary else deadline
+            while self.credits - self.reserved < needed:
+                if now >= deadline:
+                    # The peer does not reply. Assume its buffer is empty by now.
+                    self.stats.credit_timeouts += 1
+                    logging.warn("Credit timeout exceeded. Resetting the flow control credits.")
+                    self.credits = self.buffer_size
+                    break
+                if now >= request_time:
+                    self.send_request()
+                    request_time = now + self.request_time
+                self.cond.wait(min(deadline, request_time) - now)
+                now = time()
+            size = min(len(data), self.credits - self.reserved)
+            if size < len(data):
+                # Stop after the last whole frame
+                size = data.rfind(FRAME_BOUNDARY, 0, size + 1) + 1 or size
+            self.credits -= size
+            self.write_total += size
+        return size
+
+    def send_request(self):
+        """ Request a credit report. Must be called with the condition acquired. """
+        self.request_seq = self.request_seq % 255 + 1
+        size = self.request(self.request_seq)
+        self.credits -= size
+        self.write_total += size
+        self.request_total = self.write_total
+        self.stats.credit_requests += 1
+
+    def spend(self, size):
+        """ Spend credits without waiting. ACK frames are small and must not be delayed. """
+        with self.cond:
+            self.credits -= size
+            self.write_total += size
+
+
+class RTOEstimator(object):
+    """ Retransmission timeout of a link, computed from the measured round-trip times
+        like in TCP (RFC 6298): RTO = SRTT + 4 * RTTVAR, between min_rto and max_rto.
+        The RTO does not include the time to transmit the frame, which is added for each frame
+        (byte_time is the time to transmit one byte). After a timeout, the RTO is multiplied by
+        the backoff factor until a new round-trip time is measured.
+        The measured times (including the transmission) are added to the histogram, if given.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, byte_time=0.0, initial_rto=TIMEOUT, min_rto=MIN_RTO, max_rto=TIMEOUT, backoff=BACKOFF, histogram=None):
+        self.byte_time = byte_time
+        self.histogram = histogram
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.backoff_factor = backoff
+        self.rto = initial_rto
+        # Smoothed round-trip time and its variation. None until the first measurement.
+        self.srtt = None
+        self.rttvar = None
+        self.lock = Lock()
+
+    def timeout(self, size):
+        """ Time (seconds) to wait for the ACK of a frame of size bytes, after writing it """
+        return self.rto + size * self.byte_time
+
+    def sample(self, elapsed, size):
+        """ Update the RTO with the time elapsed between writing a frame of size bytes and its ACK.
+            Only frames transmitted once are measured (Karn's algorithm).
+        """
+        rtt = max(0.0, elapsed - size * self.byte_time)
+        with self.lock:
+            if self.histogram is not None:
+                self.histogram.observe(elapsed)
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+            self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def backoff(self):
+        """ Increase the RTO after a timeout """
+        with self.lock:
+            self.rto = min(self.rto * self.backoff_factor, self.max_rto)
 
-        # Sequence number
-        data += escape_byte(self.seq_number)
-        # Command
-        data.append(self.command)
 
-        # End
-        data.append(START_FLAG)
- 
-        return bytearray(data)
+class Transmission(object):
+    """ Retransmission state of a packet frame sent with Stop-and-Wait, shared by ArduComm and
+        AsyncArduComm. The link writes the frame, waits for its ACK up to timeout() and passes the
+        result to result(), which updates the RTO and the counters (stats, a LinkStats object)
+        and decides if the frame must be written again.
+    """
+    def __init__(self, frame, rto, max_retries=MAX_RETRIES, stats=None):
+        self.frame = frame
+        # The frame is serialized only once, and the same bytes are written in each retry
+        self.data = frame.serialize()
+        self.rto = rto
+        self.max_retries = max_retries
+        self.stats = stats if stats is not None else LinkStats()
+        self.retries = 0
+        self.write_time = None
+
+    def written(self):
+        """ Start waiting for the ACK. Called right after writing the frame. """
+        self.write_time = time()
+
+    def timeout(self):
+        """ Time (seconds) to wait for the ACK of the last write """
+        return self.rto.timeout(len(self.data))
+
+    def result(self, ack):
+        """ Process the ACK of the last write (ACK_OK, ACK_RETRY, or ACK_UNSET if the timeout expired).
+            Return True if the frame was acknowledged, False if it could not be sent after
+            max_retries transmissions, or None if it must be written again.
+        """
+        frame = self.frame
+        stats = self.stats
+        if ack == ACK_OK:
+            if self.retries == 0:
+                self.rto.sample(time() - self.write_time, len(self.data))
+            stats.tx_packets += 1
+            return True
+        self.retries += 1
+        if ack == ACK_UNSET:
+            stats.timeouts += 1
+            self.rto.backoff()
+            logging.warn("Timeout exceeded. Did not receive the ACK for packet {n} with command {c}".format(n=frame.seq_number, c=frame.command))
+        else:
+            stats.nacks += 1
+        if self.retries >= self.max_retries:
+            stats.count_failed()
+            logging.warn('Could not send packet {n} with command {c}'.format(c=frame.command, n=frame.seq_number))
+            return False
+        stats.retries += 1
+        logging.warn("Retrying packet {n}...".format(n=frame.seq_number))
+        return None
+
+
+class WindowEntry(object):
+    """ Frame sent in windowed ARQ mode that is waiting for its ACK """
+    def __init__(self, frame, future=None):
+        self.frame = frame
+        self.data = frame.serialize()
+        # None until the frame is written for the first time. 0 if it was rejected with a NACK.
+        self.deadline = None
+        self.retries = 0
+        # Number of times the frame was written, the last time, and the bytes written in the
+        # same batch up to the end of this frame (to measure the round-trip time)
+        self.writes = 0
+        self.write_time = None
+        self.write_size = 0
+        # Resolved when the frame is acknowledged (True) or dropped (False)
+        self.future = future
+
+
+def resolve(entries, result):
+    """ Resolve the futures of the given window entries.
+        Called without holding the window lock, because the futures run their callbacks.
+    """
+    for entry in entries:
+        if entry.future is not None and not entry.future.done():
+            entry.future.set_result(result)
+
+
+class TXRequest(object):
+    """ Packet waiting in the send queue """
+    def __init__(self, command, payload):
+        self.command = command
+        self.payload = payload
+        # Resolved when the packet is acknowledged (True) or could not be sent (False)
+        self.future = Future()
+        # Result for send(): set when the packet is acknowledged (Stop-and-Wait) or queued in the window
+        self.result = None
+        self.accepted = Event()
+
+    def accept(self, result):
+        self.result = result
+        self.accepted.set()
+
+    def finish(self, result):
+        """ Resolve the request (it was acknowledged or it could not be sent) """
+        if not self.future.done():
+            self.future.set_result(result)
+        self.accept(result)
+
+
+class TXQueue(object):
+    """ Priority queue of the packets waiting to be sent.
+        Packets with higher priority are sent first, and packets with the same priority
+        in the order they were queued.
+    """
+    def __init__(self):
+        self.heap = []
+        # Order of arrival, to break the ties between packets with the same priority
+        self.count = 0
+        self.cond = Condition()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, request, priority=0):
+        """ Queue a request. Return False if the queue is closed. """
+        with self.cond:
+            if self.closed:
+                return False
+            heapq.heappush(self.heap, (-priority, self.count, request))
+            self.count += 1
+            self.cond.notify()
+        return True
+
+    def get(self):
+        """ Wait for the next request. Return None if the queue is closed. """
+        with self.cond:
+            self.cond.wait_for(lambda: self.heap or self.closed)
+            if self.closed:
+                return None
+            return heapq.heappop(self.heap)[2]
+
+    def close(self):
+        """ Close the queue and return the requests that were not sent """
+        with self.cond:
+            self.closed = True
+            requests = [item[2] for item in sorted(self.heap)]
+            self.heap = []
+            self.cond.notify_all()
+        return requests
+
+
+class SlidingWindow(Thread):
+    """ Sender side of the windowed ARQ mode (Go-Back-N).
+        Up to window_size frames can be sent without waiting for their ACKs.
+        ACKs are cumulative: an ACK with sequence number n acknowledges all the frames before n.
+        Each frame has its own retransmission timer, handled in this thread. When the oldest
+        frame times out or is rejected with a NACK, all the frames in the window are sent again.
+        This thread writes all the frames, so they are always sent in order and the senders
+        do not block while the port waits for flow control credits. The frames that are ready
+        at the same time are written together, with a single write.
+    """
+    def __init__(self, write, window_size, next_seq, rto=None, max_retries=MAX_RETRIES, fcs=FLETCHER16, stats=None):
+        """ write(frames) writes a list of serialized frames.
+            rto is the RTOEstimator of the link, which sets the retransmission timers.
+            The ACKs, retries and drops are counted in stats (the LinkStats of the link).
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.write = write
+        self.fcs = fcs
+        self.window_size = window_size
+        self.next_seq = next_seq
+        self.rto = rto or RTOEstimator()
+        self.max_retries = max_retries
+        self.stats = stats if stats is not None else LinkStats()
+        # Frames waiting for their ACK, in the order they were sent
+        self.entries = deque()
+        # Number of frames at the end of the window that were not written yet
+        self.unsent = 0
+        self.cond = Condition()
+        # Number of frames dropped since the last flush
+        self.failed = 0
+        # Set when a frame could not be sent. The peer must be synchronized again.
+        self.broken = False
+        # Entries dropped, waiting to resolve their futures
+        self.dropped = []
+        self.running = True
+
+    def run(self):
+        """ Write the new frames and retransmit the window when the oldest frame times out """
+        while True:
+            with self.cond:
+                entries = self.next_entries()
+                dropped, self.dropped = self.dropped, []
+                for entry in entries or []:
+                    # Counted before writing: an ACK that arrives during the write (which can be long
+                    # without flow control) must not be measured against the previous write (Karn's algorithm)
+                    entry.writes += 1
+                    entry.write_time = None
+            resolve(dropped, False)
+            if entries is None:
+                return
+            if entries:
+                self.write([entry.data for entry in entries])
+                now = time()
+                size = 0
+                for entry in entries:
+                    # Each frame waits until the frames before it are transmitted
+                    size += len(entry.data)
+                    entry.write_time = now
+                    entry.write_size = size
+                    entry.deadline = now + self.rto.timeout(size)
+
+    def next_entries(self):
+        """ Wait until there are frames to write and return them (None if the window is stopped).
+            An empty list is returned if some frames were dropped, to resolve them.
+            Must be called with the condition acquired.
+        """
+        while self.running:
+            if not self.entries:
+                self.cond.wait()
+                continue
+            head = self.entries[0]
+            if head.deadline is not None and head.deadline <= time():
+                if head.deadline > 0:
+                    # Timeout (not a NACK)
+                    self.stats.timeouts += 1
+                    self.rto.backoff()
+                head.retries += 1
+                if head.retries >= self.max_retries:
+                    logging.warn('Could not send packet {n} with command {c}'.format(c=head.frame.command, n=head.frame.seq_number))
+                    logging.warn(F"Dropping {len(self.entries)} packets in the window.")
+                    self.failed += len(self.entries)
+                    self.stats.count_failed(len(self.entries))
+                    self.dropped += self.entries
+                    self.entries.clear()
+                    self.unsent = 0
+                    self.broken = True
+                    self.cond.notify_all()
+                    return []
+                # Go back N: send again all the frames in the window
+                logging.warn("Retrying packets {n} to {m}...".format(n=head.frame.seq_number, m=self.entries[-1].frame.seq_number))
+                self.stats.retries += len(self.entries)
+                self.unsent = 0
+                return list(self.entries)
+            if self.unsent:
+                entries = list(self.entries)[-self.unsent:]
+                self.unsent = 0
+                return entries
+            self.cond.wait(head.deadline - time())
+        self.dropped += self.entries
+        return None
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if not self.is_alive():
+            # The thread resolves the entries when it ends
+            with self.cond:
+                dropped, self.dropped = self.dropped + list(self.entries), []
+            resolve(dropped, False)
+
+    def send(self, command, payload, timeout=None, future=None):
+        """ Queue a packet to be sent as soon as there is room in the window.
+            The future is resolved when the packet is acknowledged or dropped.
+            Return False if the window stays full after the timeout. By default it waits until
+            the oldest frame is acknowledged or dropped, after its last retransmission.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.entries) < self.window_size or self.broken or not self.running, timeout):
+                logging.warn("Timeout exceeded. The window is full.")
+                self.stats.count_failed()
+                return False
+            if self.broken or not self.running:
+                self.stats.count_failed()
+                return False
+            entry = WindowEntry(PacketFrame(self.next_seq, command, payload, self.fcs), future)
+            self.next_seq = (self.next_seq + 1) % 256
+            self.entries.append(entry)
+            # The frame is written by the window thread
+            self.unsent += 1
+            self.cond.notify_all()
+        return True
+
+    def ack(self, seq_number, nack=False):
+        """ Process a cumulative ACK (or NACK) with the given sequence number """
+        with self.cond:
+            if not self.entries:
+                return
+            acked = (seq_number - self.entries[0].frame.seq_number) % 256
+            if acked > len(self.entries):
+                # Old ACK (duplicated or delayed). Ignore it.
+                return
+            entries = [self.entries.popleft() for i in range(acked)]
+            self.stats.tx_packets += acked
+            if nack and self.entries:
+                # Expire the timer of the rejected frame to send it again right away
+                self.stats.nacks += 1
+                self.entries[0].deadline = 0
+            self.cond.notify_all()
+        if entries and entries[-1].writes == 1 and entries[-1].write_time is not None:
+            # The ACK replies to the last acknowledged frame (and it was not being written)
+            self.rto.sample(time() - entries[-1].write_time, entries[-1].write_size)
+        resolve(entries, True)
+
+    def flush(self, timeout=None):
+        """ Wait until all the frames in the window are acknowledged.
+            Return False if any frame was dropped since the last flush or the timeout expires.
+        """
+        with self.cond:
+            done = self.cond.wait_for(lambda: not self.entries, timeout)
+            success = done and self.failed == 0
+            self.failed = 0
+        return success
+
+
+def count_tx(counters, data, frames):
+    """ Count in counters (LinkStats) the bytes of data written by a link, with the given number of frames.
+        Must be called by one thread at a time (the one that writes the port).
+    """
+    counters.tx_bytes += len(data)
+    counters.tx_frames += frames
+    # Escaped bytes never contain ESCAPE_FLAG, so each one in the frames is an escape byte
+    escape_bytes = data.count(ESCAPE_FLAG)
+    if escape_bytes:
+        counters.tx_escape_bytes += escape_bytes
+        frames -= sum(ESCAPE_FLAG in frame for frame in data.split(START_FLAG_BYTES))
+    counters.tx_fast_frames += frames
+
+
+def handle_frame(link, data):
+    """ Process the unescaped data (without flags) of a frame received by a link (ArduComm or AsyncArduComm).
+        The negotiation requests of the peer and the checksum of the packets are handled here, the same way
+        for both classes. The rest of ACKs are passed to link.ack_received(seq_number, ack_type, data), and
+        the accepted packets to link.packet_received(command, payload). The replies are written with
+        link.send_ack(seq_number, ack_type, data). The link also provides counters (LinkStats), fcs,
+        payload_views and the state of the Go-Back-N receiver (rx_window_size and expected_seq).
+    """
+    counters = link.counters
+    if len(data) < 2:
+        counters.rx_short_frames += 1
+        logging.warn(F"Packet frame too small. Frame data: {[i for i in data]}")
+        return
+
+    seq_number = data[0]
+    command = data[1]
+
+    if command == ACK_COMMAND:
+        counters.rx_acks += 1
+        ack_type = data[2] if len(data) > 2 else ACK_TYPE_PLAIN
+        if ack_type == ACK_TYPE_WINDOW_REQUEST:
+            # The peer wants to use windowed ARQ. The sequence number is the next frame to expect.
+            link.rx_window_size = min(data[3], MAX_WINDOW_SIZE) if len(data) > 3 else 0
+            link.expected_seq = seq_number
+            link.send_ack(seq_number, ACK_TYPE_WINDOW_REPLY, bytes([link.rx_window_size]))
+        elif ack_type == ACK_TYPE_FLOW_REQUEST:
+            # The input buffer of the host is large enough. Reply with size 0 (no limit).
+            link.send_ack(seq_number, ACK_TYPE_FLOW_REPLY, bytes(2))
+        elif ack_type == ACK_TYPE_CREDIT_REQUEST:
+            # Without a limit there are no credits to report (and the peer never requests them)
+            return
+        else:
+            link.ack_received(seq_number, ack_type, data)
+    elif link.rx_window_size and seq_number != link.expected_seq:
+        # Go-Back-N receiver: discard out of order frames and repeat the last ACK
+        counters.rx_out_of_order += 1
+        logging.info(F"Out of order packet {seq_number} (expected {link.expected_seq}). Discarding it.")
+        link.send_ack(link.expected_seq)
+    else:
+        # Check the checksum directly on the frame data (seq number, command and payload)
+        view = memoryview(data)
+        if len(data) < 4 or FCS_FUNCTIONS[link.fcs](view[:-2]) != (data[-2] << 8 | data[-1]):
+            counters.rx_checksum_errors += 1
+            logging.info("Packet checksum mismatch. Sending ACK for retransmission.")
+            if link.rx_window_size:
+                link.send_ack(seq_number, ACK_TYPE_NACK)
+            else:
+                # Reset the ack packet number to indicate retransmission
+                link.send_ack(seq_number)
+        else:
+            counters.rx_packets += 1
+            link.expected_seq = (seq_number + 1) % 256
+            link.send_ack(link.expected_seq)
+            # The payload is a slice of the frame: a view of it, or its only copy
+            link.packet_received(command, readonly(view[2:-2]) if link.payload_views else bytes(view[2:-2]))
 
 
 class ArduComm(Thread):
     """ Class to handle the serial object and implement the communication protocol """
     
-    def __init__(self, message_callback, port='/dev/ttyACM0', baudrate=BAUDRATE):
+    def __init__(self, message_callback=None, port='/dev/ttyACM0', baudrate=BAUDRATE, read_timeout=READ_TIMEOUT, window_size=1,
+                 callback_workers=1, callback_queue_size=QUEUE_SIZE, callback_overflow=BLOCK, fcs=FLETCHER16,
+                 flow_control=False, rtscts=False, dispatcher=None, max_retries=MAX_RETRIES, backoff=BACKOFF,
+                 capture=None, payload_views=False):
+        """ message_callback(command, payload) is called for every packet received.
+            It can be None if the packets are only processed by subscribers (see subscribe).
+
+            read_timeout sets the max time (seconds) that the receiving thread blocks
+            waiting for new bytes. The thread sleeps in the OS until data arrives, so an idle
+            link does not use any CPU. Use None to poll the port every PACKET_POLL_TIME instead.
+
+            window_size > 1 enables the windowed ARQ mode (Go-Back-N) if the peer supports it.
+            The mode is negotiated before sending the first packet. Otherwise Stop-and-Wait is used.
+
+            The message callback runs in a pool of callback_workers threads (see Dispatcher).
+            Packets with the same command are always processed in order. Each worker queues up to
+            callback_queue_size packets, and callback_overflow selects what happens when the
+            queue is full: 'block' (default), 'drop_oldest' or 'drop_newest'.
+
+            fcs selects the frame check sequence algorithm: FLETCHER16 (default) or CRC16.
+            Both ends must use the same algorithm (the Arduino library only uses FLETCHER16).
+
+            flow_control enables the credit-based flow control if the peer supports it. The peer
+            reports its buffer sizes and the bytes it reads, so the frames are written as fast
+            as the peer can read them. It is negotiated before sending the first packet.
+            Otherwise frames are written in blocks of ARDUINO_RX_BUFFER_SIZE bytes with a pause
+            of ARDUINO_READ_TIME between them, unless rtscts enables the hardware flow control.
+            The windowed mode writes many frames without waiting for their ACKs, so it always
+            enables the flow control (window_size > 1).
+
+            dispatcher runs the callbacks in the workers of another Dispatcher, shared with other
+            links (see ArduCommHub). The link does not start or stop it, and the callback_* options
+            are ignored.
+
+            The packets are sent by a transmission thread, in order of priority (see send_async).
+            It is the only thread that runs the ARQ of the packets, so any thread can send them.
+
+            A packet is sent up to max_retries times if the peer rejects it or its ACK does not
+            arrive. The retransmission timeout adapts to the round-trip time of the link
+            (see RTOEstimator), and it is multiplied by backoff after each timeout.
+
+            capture records all the bytes read and written, and the frames decoded from them, in a
+            binary capture file (see arducomm.capture). It can be the path of the file or a CaptureWriter.
+
+            payload_views passes the payloads to the callbacks and subscribers as read-only memoryviews
+            of the received frame instead of bytes, so they are never copied. Each frame has its own
+            buffer, so a view stays valid after the callback returns. Use bytes(payload) to get a copy.
+        """
+        if not 1 <= window_size <= MAX_WINDOW_SIZE:
+            raise ValueError(F"Window size must be between 1 and {MAX_WINDOW_SIZE}")
+        if fcs not in FCS_FUNCTIONS:
+            raise ValueError(F"Unknown FCS algorithm: '{fcs}'")
+        self.fcs = fcs
         self.sent_seq = 0
-        self.last_ack = None
-        self.retries = 0
+        # ACK frames received, indexed by sequence number.
+        # The condition is notified every time a new ACK arrives.
+        self.acks = {}
+        self.ack_cond = Condition()
+        self.max_retries = max_retries
+        # Windowed ARQ (sender side)
+        self.window_size = window_size
+        self.window = None
+        self.window_reply = None
+        self.window_failed = 0
+        # Set when the peer accepts the windowed mode. It stays in that mode until it is negotiated again.
+        self.window_accepted = False
+        # Set when the peer acknowledges a packet. Until then it might keep the modes of a previous host.
+        self.peer_synced = False
+        # Windowed ARQ (receiver side). A window size of 0 means Stop-and-Wait.
+        self.rx_window_size = 0
+        self.expected_seq = 0
+        # Flow control. A tx_chunk_size of None writes the frames without pauses.
+        self.flow_control = flow_control or window_size > 1
+        self.flow = None
+        self.flow_reply = None
+        self.tx_chunk_size = None if rtscts else ARDUINO_RX_BUFFER_SIZE
+        # Time when the next block of frames can be written without overflowing the peer buffer
+        self.tx_ready_time = 0.0
+        self.max_payload_size = 255
         self.serial_lock = Lock()
+        # ACKs waiting for the packet that is being written (see write_ack)
+        self.pending_acks = deque()
+        # Packets waiting to be sent by the transmission thread, which is started with the first one
+        self.tx_queue = TXQueue()
+        self.tx_thread = None
+        self.tx_thread_lock = Lock()
+        # Held while a packet is sent, by the transmission thread or by the thread that calls send
+        self.tx_lock = Lock()
         self.callback = message_callback
+        self.payload_views = payload_views
+        # Subscriber of each command (None if the command has no subscribers)
+        self.subscribers = [None] * 256
+        # The link only starts and stops its own dispatcher
+        self.own_dispatcher = dispatcher is None
+        self.dispatcher = dispatcher or Dispatcher(self.process_packet, callback_workers, callback_queue_size, callback_overflow)
+        # Counters of the link (see stats)
+        self.counters = LinkStats()
+        self.decoder = FrameDecoder(self.counters)
+        # The link only closes the captures that it opens
+        self.own_capture = isinstance(capture, str)
+        if self.own_capture:
+            from .capture import CaptureWriter
+            capture = CaptureWriter(capture)
+        self.capture = capture
 
         logging.info("Connecting to serial port...")
         try:
-            self.ser = serial.Serial(port=port, baudrate=baudrate)
+            self.read_timeout = read_timeout
+            self.ser = serial.Serial(port=port, baudrate=baudrate, timeout=read_timeout, rtscts=rtscts)
+            # Start, 8 data bits and stop bit of each byte
+            self.rto = RTOEstimator(10.0 / baudrate, backoff=backoff, histogram=self.counters.ack_rtt)
             # Wait for the arduino to init
             open_time = time()
             while not self.ser.isOpen():
@@ -199,89 +981,147 @@ class ArduComm(Thread):
             If the frame is an ack message, put it in the ACK buffer
             If it is another message, process it with the message callback
         """
-        in_buffer = bytearray()
+        if self.own_dispatcher:
+            self.dispatcher.start()
         while (self.running):
-            if self.ser.inWaiting() > 0:
-                try:
-                    b = self.ser.read(1)
-                except serial.serialutil.SerialException as se:
-                    # TODO
-                    logging.warn(F"Could not read the serial port! Exception: {str(se)}")
-                    continue
-                in_buffer += b
-                if in_buffer[0] != START_FLAG:
-                    # Broken frame. The buffer will never contain a full packet.
-                    logging.warn(F"Broken frame. Current buffer: {[i for i in in_buffer]}")
-                    # Drop bytes until a START_FLAG arrives
-                    in_buffer.clear()
-                elif b[0] == START_FLAG:
-                    # Get number of bytes between start flags to skip ghost frames (between end_flag and start_flag)
-                    if len(in_buffer) > 3:
-                        # Process frame
-                        frame_data = in_buffer[:]
-                        self.process_frame(frame_data)
-                        # Clear the current buffer
-                        in_buffer.clear()
-                    else:
-                        # We received a start flag but the buffer is too small to contain a full frame
-                        if len(in_buffer) > 1:
-                            logging.warn(F"Packet frame too small. Current buffer: {[i for i in in_buffer]}")
-                        in_buffer = bytearray(b)
-            else:
-                sleep(PACKET_POLL_TIME)
+            try:
+                if self.read_timeout is None:
+                    # Polling mode
+                    in_waiting = self.ser.in_waiting
+                    if in_waiting == 0:
+                        sleep(PACKET_POLL_TIME)
+                        continue
+                    chunk = self.ser.read(in_waiting)
+                else:
+                    # Blocking mode. Wait until at least one byte arrives (or the timeout expires)
+                    # and get the rest of the bytes that are already waiting in the buffer.
+                    chunk = self.ser.read(self.ser.in_waiting or 1)
+            except serial.serialutil.SerialException as se:
+                if not self.running:
+                    # The port was closed while waiting for data
+                    break
+                # TODO
+                logging.warn(F"Could not read the serial port! Exception: {str(se)}")
+                continue
+            self.receive(chunk)
 
-        """ Code to test raw data received (without frame formatting)
-        in_buffer = bytearray()
-        while (self.running):
-            if self.ser.inWaiting() > 0:
-                b = self.ser.read(1)
-                in_buffer += b
-                logging.debug("Buffer: {}".format(in_buffer))
-            sleep(PACKET_POLL_TIME)
-        """
+
+    def receive(self, chunk):
+        """ Process a chunk of bytes read from the serial port """
+        if not chunk:
+            # The read timeout expired without new bytes
+            return
+        frames = self.decoder.decode(chunk)
+        if self.capture is not None:
+            self.capture.rx(chunk, frames)
+        for frame_data in frames:
+            self.process_frame(frame_data)
 
 
     def process_frame(self, data):
-        """ Get the byte array, create its corresponding frame object and process it """
-        # Restore the escaped bytes
-        escaped_data = []
-        data_iter = data.__iter__()
-        for i in data_iter:
-            b = i if i != ESCAPE_FLAG else invert_bit_5(next(data_iter))
-            escaped_data.append(b)
-
-        seq_number = escaped_data[1]
-        command = escaped_data[2]
-
-        if command == ACK_COMMAND:
-            # Create ACKFrame and store it
-            self.last_ack = ACKFrame(seq_number)
-        else:
-            payload = bytes(escaped_data[3:-3])
-            packet = PacketFrame(seq_number, command, payload)
+        """ Process the unescaped frame data (without flags) in the receiving thread (see handle_frame) """
+        handle_frame(self, data)
 
-            # Check checksum
-            received_checksum = (escaped_data[-3], escaped_data[-2])
-            computed_checksum = packet.checksum()
-            retry = received_checksum[0] != computed_checksum[0] or received_checksum[1] != computed_checksum[1]
 
-            # Send ACK
-            if retry:
-                logging.info("Packet checksum mismatch. Sending ACK for retransmission.")
-                # Reset the ack packet number to indicate retransmission
-                self.send_frame(ACKFrame(seq_number))
+    def ack_received(self, seq_number, ack_type, data):
+        """ Process an ACK frame that is not a request of the peer (see handle_frame) """
+        if ack_type == ACK_TYPE_WINDOW_REPLY:
+            with self.ack_cond:
+                self.window_reply = (seq_number, data[3] if len(data) > 3 else 0)
+                self.ack_cond.notify_all()
+        elif ack_type == ACK_TYPE_CREDIT:
+            # Report of the flow control: bytes read and the FCS of the report
+            if self.flow is None:
+                return
+            if len(data) > 5 and FCS_FUNCTIONS[self.fcs](data[:4]) == (data[4] << 8 | data[5]):
+                self.flow.grant(seq_number, data[3])
             else:
-                self.send_frame(ACKFrame((seq_number + 1) % 256))
+                self.counters.credit_errors += 1
+                logging.info("Credit report checksum mismatch. Ignoring it.")
+        elif ack_type == ACK_TYPE_FLOW_REPLY:
+            with self.ack_cond:
+                self.flow_reply = (data[3], data[4]) if len(data) > 4 else (0, 0)
+                self.ack_cond.notify_all()
+        elif self.window is not None:
+            self.window.ack(seq_number, nack=(ack_type == ACK_TYPE_NACK))
+        else:
+            # Create ACKFrame, store it and wake up the sender waiting for it
+            with self.ack_cond:
+                self.acks[seq_number] = ACKFrame(seq_number, ack_type)
+                self.ack_cond.notify_all()
+
 
-                # Process the packet in a different thread to avoid blocking the main (receiving) thread
-                t = Thread(target=self.callback, args=((command, payload)))
-                t.daemon = True
-                t.start()
+    def packet_received(self, command, payload):
+        """ Process an accepted packet in a worker thread, to avoid blocking the receiving thread """
+        self.dispatcher.dispatch(command, payload, self.process_packet)
+
+
+    def process_packet(self, command, payload):
+        """ Pass a received packet to the subscribers of its command and to the message callback.
+            This runs in the dispatcher workers. An error in the subscribers does not skip the callback.
+        """
+        subscriber = self.subscribers[command]
+        if subscriber is not None:
+            try:
+                subscriber.callback(payload)
+            except Exception:
+                logging.exception(F"Exception in the subscribers of command {command}")
+        if self.callback is not None:
+            self.callback(command, payload)
+
+
+    def subscribe(self, command, dtype, handler):
+        """ Call handler(data) for every packet received with the given command.
+            The payload is parsed only once with the given dtype (a Serializable class or a basic
+            dtype, see serialization.parse), even if the command has multiple handlers.
+            Use dtype=None to pass the raw payload bytes.
+        """
+        if not 0 <= command <= 255 or command == ACK_COMMAND:
+            raise ValueError(F"Invalid command: {command}")
+        subscriber = self.subscribers[command]
+        if subscriber is None:
+            subscriber = Subscriber(dtype)
+        elif subscriber.dtype != dtype:
+            raise ValueError(F"Command {command} is already subscribed with dtype '{subscriber.dtype}'")
+        subscriber.add_handler(handler)
+        self.subscribers[command] = subscriber
+
+
+    def unsubscribe(self, command, handler=None):
+        """ Remove a handler of the given command, or all of them if handler is None """
+        subscriber = self.subscribers[command]
+        if subscriber is None:
+            return
+        if handler is not None:
+            subscriber.remove_handler(handler)
+        if handler is None or not subscriber.handlers:
+            self.subscribers[command] = None
 
 
     def stop(self):
-        # Stop the thread and close the serial port
+        # Stop the threads and close the serial port
         self.running = False
+        if self.own_dispatcher:
+            self.dispatcher.stop()
+        # Drop the packets that were not sent and wake up the transmission thread
+        for request in self.tx_queue.close():
+            request.finish(False)
+        with self.ack_cond:
+            self.ack_cond.notify_all()
+        with self.tx_thread_lock:
+            tx_thread = self.tx_thread
+        if tx_thread is not None and current_thread() is not tx_thread:
+            tx_thread.join(TIMEOUT)
+        if self.window is not None:
+            self.window.stop()
+        if self.is_alive() and current_thread() is not self:
+            # Wake up the receiving thread if it is blocked reading the port and wait for it
+            if hasattr(self.ser, 'cancel_read'):
+                self.ser.cancel_read()
+            self.join(self.read_timeout)
+
+        if self.own_capture:
+            self.capture.close()
 
         if self.ser.isOpen():
             logging.info("Closing serial port...")
@@ -292,67 +1132,366 @@ class ArduComm(Thread):
 
 
     def send_frame(self, frame):
-        """ Send a frame object to the serial port """
-        # Reset the last ACK
-        if frame.command != ACK_COMMAND:
-            self.last_ack = None
-
-        # Serialize the Packet data
-        data = frame.serialize()
-
-        # Use a mutex to avoid conflict between packet sends and ACK replies (different threads)
-        with self.serial_lock:
-            # Split data in 64 bytes blocks (Arduino buffer size)
-            while len(data) > 64:
-                self.ser.write(data[:64])
-                data = data[64:]
-                # Wait for the arduino to read the buffer, so it does not overflow
-                sleep(ARDUINO_READ_TIME)
-            # Write the rest of the data
-            self.ser.write(data)
-
+        """ Send a frame object to the serial port.
+            Packet frames are sent again until they are acknowledged (Stop-and-Wait),
+            up to max_retries times. Return True if the frame was acknowledged.
+        """
         # Do not wait for ACK after sending an ACK frame
         if frame.command == ACK_COMMAND:
+            self.write_ack(frame.serialize())
             return True
 
-        # Wait for the ACK
-        sent_time = time()
-        while not self.last_ack:
-            # Check for the timeout, so it does not stay here forever
-            if (time() - sent_time) >= TIMEOUT:
-                logging.warn("Timeout exceeded.")
-                logging.warn("Did not received the ACK for packet {n} with command {c}".format(n=frame.seq_number, c=frame.command))
-                return False
-            sleep(ACK_POLL_TIME)
-        # Check the ACK and retry if needed
-        if self.last_ack.seq_number == frame.seq_number:
-            # Retry
-            self.retries += 1
-            if self.retries >= MAX_RETRIES:
-                logging.warn('Could not send packet {n} with command {c}'.format(c=frame.command, n=frame.seq_number))
+        transmission = Transmission(frame, self.rto, self.max_retries, self.counters)
+        while True:
+            if not self.peer_synced:
+                self.reset_peer()
+            # Discard old ACKs that could be mistaken for the reply to this frame
+            with self.ack_cond:
+                self.acks.pop(frame.seq_number, None)
+                self.acks.pop((frame.seq_number + 1) % 256, None)
+            self.write(transmission.data)
+            transmission.written()
+
+            # Wait for the ACK
+            ack = self.wait_ack(frame.seq_number, transmission.timeout())
+            if ack != ACK_OK and not self.running:
                 return False
+            result = transmission.result(ack)
+            if result is not None:
+                self.peer_synced = self.peer_synced or result
+                return result
+
+
+    def write(self, data, frames=1):
+        """ Write the serialized data of the given number of frames to the serial port """
+        # Use a mutex to avoid conflict between packet sends and ACK replies (different threads)
+        with self.serial_lock:
+            count_tx(self.counters, data, frames)
+            if self.capture is not None:
+                self.capture.tx(data)
+            if self.flow is not None:
+                # Write as many bytes as the peer can store and wait for it to read them.
+                # The write is between frames if an even number of flags was written.
+                flags = 0
+                while data:
+                    size = self.flow.take(data, flags % 2 == 0)
+                    self.ser.write(data[:size])
+                    flags += data.count(START_FLAG, 0, size)
+                    data = data[size:]
+            elif self.tx_chunk_size is not None:
+                # Split data in blocks of the Arduino buffer size
+                while len(data) > self.tx_chunk_size:
+                    self.ser.write(data[:self.tx_chunk_size])
+                    data = data[self.tx_chunk_size:]
+                    # Wait for the arduino to read the buffer, so it does not overflow
+                    sleep(ARDUINO_READ_TIME)
+                self.ser.write(data)
             else:
-                logging.warn("Received ACK with retry code. Retrying packet {n}...".format(n=frame.seq_number))
-                return self.send_frame(frame)
+                self.ser.write(data)
+        # Write the ACKs that arrived while the port was busy
+        self.write_pending_acks()
+
+
+    def write_frames(self, frames):
+        """ Write a list of serialized frames, joined in as few writes as possible.
+            Without flow control, each write is limited to the size of the Arduino buffer, and
+            there is a pause of ARDUINO_READ_TIME after it (also before the frames of the next
+            call), so the peer reads each block before the next one arrives.
+        """
+        if self.flow is not None or self.tx_chunk_size is None:
+            self.write(b''.join(frames), len(frames))
+            return
+        batch = []
+        batch_size = 0
+        for data in frames:
+            if batch and batch_size + len(data) > self.tx_chunk_size:
+                self.write_block(batch)
+                batch = []
+                batch_size = 0
+            batch.append(data)
+            batch_size += len(data)
+        self.write_block(batch)
+
+
+    def write_block(self, frames):
+        """ Write a block of frames (see write_frames) after the pause of the previous block """
+        delay = self.tx_ready_time - time()
+        if delay > 0:
+            sleep(delay)
+        self.write(b''.join(frames), len(frames))
+        self.tx_ready_time = time() + ARDUINO_READ_TIME
+
+
+    def send_ack(self, seq_number, ack_type=ACK_TYPE_PLAIN, data=b''):
+        """ Send an ACK frame, encoded without creating an ACKFrame object (see send_frame) """
+        self.write_ack(get_encoder().encode_ack(seq_number, ack_type, data))
+
+
+    def write_ack(self, data):
+        """ Write the serialized ACK frame data without blocking.
+            The receiving thread must never wait for a packet that is being written, because
+            that packet might be waiting for the credits that the receiving thread processes.
+            If the port is busy, the ACK is written as soon as the current packet is complete.
+        """
+        self.pending_acks.append(data)
+        self.write_pending_acks()
+
+
+    def write_pending_acks(self):
+        """ Write the pending ACKs, unless another thread is writing (it will write them later) """
+        while self.pending_acks and self.serial_lock.acquire(blocking=False):
+            try:
+                # All the pending ACKs are written together
+                acks = [self.pending_acks.popleft() for i in range(len(self.pending_acks))]
+                data = b''.join(acks)
+                count_tx(self.counters, data, len(acks))
+                if self.capture is not None:
+                    self.capture.tx(data)
+                if self.flow is not None:
+                    self.flow.spend(len(data))
+                self.ser.write(data)
+            finally:
+                self.serial_lock.release()
+
+
+    def request_credits(self, seq_number):
+        """ Write a CREDIT_REQUEST frame and return its size. It is called by FlowControl while
+            a packet waits for credits, so the serial lock is already acquired.
+        """
+        data = get_encoder().encode_ack(seq_number, ACK_TYPE_CREDIT_REQUEST)
+        count_tx(self.counters, data, 1)
+        if self.capture is not None:
+            self.capture.tx(data)
+        self.ser.write(data)
+        return len(data)
+
+
+    def wait_ack(self, seq_number, timeout=TIMEOUT):
+        """ Block until the ACK for the frame with the given sequence number arrives.
+            Return ACK_OK if the frame was received, ACK_RETRY if it must be sent again,
+            or ACK_UNSET if the timeout expires.
+        """
+        next_seq = (seq_number + 1) % 256
+        with self.ack_cond:
+            if not self.ack_cond.wait_for(lambda: seq_number in self.acks or next_seq in self.acks or not self.running, timeout):
+                return ACK_UNSET
+            if not self.running:
+                return ACK_UNSET
+            # Both ACKs are removed so they are not mistaken for the reply to a later frame
+            self.acks.pop(seq_number, None)
+            ok = self.acks.pop(next_seq, None)
+        return ACK_OK if ok else ACK_RETRY
+
+
+    def send(self, command, payload=[], priority=0):
+        """ Send a packet given the command and the payload.
+            In Stop-and-Wait mode, block until the packet is acknowledged and return True,
+            or False if it could not be sent. In windowed ARQ mode, return True as soon as
+            the packet enters the window (see flush).
+            If no packets are queued, the packet is sent in the calling thread. Otherwise it is
+            queued, and the packets with higher priority are sent first (see send_async).
+        """
+        if len(self.tx_queue) or self.tx_queue.closed:
+            request = self.queue_packet(command, payload, priority)
         else:
-            # ACK OK
-            self.retries = 0
-            return True
+            # Nothing to wait for. Skip the handoff to the transmission thread.
+            request = TXRequest(command, payload)
+            self.transmit_request(request)
+        request.accepted.wait()
+        return request.result
+
+
+    def send_async(self, command, payload=[], priority=0):
+        """ Queue a packet and return without waiting.
+            Return a concurrent.futures.Future resolved with True when the packet is acknowledged,
+            or False if it could not be sent (timeout, max. number of retries, or the link was stopped).
+            The queued packets with higher priority are sent first, and the packets with the same
+            priority in order. The callbacks of the future run in the transmission or receiving thread,
+            so they must not block.
+        """
+        return self.queue_packet(command, payload, priority).future
+
+
+    def queue_packet(self, command, payload, priority):
+        """ Add a packet to the transmission queue and return its TXRequest """
+        request = TXRequest(command, payload)
+        if not self.tx_queue.put(request, priority):
+            logging.error("The link is stopped. Frame cannot be sent")
+            request.finish(False)
+        elif self.tx_thread is None:
+            self.start_transmission()
+        return request
+
+
+    def start_transmission(self):
+        """ Start the transmission thread, which sends the queued packets """
+        with self.tx_thread_lock:
+            if self.tx_thread is None and self.running:
+                self.tx_thread = Thread(target=self.transmit_loop)
+                self.tx_thread.daemon = True
+                self.tx_thread.start()
+
+
+    def transmit_loop(self):
+        """ Send the queued packets, one after another """
+        while True:
+            request = self.tx_queue.get()
+            if request is None:
+                return
+            self.transmit_request(request)
+
 
+    def transmit_request(self, request):
+        """ Send a packet and resolve its request, one sender at a time """
+        with self.tx_lock:
+            try:
+                self.transmit(request)
+            except Exception:
+                if self.running:
+                    logging.exception(F"Could not send packet with command {request.command}")
+                request.finish(False)
 
-    def send(self, command, payload=[]):
-        """ Send a packet given the command and the payload """
+
+    def transmit(self, request):
+        """ Send a packet and resolve its request. Must be called with tx_lock acquired. """
+        command, payload = request.command, request.payload
         if command > 255:
             logging.error("Command number > 255. Frame cannot be sent")
-            return False
-        if len(payload) > 255:
+            request.finish(False)
+            return
+        if self.flow_control:
+            self.setup_flow_control()
+        if len(payload) > self.max_payload_size:
             logging.error("Payload length exceded. Frame cannot be sent")
-            return False
+            self.counters.count_failed()
+            request.finish(False)
+            return
+
+        if self.window is not None and self.window.broken:
+            # A frame was dropped and the peer is still waiting for it. Negotiate the window again.
+            self.window.stop()
+            self.sent_seq = (self.window.next_seq - 1) % 256
+            # Keep the number of dropped frames, so the next flush reports them
+            self.window_failed += self.window.failed
+            self.window = None
+        if self.window is None and self.window_size > 1:
+            if not self.setup_window() and self.window_size > 1:
+                # The peer is still in windowed mode. Stop-and-Wait frames would be discarded.
+                self.counters.count_failed()
+                request.finish(False)
+                return
+        if self.window is not None:
+            logging.debug(F"Sending packet {self.window.next_seq} with command {command}")
+            if self.window.send(command, payload, future=request.future):
+                request.accept(True)
+            else:
+                request.finish(False)
+            return
 
         self.sent_seq = (self.sent_seq + 1) % 256
 
         # Create the Packet frame
-        frame = PacketFrame(self.sent_seq, command, payload)
+        frame = PacketFrame(self.sent_seq, command, payload, self.fcs)
         logging.debug(F"Sending packet {self.sent_seq} with command {command}")
 
-        return self.send_frame(frame)
+        request.finish(self.send_frame(frame))
+
+
+    def reset_peer(self):
+        """ Disable the windowed mode and the flow control (if it is not used) in the peer, which keeps
+            them after a previous host disconnects. The requests are written before each transmission of
+            the Stop-and-Wait packets without waiting for their replies, until a packet is acknowledged.
+        """
+        self.send_frame(ACKFrame(self.sent_seq, ACK_TYPE_WINDOW_REQUEST, [0]))
+        if self.flow is None:
+            self.send_frame(ACKFrame(0, ACK_TYPE_FLOW_REQUEST, [0]))
+
+
+    def setup_flow_control(self):
+        """ Ask the peer for its buffer sizes and enable the credit-based flow control.
+            Keep the fixed pauses between blocks if the peer does not support it.
+            Return True if the flow control is enabled.
+        """
+        # Negotiated only once
+        self.flow_control = False
+        with self.ack_cond:
+            self.flow_reply = None
+        self.send_frame(ACKFrame(0, ACK_TYPE_FLOW_REQUEST))
+        with self.ack_cond:
+            self.ack_cond.wait_for(lambda: self.flow_reply is not None, TIMEOUT)
+            reply = self.flow_reply
+        if reply is None:
+            logging.warn("The peer does not support flow control. Using fixed pauses.")
+            return False
+        rx_buffer_size, frame_buffer_size = reply
+        if frame_buffer_size:
+            # The peer stores the frame with its flags, but without the escape flags
+            self.max_payload_size = min(255, max(0, frame_buffer_size - FRAME_OVERHEAD))
+        if rx_buffer_size:
+            # Wait for the reports at least the time to transmit a full buffer
+            request_time = CREDIT_REQUEST_TIME + rx_buffer_size * self.rto.byte_time
+            self.flow = FlowControl(rx_buffer_size, stats=self.counters, request=self.request_credits, request_time=request_time)
+            logging.info(F"Flow control enabled with a {rx_buffer_size} bytes buffer")
+        else:
+            # The peer does not have a limit
+            self.tx_chunk_size = None
+        return True
+
+
+    def setup_window(self):
+        """ Negotiate the windowed ARQ mode with the peer.
+            Fall back to Stop-and-Wait if the peer does not support it.
+            If the peer accepted the mode before, it is negotiated again in the next send.
+            Return True if the windowed mode is enabled.
+        """
+        next_seq = (self.sent_seq + 1) % 256
+        with self.ack_cond:
+            self.window_reply = None
+        self.send_frame(ACKFrame(next_seq, ACK_TYPE_WINDOW_REQUEST, [self.window_size]))
+        with self.ack_cond:
+            self.ack_cond.wait_for(lambda: self.window_reply is not None, TIMEOUT)
+            reply = self.window_reply
+        if reply is None and self.window_accepted:
+            # The request or the reply was lost. Try again with the next packet.
+            logging.warn("Could not negotiate the windowed ARQ mode again.")
+            return False
+        if reply is None or reply[0] != next_seq or reply[1] <= 1:
+            logging.warn("The peer does not support windowed ARQ. Using Stop-and-Wait.")
+            self.window_size = 1
+            return False
+        self.window_size = min(self.window_size, reply[1])
+        self.window_accepted = True
+        self.peer_synced = True
+        logging.info(F"Windowed ARQ enabled with window size {self.window_size}")
+        self.window = SlidingWindow(self.write_frames, self.window_size, next_seq, self.rto, self.max_retries, self.fcs, self.counters)
+        self.window.start()
+        return True
+
+
+    def flush(self, timeout=None):
+        """ Wait until all the packets sent in windowed ARQ mode are acknowledged.
+            Return False if any of them could not be sent or the timeout expires.
+            In Stop-and-Wait mode every send already waits for its ACK, so this returns True.
+        """
+        success = self.window is None or self.window.flush(timeout)
+        success = success and self.window_failed == 0
+        self.window_failed = 0
+        return success
+
+
+    def stats(self):
+        """ Return a dict with a snapshot of the statistics of the link: the counters and the
+            histogram of the ACK round-trip times (see arducomm.stats.LinkStats), the current
+            retransmission timeout, the packets waiting to be sent or acknowledged, and the
+            state of the callback queue (shared by all the links of an ArduCommHub).
+            The histograms include the count, sum, max and p50/p90/p99 of the times (seconds).
+        """
+        snapshot = self.counters.snapshot()
+        window = self.window
+        snapshot['rto'] = self.rto.rto
+        snapshot['tx_queue'] = len(self.tx_queue)
+        snapshot['window'] = len(window.entries) if window is not None else 0
+        snapshot['callback_queue'] = self.dispatcher.queue_depth()
+        snapshot['callback_dropped'] = self.dispatcher.dropped()
+        snapshot['callback_latency'] = self.dispatcher.latency().snapshot()
+        return snapshot
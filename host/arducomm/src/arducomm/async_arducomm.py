@@ -0,0 +1,256 @@
+""" asyncio version of the ArduComm link.
+
+    The serial port is registered in the event loop (loop.add_reader), so many links
+    can run in a single thread without polling. Only available on POSIX systems.
+"""
+
+import asyncio
+import logging
+import serial
+from .arducomm import (FrameDecoder, PacketFrame, RTOEstimator, Transmission, BAUDRATE, MAX_RETRIES, BACKOFF,
+                       ARDUINO_RX_BUFFER_SIZE, ARDUINO_READ_TIME, ACK_OK, ACK_RETRY, ACK_UNSET,
+                       ACK_TYPE_PLAIN, ACK_TYPE_NACK, ACK_TYPE_WINDOW_REQUEST, ACK_TYPE_FLOW_REQUEST,
+                       count_tx, get_encoder, handle_frame)
+from .checksum import FLETCHER16, FCS_FUNCTIONS
+from .dispatcher import QUEUE_SIZE, BLOCK, DROP_OLDEST, DROP_NEWEST, OVERFLOW_POLICIES
+from .stats import LinkStats
+
+
+class AsyncArduComm(object):
+    """ Class to handle the serial object and implement the communication protocol with asyncio.
+
+        Packets are sent with Stop-and-Wait (await send(...)) and the received packets
+        are obtained iterating over the object (async for command, payload in comm).
+        The frames are processed with the same code as ArduComm (see handle_frame and Transmission),
+        so the peer can also send its packets in windowed ARQ mode.
+
+        fcs selects the frame check sequence algorithm, and max_retries and backoff the
+        retransmissions of the packets, the same as in ArduComm.
+
+        Up to queue_size received packets wait for the consumer, and overflow selects what happens
+        when the queue is full (see Dispatcher): 'block' (default) stops reading the serial port until
+        the consumer takes a packet, 'drop_oldest' and 'drop_newest' drop a packet.
+    """
+
+    def __init__(self, port='/dev/ttyACM0', baudrate=BAUDRATE, fcs=FLETCHER16, max_retries=MAX_RETRIES, backoff=BACKOFF,
+                 queue_size=QUEUE_SIZE, overflow=BLOCK):
+        if fcs not in FCS_FUNCTIONS:
+            raise ValueError(F"Unknown FCS algorithm: '{fcs}'")
+        if max_retries < 1:
+            raise ValueError("The max. number of retries must be at least 1")
+        if queue_size < 1:
+            raise ValueError("The queue size must be at least 1")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(F"Unknown overflow policy: '{overflow}'")
+        self.fcs = fcs
+        self.port = port
+        self.baudrate = baudrate
+        self.max_retries = max_retries
+        self.ser = None
+        self.loop = None
+        self.counters = LinkStats()
+        self.decoder = FrameDecoder(self.counters)
+        # Start, 8 data bits and stop bit of each byte
+        self.rto = RTOEstimator(10.0 / baudrate, backoff=backoff, histogram=self.counters.ack_rtt)
+        self.sent_seq = 0
+        # Set when the peer acknowledges a packet. Until then it might keep the modes of a previous host.
+        self.peer_synced = False
+        # Future of each packet waiting for its ACK, indexed by sequence number
+        self.ack_futures = {}
+        # Go-Back-N receiver, enabled if the peer requests the windowed mode (see handle_frame)
+        self.rx_window_size = 0
+        self.expected_seq = 0
+        # The payloads are always copied, the consumer may keep them for any time
+        self.payload_views = False
+        # The lock and the queue are created in open(), inside the running event loop
+        self.send_lock = None
+        # Received packets (command, payload). None marks the end of the stream.
+        self.packets = None
+        self.queue_size = queue_size
+        self.overflow = overflow
+        # Number of packets dropped because the queue was full
+        self.dropped = 0
+        # False while the reader is removed from the event loop (closed, or waiting for the consumer)
+        self.reading = False
+        # ACKs are not written in the middle of a packet frame
+        self.tx_busy = False
+        self.pending_acks = []
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        packet = await self.packets.get()
+        if packet is None:
+            raise StopAsyncIteration
+        if not self.reading and self.packets.qsize() < self.queue_size and self.is_open():
+            # There is room again. Read the frames that arrived while the queue was full.
+            self.loop.add_reader(self.ser.fileno(), self.read)
+            self.reading = True
+        return packet
+
+    async def open(self):
+        """ Open the serial port and start receiving frames """
+        self.loop = asyncio.get_running_loop()
+        self.send_lock = asyncio.Lock()
+        # The size is limited in packet_received, so the end of the stream can always be queued
+        self.packets = asyncio.Queue()
+        logging.info("Connecting to serial port...")
+        # Non blocking reads. The event loop tells us when there are bytes available.
+        self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=0)
+        self.loop.add_reader(self.ser.fileno(), self.read)
+        self.reading = True
+        logging.info("Connected!")
+
+    def is_open(self):
+        return self.ser is not None and self.ser.isOpen()
+
+    def close(self):
+        """ Stop receiving frames and close the serial port.
+            The packets waiting for their ACK are not sent (send returns False).
+        """
+        if not self.is_open():
+            logging.info("Serial port is already closed.")
+            return
+        if self.reading:
+            self.loop.remove_reader(self.ser.fileno())
+            self.reading = False
+        logging.info("Closing serial port...")
+        self.ser.close()
+        logging.info("Serial port closed.")
+        for future in self.ack_futures.values():
+            future.cancel()
+        self.ack_futures.clear()
+        self.packets.put_nowait(None)
+
+    def read(self):
+        """ Read the available bytes and process the complete frames """
+        try:
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+        except serial.serialutil.SerialException as se:
+            logging.warn(F"Could not read the serial port! Exception: {str(se)}")
+            return
+        for frame_data in self.decoder.decode(chunk):
+            handle_frame(self, frame_data)
+
+    def ack_received(self, seq_number, ack_type, data):
+        """ Resolve the future of the packet acknowledged by an ACK frame (see handle_frame) """
+        if ack_type not in (ACK_TYPE_PLAIN, ACK_TYPE_NACK):
+            # Replies and credits of the modes negotiated by ArduComm, which are not used here
+            return
+        # An ACK with the same sequence number requests a retransmission
+        future = self.ack_futures.pop(seq_number, None)
+        result = ACK_RETRY
+        if future is None and ack_type == ACK_TYPE_PLAIN:
+            future = self.ack_futures.pop((seq_number - 1) % 256, None)
+            result = ACK_OK
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def packet_received(self, command, payload):
+        """ Queue an accepted packet for the consumer, applying the overflow policy """
+        packets = self.packets
+        if packets.qsize() >= self.queue_size:
+            if self.overflow == DROP_OLDEST:
+                packets.get_nowait()
+                self.dropped += 1
+                logging.warn("Packet queue full. Dropped the oldest packet.")
+            elif self.overflow == DROP_NEWEST:
+                self.dropped += 1
+                logging.warn(F"Packet queue full. Dropped packet with command {command}.")
+                return
+        packets.put_nowait((command, payload))
+        if self.overflow == BLOCK and packets.qsize() >= self.queue_size and self.reading:
+            # Stop reading until the consumer takes a packet (the rest of the current chunk is still queued)
+            self.loop.remove_reader(self.ser.fileno())
+            self.reading = False
+
+    def send_ack(self, seq_number, ack_type=ACK_TYPE_PLAIN, data=b''):
+        """ Write an ACK frame, or keep it until the packet being written is complete """
+        ack_data = get_encoder().encode_ack(seq_number, ack_type, data)
+        if self.tx_busy:
+            self.pending_acks.append(ack_data)
+        else:
+            self.write_serial(ack_data)
+
+    def write_serial(self, data):
+        count_tx(self.counters, data, 1)
+        self.ser.write(data)
+
+    async def write(self, data):
+        """ Write the serialized frame data to the serial port """
+        self.tx_busy = True
+        try:
+            count_tx(self.counters, data, 1)
+            # Split data in blocks of the Arduino buffer size
+            while len(data) > ARDUINO_RX_BUFFER_SIZE:
+                self.ser.write(data[:ARDUINO_RX_BUFFER_SIZE])
+                data = data[ARDUINO_RX_BUFFER_SIZE:]
+                # Wait for the arduino to read the buffer, so it does not overflow
+                await asyncio.sleep(ARDUINO_READ_TIME)
+            # Write the rest of the data
+            self.ser.write(data)
+        finally:
+            self.tx_busy = False
+            if self.is_open():
+                for ack_data in self.pending_acks:
+                    self.write_serial(ack_data)
+            self.pending_acks.clear()
+
+    async def send(self, command, payload=[]):
+        """ Send a packet given the command and the payload.
+            The packet is sent again if the peer rejects it or its ACK does not arrive before the
+            retransmission timeout, up to max_retries times (see Transmission).
+            Return True when the packet is acknowledged, or False if it could not be sent.
+        """
+        if command > 255:
+            logging.error("Command number > 255. Frame cannot be sent")
+            return False
+        if len(payload) > 255:
+            logging.error("Payload length exceded. Frame cannot be sent")
+            return False
+
+        async with self.send_lock:
+            self.sent_seq = (self.sent_seq + 1) % 256
+            frame = PacketFrame(self.sent_seq, command, payload, self.fcs)
+            logging.debug(F"Sending packet {self.sent_seq} with command {command}")
+            transmission = Transmission(frame, self.rto, self.max_retries, self.counters)
+
+            while True:
+                if not self.is_open():
+                    logging.error("The link is closed. Frame cannot be sent")
+                    return False
+                future = self.loop.create_future()
+                self.ack_futures[frame.seq_number] = future
+                try:
+                    if not self.peer_synced:
+                        # Disable the windowed mode and the flow control of the peer (see ArduComm.reset_peer)
+                        self.write_serial(get_encoder().encode_ack(self.sent_seq, ACK_TYPE_WINDOW_REQUEST, bytes(1)))
+                        self.write_serial(get_encoder().encode_ack(0, ACK_TYPE_FLOW_REQUEST, bytes(1)))
+                    await self.write(transmission.data)
+                    transmission.written()
+                    ack = await asyncio.wait_for(future, transmission.timeout())
+                except asyncio.TimeoutError:
+                    ack = ACK_UNSET
+                except asyncio.CancelledError:
+                    if self.is_open():
+                        # The task that awaits send was cancelled
+                        raise
+                    # close() cancelled the future
+                    return False
+                except serial.serialutil.SerialException as se:
+                    logging.error(F"Could not write the serial port! Exception: {str(se)}")
+                    return False
+                finally:
+                    self.ack_futures.pop(frame.seq_number, None)
+                result = transmission.result(ack)
+                if result is not None:
+                    self.peer_synced = self.peer_synced or result
+                    return result
@@ -0,0 +1,396 @@
+""" Binary capture of the raw traffic of a link, and indexed playback.
+
+    A capture file stores the chunks of bytes read from and written to the serial port, exactly as
+    they were transmitted, and the frames decoded from them (unescaped, without the flags), each one
+    with its timestamp. A companion index file (path + '.idx') stores the time, offset, kind and
+    command of every record, so a time window or a command can be found without reading the whole
+    capture. Both files are memory-mapped when they are read.
+
+    Capture file: header (magic, version) followed by the records:
+
+        | Kind (uint8) | Timestamp (float64) | Length (uint32) | Data |
+
+    Index file: header (magic, version) followed by one entry per record:
+
+        | Timestamp (float64) | Offset (uint64) | Kind (uint8) | Command (uint8) |
+
+    All the values are little endian. The timestamps (time.time) never go backwards within a file,
+    so the index is sorted by time.
+
+        comm = ArduComm(callback, port='/dev/ttyUSB0', capture='field_test.cap')
+        ...
+        with CaptureReader('field_test.cap') as capture:
+            for record in capture.frames(RX, start=t0, end=t0 + 10, commands=[0x05]):
+                print(record.timestamp, record.data)
+        replay('field_test.cap', callback, speed=None)  # Decode the RX stream again, unthrottled
+"""
+
+import os
+import mmap
+import struct
+import logging
+from bisect import bisect_left
+from collections import namedtuple
+from threading import Lock
+from time import time, sleep
+from .arducomm import FrameDecoder, ACK_COMMAND
+from .checksum import FLETCHER16, FCS_FUNCTIONS
+
+# Kinds of records: chunks read (RX) and written (TX), and the frames decoded from them
+RX = 0
+TX = 1
+FRAME = 2
+RX_FRAME = RX | FRAME
+TX_FRAME = TX | FRAME
+
+CAPTURE_MAGIC = b'ACAP'
+INDEX_MAGIC = b'ACIX'
+VERSION = 1
+INDEX_SUFFIX = '.idx'
+# Max time (seconds) that the captured records stay in the write buffers
+FLUSH_INTERVAL = 1.0
+
+HEADER = struct.Struct('<4sB')
+RECORD = struct.Struct('<BdI')
+INDEX_ENTRY = struct.Struct('<dQBB')
+
+# Record read from a capture. data is a bytes object.
+Record = namedtuple('Record', ['kind', 'timestamp', 'data'])
+
+
+def _prepare_append(path):
+    """ Prepare an existing capture to be extended. The index is built again if it is missing or
+        not complete, and a truncated record at the end (e.g. if the program crashed while writing
+        it) is removed from both files, so the new records are appended after the last complete one.
+        Return the timestamp of the last record (0.0 if the capture is new).
+    """
+    index_path = path + INDEX_SUFFIX
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        # New capture: an index left by a previous capture with the same name is not valid
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        return 0.0
+    with CaptureReader(path) as reader:
+        count = len(reader)
+        end = reader.record_end(count - 1) if count else HEADER.size
+        last_time = reader.end_time or 0.0
+    if end < os.path.getsize(path):
+        logging.warning(F"Removing a truncated record at the end of {path}")
+        os.truncate(path, end)
+    os.truncate(index_path, HEADER.size + count * INDEX_ENTRY.size)
+    return last_time
+
+
+def _open_append(path, magic):
+    """ Open a file to append records, writing its header if it is new """
+    f = open(path, 'ab')
+    if f.tell() == 0:
+        f.write(HEADER.pack(magic, VERSION))
+    else:
+        with open(path, 'rb') as existing:
+            _check_header(existing.read(HEADER.size), magic, path)
+    return f
+
+
+def _check_header(data, magic, path):
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != magic:
+        raise ValueError(F"{path} is not an ArduComm capture file")
+    version = HEADER.unpack_from(data)[1]
+    if version != VERSION:
+        raise ValueError(F"Unsupported capture version {version} in {path}")
+
+
+def _index_entry(kind, timestamp, offset, data):
+    # Frames are indexed by command. Chunks may contain several frames, so they do not have one.
+    command = data[1] if kind & FRAME and len(data) > 1 else 0
+    return INDEX_ENTRY.pack(timestamp, offset, kind, command)
+
+
+class CaptureWriter(object):
+    """ Append the traffic of a link to a capture file and its index.
+        The link calls rx() with every chunk read and the frames decoded from it, and tx() with
+        every chunk written. It is thread safe: both directions can be captured from different threads.
+        Existing captures are extended after their last complete record (see _prepare_append).
+        The files are flushed every flush_interval seconds while the traffic is captured, so the
+        records can be read during the capture and a crash only loses the last ones.
+    """
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        last_time = _prepare_append(path)
+        self.file = _open_append(path, CAPTURE_MAGIC)
+        self.index = _open_append(path + INDEX_SUFFIX, INDEX_MAGIC)
+        self.offset = self.file.tell()
+        # The frames written are decoded here, because the link only writes them already escaped
+        self.tx_decoder = FrameDecoder()
+        self.last_time = last_time
+        self.flush_time = time() + flush_interval
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def rx(self, chunk, frames=()):
+        """ Capture a chunk read from the serial port and the frames decoded from it """
+        with self.lock:
+            if self.file.closed:
+                # The link is stopping
+                return
+            timestamp = self.timestamp()
+            self.append(RX, timestamp, chunk)
+            for data in frames:
+                self.append(RX_FRAME, timestamp, data)
+            self.flush_due(timestamp)
+
+    def tx(self, chunk):
+        """ Capture a chunk written to the serial port (complete frames) """
+        with self.lock:
+            if self.file.closed:
+                return
+            timestamp = self.timestamp()
+            self.append(TX, timestamp, chunk)
+            for data in self.tx_decoder.decode(chunk):
+                self.append(TX_FRAME, timestamp, data)
+            self.flush_due(timestamp)
+
+    def timestamp(self):
+        # The index is sorted by time, so the timestamps can not go backwards (clock adjustments)
+        self.last_time = max(time(), self.last_time)
+        return self.last_time
+
+    def write_record(self, record):
+        """ Append a record read from another capture (e.g. to extract a part of it) """
+        with self.lock:
+            self.last_time = max(record.timestamp, self.last_time)
+            self.append(record.kind, self.last_time, record.data)
+
+    def append(self, kind, timestamp, data):
+        """ Append a record. Must be called with the lock acquired. """
+        self.file.write(RECORD.pack(kind, timestamp, len(data)))
+        self.file.write(data)
+        self.index.write(_index_entry(kind, timestamp, self.offset, data))
+        self.offset += RECORD.size + len(data)
+
+    def flush_due(self, timestamp):
+        """ Flush the files if the interval expired. Must be called with the lock acquired. """
+        if timestamp >= self.flush_time:
+            # The records first, so the index never points past the end of the capture
+            self.file.flush()
+            self.index.flush()
+            self.flush_time = timestamp + self.flush_interval
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.index.close()
+
+
+def build_index(path):
+    """ Scan a capture file and write its index again (e.g. if the program crashed before
+        writing the index). A truncated record at the end of the capture is ignored.
+        The new index replaces the old one when it is complete, so the readers that have the old
+        one open are not affected. Return the number of records.
+    """
+    count = 0
+    index_path = path + INDEX_SUFFIX
+    with open(path, 'rb') as f:
+        _check_header(f.read(HEADER.size), CAPTURE_MAGIC, path)
+        size = os.fstat(f.fileno()).st_size
+        with open(index_path + '.tmp', 'wb') as index:
+            index.write(HEADER.pack(INDEX_MAGIC, VERSION))
+            if size > HEADER.size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    offset = HEADER.size
+                    while offset + RECORD.size <= size:
+                        kind, timestamp, length = RECORD.unpack_from(data, offset)
+                        end = offset + RECORD.size + length
+                        if end > size:
+                            break
+                        # Only the sequence number and the command are needed to index the frames
+                        head = data[offset + RECORD.size:min(end, offset + RECORD.size + 2)]
+                        index.write(_index_entry(kind, timestamp, offset, head))
+                        offset = end
+                        count += 1
+    os.replace(index_path + '.tmp', index_path)
+    return count
+
+
+class _Timestamps(object):
+    """ Sequence view of the timestamps in the index, to search them with bisect """
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, i):
+        return INDEX_ENTRY.unpack_from(self.reader.index, HEADER.size + i * INDEX_ENTRY.size)[0]
+
+
+class CaptureReader(object):
+    """ Read the records of a capture file through its index. Both files are memory-mapped, so
+        only the pages of the records that are read are loaded. The index is built if it does
+        not exist, or if it is stale (there are complete records after the last indexed one).
+        Records written after the reader was opened are not seen.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path + INDEX_SUFFIX):
+            logging.info(F"Building the index of {path}...")
+            build_index(path)
+        self.open()
+        if self.unindexed():
+            logging.info(F"The index of {path} is not complete. Building it again...")
+            self.close()
+            build_index(path)
+            self.open()
+
+    def open(self):
+        path = self.path
+        self.file = open(path, 'rb')
+        self.index_file = open(path + INDEX_SUFFIX, 'rb')
+        _check_header(self.file.read(HEADER.size), CAPTURE_MAGIC, path)
+        _check_header(self.index_file.read(HEADER.size), INDEX_MAGIC, path + INDEX_SUFFIX)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = (len(self.index) - HEADER.size) // INDEX_ENTRY.size
+        # Ignore the entries of records that are not complete in the capture file (still being written)
+        while self.count and self.record_end(self.count - 1) > self.size:
+            self.count -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+        self.file.close()
+        self.index_file.close()
+
+    def unindexed(self):
+        """ Return True if there is a complete record after the last indexed one """
+        end = self.record_end(self.count - 1) if self.count else HEADER.size
+        if end + RECORD.size > self.size:
+            return False
+        return end + RECORD.size + RECORD.unpack_from(self.data, end)[2] <= self.size
+
+    def entry(self, i):
+        """ Return the index entry of the i-th record: (timestamp, offset, kind, command) """
+        return INDEX_ENTRY.unpack_from(self.index, HEADER.size + i * INDEX_ENTRY.size)
+
+    def record_end(self, i):
+        offset = self.entry(i)[1]
+        if offset + RECORD.size > self.size:
+            return offset + RECORD.size
+        return offset + RECORD.size + RECORD.unpack_from(self.data, offset)[2]
+
+    def record(self, i):
+        """ Return the i-th record """
+        offset = self.entry(i)[1]
+        kind, timestamp, length = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        return Record(kind, timestamp, self.data[start:start + length])
+
+    def find(self, timestamp):
+        """ Return the position of the first record at or after the timestamp """
+        return bisect_left(_Timestamps(self), timestamp)
+
+    @property
+    def start_time(self):
+        return self.entry(0)[0] if self.count else None
+
+    @property
+    def end_time(self):
+        return self.entry(self.count - 1)[0] if self.count else None
+
+    def span(self, start=None, end=None):
+        """ Return the positions (first, last) of the records between the start and end timestamps
+            (end excluded), to iterate over them with scan
+        """
+        first = self.find(start) if start is not None else 0
+        last = self.find(end) if end is not None else self.count
+        return first, max(first, last)
+
+    def scan(self, first, last, kinds=None, commands=None):
+        """ Iterate over the records from position first to last (excluded).
+            kinds and commands filter the records by kind (RX, TX, RX_FRAME, TX_FRAME) and by
+            command (only frames have one). The filters only read the index.
+        """
+        for i in range(first, last):
+            timestamp, offset, kind, command = self.entry(i)
+            if kinds is not None and kind not in kinds:
+                continue
+            if commands is not None and (not kind & FRAME or command not in commands):
+                continue
+            yield self.record(i)
+
+    def records(self, start=None, end=None, kinds=None, commands=None):
+        """ Iterate over the records between the start and end timestamps (end excluded),
+            filtered by kind and command (see scan)
+        """
+        first, last = self.span(start, end)
+        return self.scan(first, last, kinds, commands)
+
+    def chunks(self, direction=RX, start=None, end=None):
+        """ Iterate over the chunks read (RX) or written (TX) between the start and end timestamps """
+        return self.records(start, end, kinds=(direction,))
+
+    def frames(self, direction=None, start=None, end=None, commands=None):
+        """ Iterate over the frames received (RX), sent (TX) or both (None), optionally only the
+            ones with the given commands
+        """
+        kinds = (RX_FRAME, TX_FRAME) if direction is None else (direction | FRAME,)
+        return self.records(start, end, kinds, commands)
+
+
+def replay(capture, callback, direction=RX, speed=1.0, start=None, end=None, fcs=FLETCHER16):
+    """ Feed the chunks of a capture (a path or a CaptureReader) through a FrameDecoder, and call
+        callback(command, payload) for every packet with a valid FCS, like the message callback of
+        ArduComm. ACKs are skipped. direction selects the stream: received (RX) or sent (TX).
+        speed=1.0 replays the chunks at the pace they were captured, 2.0 twice as fast, and None
+        as fast as possible. start and end select a time window.
+        Return the LinkStats of the decoder (see arducomm.stats).
+    """
+    reader = capture if isinstance(capture, CaptureReader) else CaptureReader(capture)
+    decoder = FrameDecoder()
+    stats = decoder.stats
+    fcs_function = FCS_FUNCTIONS[fcs]
+    first = None
+    try:
+        for record in reader.chunks(direction, start, end):
+            if speed is not None:
+                if first is None:
+                    first = (record.timestamp, time())
+                else:
+                    delay = first[1] + (record.timestamp - first[0]) / speed - time()
+                    if delay > 0:
+                        sleep(delay)
+            for data in decoder.decode(record.data):
+                if len(data) < 2:
+                    stats.rx_short_frames += 1
+                elif data[1] == ACK_COMMAND:
+                    stats.rx_acks += 1
+                elif len(data) >= 4 and fcs_function(data[:-2]) == (data[-2] << 8 | data[-1]):
+                    stats.rx_packets += 1
+                    callback(data[1], bytes(data[2:-2]))
+                else:
+                    stats.rx_checksum_errors += 1
+    finally:
+        if reader is not capture:
+            reader.close()
+    return stats
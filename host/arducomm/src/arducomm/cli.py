@@ -0,0 +1,410 @@
+""" Command line tool to analyze the captures of ArduComm links (see arducomm.capture).
+
+        arducomm info field_test.cap
+        arducomm decode field_test.cap -c 0x05 -t 0x05=Imu --start 60 --end 70
+        arducomm export field_test.cap -c 0x05 -t 0x05=Imu -o imu.csv -j 4
+        arducomm filter field_test.cap -c 0x05 --start 60 --end 70 -o imu_window.cap
+
+    The payloads are parsed with the type of their command (-t COMMAND=TYPE): a basic dtype
+    (e.g. float), a type of arducomm.types (e.g. Imu), or a Serializable class of any module as
+    module:Class (e.g. my_robot.messages:Odometry). The payloads of the commands without a type are
+    shown in hexadecimal. The tables have one column per basic field of the types, named after the
+    nested fields (e.g. angular_vel.z).
+
+    The capture is read in batches of records through its index, so the memory does not grow
+    with the size of the capture, and the batches can be decoded in a pool of processes (-j).
+"""
+
+import os
+import sys
+import csv
+import struct
+import argparse
+import importlib
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+from . import types
+from .arducomm import ACK_COMMAND
+from .capture import CaptureReader, CaptureWriter, HEADER, INDEX_ENTRY, RX, TX, RX_FRAME, TX_FRAME, FRAME
+from .checksum import FLETCHER16, FCS_FUNCTIONS
+from .serialization import Serializable, parse
+from .serialization.serialization import _NUM_FMT
+
+# Max number of records in each batch
+BATCH_SIZE = 100000
+
+# Frames of each direction
+DIRECTIONS = {'rx': (RX_FRAME,), 'tx': (TX_FRAME,), 'all': (RX_FRAME, TX_FRAME)}
+DIRECTION_NAMES = {RX: 'rx', TX: 'tx', RX_FRAME: 'rx', TX_FRAME: 'tx'}
+
+# Kinds of the table columns
+FLOAT = 'float'
+INT = 'int'
+STR = 'str'
+LIST = 'list'
+
+BASE_COLUMNS = [('time', FLOAT), ('direction', STR), ('seq', INT), ('command', INT)]
+
+
+def resolve_type(spec):
+    """ Return the dtype of a type name: a basic dtype, a type of arducomm.types or module:Class """
+    if spec in _NUM_FMT or spec in ('str', 'char'):
+        return spec
+    if ':' not in spec:
+        if spec not in types.__all__:
+            raise ValueError(F"Unknown type: '{spec}'")
+        return getattr(types, spec)
+    module_name, name = spec.split(':', 1)
+    # The console script does not include the working directory in the path
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    dtype = getattr(importlib.import_module(module_name), name)
+    if not (isinstance(dtype, type) and issubclass(dtype, Serializable)):
+        raise ValueError(F"{spec} is not a Serializable class")
+    return dtype
+
+
+def type_columns(dtype, prefix=''):
+    """ Return the columns (name, kind) of the values of a dtype """
+    fields = getattr(dtype, '_fields', None)
+    if fields is not None:
+        columns = []
+        for name, field_dtype in fields:
+            columns += type_columns(field_dtype, prefix + name + '.')
+        return columns
+    name = prefix[:-1] or 'value'
+    if dtype is types.FloatArray:
+        return [(prefix + 'data', LIST)]
+    if dtype == 'float':
+        return [(name, FLOAT)]
+    if dtype in _NUM_FMT:
+        return [(name, INT)]
+    # Strings and Serializable classes without fields (shown with their repr)
+    return [(name, STR)]
+
+
+def flatten(value, dtype, values):
+    """ Append the values of a parsed payload to values, in the order of type_columns """
+    fields = getattr(dtype, '_fields', None)
+    if fields is not None:
+        for name, field_dtype in fields:
+            flatten(getattr(value, name), field_dtype, values)
+    elif dtype is types.FloatArray:
+        values.append(value.tolist())
+    elif isinstance(value, Serializable):
+        values.append(repr(value))
+    else:
+        values.append(value)
+    return values
+
+
+class Job(object):
+    """ Decoding options of a capture, shared by all the batches (and all the processes) """
+    def __init__(self, path, kinds, commands=None, type_specs=None, fcs=FLETCHER16, table=True):
+        self.reader = CaptureReader(path)
+        self.kinds = kinds
+        self.commands = commands
+        self.types = {command: resolve_type(spec) for command, spec in (type_specs or {}).items()}
+        self.fcs_function = FCS_FUNCTIONS[fcs]
+        self.table = table
+        # Columns of the table: the base columns, the raw payload if some commands do not have
+        # a type, and the columns of all the types (the ones with the same name are shared)
+        self.columns = list(BASE_COLUMNS)
+        if commands is None or any(command not in self.types for command in commands):
+            self.columns.append(('payload', STR))
+        for dtype in self.types.values():
+            for column in type_columns(dtype):
+                if column not in self.columns:
+                    self.columns.append(column)
+        names = [name for name, kind in self.columns]
+        self.payload_column = names.index('payload') if 'payload' in names else None
+        # Position of the values of each type in the row
+        self.positions = {command: [names.index(name) for name, kind in type_columns(dtype)]
+                          for command, dtype in self.types.items()}
+
+    def decode(self, first, last):
+        """ Decode the frames in the records from position first to last.
+            Return the rows and the number of frames that could not be decoded (wrong FCS or size).
+            Table rows have a value for each column, and text rows are
+            (time, direction, seq, command, repr of the payload).
+        """
+        rows = []
+        errors = 0
+        fcs_function = self.fcs_function
+        for record in self.reader.scan(first, last, self.kinds, self.commands):
+            data = record.data
+            if len(data) < 4 or data[1] == ACK_COMMAND:
+                continue
+            if fcs_function(data[:-2]) != (data[-2] << 8 | data[-1]):
+                errors += 1
+                continue
+            command = data[1]
+            payload = data[2:-2]
+            dtype = self.types.get(command)
+            try:
+                value = parse(payload, dtype) if dtype is not None else None
+            except Exception:
+                errors += 1
+                continue
+            direction = DIRECTION_NAMES[record.kind]
+            if not self.table:
+                rows.append((record.timestamp, direction, data[0], command, payload.hex() if dtype is None else repr(value)))
+                continue
+            row = [record.timestamp, direction, data[0], command] + [None] * (len(self.columns) - len(BASE_COLUMNS))
+            if dtype is None:
+                row[self.payload_column] = payload.hex()
+            else:
+                for position, column_value in zip(self.positions[command], flatten(value, dtype, [])):
+                    row[position] = column_value
+            rows.append(row)
+        return rows, errors
+
+
+# Job of the current process
+_job = None
+
+def _init_job(*args):
+    global _job
+    _job = Job(*args)
+
+def _decode_batch(batch):
+    return _job.decode(*batch)
+
+
+def decode_batches(path, args, table=True):
+    """ Decode the selected frames of a capture in batches, in order.
+        Return the Job and an iterator over the results (rows, errors) of each batch.
+    """
+    job_args = (path, DIRECTIONS[args.direction], args.commands, args.types, args.fcs, table)
+    _init_job(*job_args)
+    reader = _job.reader
+    if not len(reader):
+        return _job, iter([])
+    start = reader.start_time + args.start if args.start is not None else None
+    end = reader.start_time + args.end if args.end is not None else None
+    first, last = reader.span(start, end)
+    batch_size = max(1, min(BATCH_SIZE, -(-(last - first) // args.jobs)))
+    batches = [(i, min(i + batch_size, last)) for i in range(first, last, batch_size)]
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=_init_job, initargs=job_args)
+        return _job, _pool_results(pool, batches)
+    return _job, map(_decode_batch, batches)
+
+def _pool_results(pool, batches):
+    with pool:
+        yield from pool.imap(_decode_batch, batches)
+
+
+def cell(value):
+    """ Format a value for the CSV and text outputs """
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ' '.join(str(v) for v in value)
+    return value
+
+
+class CSVOutput(object):
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='') if path != '-' else sys.stdout
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, kind in columns])
+
+    def write(self, rows):
+        self.writer.writerows([[cell(value) for value in row] for row in rows])
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class NumpyOutput(object):
+    """ NumPy .npz file with one array per column. The columns are accumulated until the end. """
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.values = [[] for column in columns]
+
+    def write(self, rows):
+        for values, column_values in zip(self.values, zip(*rows)):
+            values.extend(column_values)
+
+    def close(self):
+        from .serialization.batch import _numpy
+        np = _numpy()
+        arrays = {}
+        for (name, kind), values in zip(self.columns, self.values):
+            missing = any(value is None for value in values)
+            if kind == FLOAT or (kind == INT and missing):
+                # Missing values (rows of other commands) are NaN
+                arrays[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            elif kind == INT:
+                arrays[name] = np.array(values, dtype=np.int64)
+            elif kind == LIST and not missing and len(set(len(value) for value in values)) <= 1:
+                arrays[name] = np.array(values, dtype=np.float32).reshape(len(values), -1)
+            elif kind == LIST:
+                arrays[name] = np.array(values, dtype=object)
+            else:
+                arrays[name] = np.array(['' if value is None else value for value in values], dtype=str)
+        np.savez(self.path, **arrays)
+
+
+class ParquetOutput(object):
+    """ Parquet file written in row groups, one per batch (requires pyarrow) """
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet export requires pyarrow. Install it with: pip install arducomm[parquet]") from None
+        self.pa = pyarrow
+        arrow_types = {FLOAT: pyarrow.float64(), INT: pyarrow.int64(), STR: pyarrow.string(), LIST: pyarrow.list_(pyarrow.float32())}
+        self.names = [name for name, kind in columns]
+        self.schema = pyarrow.schema([(name, arrow_types[kind]) for name, kind in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            columns = {name: list(values) for name, values in zip(self.names, zip(*rows))}
+            self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+OUTPUTS = {'.csv': CSVOutput, '.npz': NumpyOutput, '.parquet': ParquetOutput}
+
+
+def report_errors(errors):
+    if errors:
+        print(F"{errors} frames could not be decoded (wrong FCS or payload size)", file=sys.stderr)
+
+
+def info(args):
+    """ Print the time span of a capture and the number of records of each kind and command """
+    with CaptureReader(args.capture) as reader:
+        print(F"Capture: {args.capture} ({reader.size / 1e6:.1f} MB)")
+        print(F"Records: {len(reader)}")
+        if not len(reader):
+            return
+        start, end = reader.start_time, reader.end_time
+        print(F"Time: {datetime.fromtimestamp(start)} to {datetime.fromtimestamp(end)} ({end - start:.3f} s)")
+        kinds = Counter()
+        commands = Counter()
+        index = memoryview(reader.index)[HEADER.size:HEADER.size + len(reader) * INDEX_ENTRY.size]
+        for timestamp, offset, kind, command in struct.iter_unpack(INDEX_ENTRY.format, index):
+            kinds[kind] += 1
+            if kind & FRAME:
+                commands[(command, DIRECTION_NAMES[kind])] += 1
+        index.release()
+        print(F"Chunks: {kinds[RX]} rx, {kinds[TX]} tx")
+        print(F"Frames: {kinds[RX_FRAME]} rx, {kinds[TX_FRAME]} tx")
+        for command in sorted(set(command for command, direction in commands)):
+            name = 'ACK' if command == ACK_COMMAND else F"0x{command:02X}"
+            print(F"\t{name}: {commands[(command, 'rx')]} rx, {commands[(command, 'tx')]} tx")
+
+
+def decode(args):
+    """ Print the decoded frames, one per line """
+    job, results = decode_batches(args.capture, args, table=False)
+    errors = 0
+    for rows, batch_errors in results:
+        errors += batch_errors
+        for timestamp, direction, seq, command, value in rows:
+            print(F"{timestamp:.6f} {direction} {seq:3d} 0x{command:02X} {value}")
+    report_errors(errors)
+
+
+def export(args):
+    """ Write the decoded frames to a table (CSV, NumPy or Parquet) """
+    extension = os.path.splitext(args.output)[1].lower() if args.output != '-' else '.csv'
+    if extension not in OUTPUTS:
+        raise ValueError(F"Unknown output format: '{extension}'. Use one of: {', '.join(OUTPUTS)}")
+    job, results = decode_batches(args.capture, args)
+    output = OUTPUTS[extension](args.output, job.columns)
+    rows = 0
+    errors = 0
+    for batch_rows, batch_errors in results:
+        output.write(batch_rows)
+        rows += len(batch_rows)
+        errors += batch_errors
+    output.close()
+    report_errors(errors)
+    if args.output != '-':
+        print(F"{rows} rows written to {args.output}", file=sys.stderr)
+
+
+def extract(args):
+    """ Copy the selected records to a new capture """
+    with CaptureReader(args.capture) as reader, CaptureWriter(args.output) as writer:
+        if not len(reader):
+            return
+        start = reader.start_time + args.start if args.start is not None else None
+        end = reader.start_time + args.end if args.end is not None else None
+        kinds = DIRECTIONS[args.direction]
+        if args.commands is None:
+            # Keep the raw chunks too
+            kinds += tuple(kind & ~FRAME for kind in kinds)
+        count = 0
+        for record in reader.records(start, end, kinds, args.commands):
+            writer.write_record(record)
+            count += 1
+    print(F"{count} records written to {args.output}", file=sys.stderr)
+
+
+def parse_type(text):
+    """ Parse a COMMAND=TYPE argument """
+    command, _, spec = text.partition('=')
+    if not spec:
+        raise argparse.ArgumentTypeError(F"Expected COMMAND=TYPE: '{text}'")
+    return int(command, 0), spec
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='arducomm', description="Analyze the captures of ArduComm links")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument("capture", help="Capture file")
+    selection.add_argument("-c", "--command", dest='commands', action='append', type=lambda text: int(text, 0),
+                           help="Select the frames with this command (e.g. 5 or 0x05). Can be repeated. Default: all")
+    selection.add_argument("-d", "--direction", default='rx', choices=DIRECTIONS,
+                           help="Select the frames received (rx), sent (tx) or both (all). Default: rx")
+    selection.add_argument("--start", type=float, help="Start of the time window (seconds since the start of the capture)")
+    selection.add_argument("--end", type=float, help="End of the time window (seconds since the start of the capture)")
+
+    decoding = argparse.ArgumentParser(add_help=False)
+    decoding.add_argument("-t", "--type", dest='types', action='append', type=parse_type, default=[],
+                          help="Payload type of a command, as COMMAND=TYPE (e.g. 0x05=Imu, 7=float or 0x10=module:Class). Can be repeated")
+    decoding.add_argument("--fcs", default=FLETCHER16, choices=FCS_FUNCTIONS, help=F"FCS algorithm of the link. Default: {FLETCHER16}")
+    decoding.add_argument("-j", "--jobs", default=1, type=int, help="Number of processes to decode the capture. Default: 1")
+
+    info_parser = subparsers.add_parser('info', help="Show the time span and the number of frames of each command")
+    info_parser.add_argument("capture", help="Capture file")
+    info_parser.set_defaults(function=info)
+    decode_parser = subparsers.add_parser('decode', parents=[selection, decoding], help="Print the decoded frames")
+    decode_parser.set_defaults(function=decode)
+    export_parser = subparsers.add_parser('export', parents=[selection, decoding],
+                                          help="Write the decoded frames to a CSV, NumPy (.npz) or Parquet file")
+    export_parser.add_argument("-o", "--output", required=True, help="Output file (.csv, .npz or .parquet), or - for CSV to stdout")
+    export_parser.set_defaults(function=export)
+    filter_parser = subparsers.add_parser('filter', parents=[selection], help="Copy the selected records to a new capture")
+    filter_parser.add_argument("-o", "--output", required=True, help="Output capture file")
+    filter_parser.set_defaults(function=extract)
+
+    args = parser.parse_args(argv)
+    if hasattr(args, 'types'):
+        args.types = dict(args.types)
+    try:
+        args.function(args)
+    except BrokenPipeError:
+        # The output was closed (e.g. piped to head). Do not write anything else to it.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except (ValueError, ImportError, OSError) as e:
+        parser.exit(1, F"arducomm: error: {e}\n")
+
+
+if __name__ == '__main__':
+    main()
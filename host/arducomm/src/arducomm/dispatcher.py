@@ -0,0 +1,128 @@
+""" Dispatch the received packets to the message callback from a fixed pool of worker threads.
+
+    Each worker has a bounded queue. All the packets with the same command are processed by
+    the same worker, so they are always delivered in the order they were received.
+"""
+
+import logging
+from collections import deque
+from threading import Thread, Condition
+from time import time
+from .stats import Histogram
+
+# Default max number of packets waiting in each worker queue
+QUEUE_SIZE = 256
+
+# Overflow policies, used when a packet arrives and the queue is full
+BLOCK = 'block'             # Wait until there is room in the queue (the receiving thread stops)
+DROP_OLDEST = 'drop_oldest' # Drop the oldest packet in the queue
+DROP_NEWEST = 'drop_newest' # Drop the packet that just arrived
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class DispatchWorker(Thread):
+    """ Worker thread that runs the callback for the packets in its queue """
+
+    def __init__(self, callback, queue_size=QUEUE_SIZE, overflow=BLOCK):
+        Thread.__init__(self)
+        self.daemon = True
+        self.callback = callback
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.queue = deque()
+        self.cond = Condition()
+        self.running = True
+        # Number of packets dropped because the queue was full
+        self.dropped = 0
+        # Time that the packets wait in the queue. Only updated by this thread.
+        self.latency = Histogram()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue or not self.running)
+                if not self.running:
+                    return
+                callback, command, payload, queued = self.queue.popleft()
+                self.cond.notify_all()
+            self.latency.observe(time() - queued)
+            try:
+                callback(command, payload)
+            except Exception:
+                logging.exception(F"Exception in the message callback for command {command}")
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def put(self, command, payload, callback=None):
+        """ Add a packet to the queue applying the overflow policy.
+            It is processed with the given callback, or the callback of the worker if it is None.
+            Return False if the packet was dropped.
+        """
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                if self.overflow == BLOCK:
+                    self.cond.wait_for(lambda: len(self.queue) < self.queue_size or not self.running)
+                elif self.overflow == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                    logging.warn("Callback queue full. Dropped the oldest packet.")
+                else:
+                    self.dropped += 1
+                    logging.warn(F"Callback queue full. Dropped packet with command {command}.")
+                    return False
+            if not self.running:
+                return False
+            self.queue.append((callback or self.callback, command, payload, time()))
+            self.cond.notify_all()
+        return True
+
+
+class Dispatcher(object):
+    """ Run the message callback for the received packets in a pool of worker threads.
+        With a single worker (default) all the packets are processed in order.
+        With more workers, packets with different commands can be processed in parallel,
+        but the packets with the same command are still processed in order.
+    """
+
+    def __init__(self, callback, num_workers=1, queue_size=QUEUE_SIZE, overflow=BLOCK):
+        if num_workers < 1:
+            raise ValueError("The number of workers must be at least 1")
+        if queue_size < 1:
+            raise ValueError("The queue size must be at least 1")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(F"Unknown overflow policy: '{overflow}'")
+        self.workers = [DispatchWorker(callback, queue_size, overflow) for i in range(num_workers)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def dispatch(self, command, payload, callback=None):
+        """ Queue a packet in the worker that handles its command.
+            callback replaces the callback of the dispatcher for this packet, so a single pool
+            can serve several links (see ArduCommHub).
+            Return False if the packet was dropped.
+        """
+        return self.workers[command % len(self.workers)].put(command, payload, callback)
+
+    def queue_depth(self):
+        """ Number of packets waiting to be processed """
+        return sum(len(worker.queue) for worker in self.workers)
+
+    def dropped(self):
+        """ Number of packets dropped because the queues were full """
+        return sum(worker.dropped for worker in self.workers)
+
+    def latency(self):
+        """ Histogram of the time (seconds) that the packets waited in the queues """
+        histogram = Histogram()
+        for worker in self.workers:
+            histogram.merge(worker.latency)
+        return histogram
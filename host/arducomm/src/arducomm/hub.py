@@ -0,0 +1,149 @@
+""" Manager of many ArduComm links in a single receiving thread.
+
+    Each link is a regular ArduComm object, with its own sequence numbers and ARQ state, but its
+    serial port is registered in a selector (epoll, kqueue...) owned by the hub instead of having
+    its own receiving thread. All the links also share the same pool of callback workers, and send
+    writes the packets in the calling thread, so the number of threads does not grow with the number
+    of boards (except for the window thread of the links in windowed ARQ mode, and the transmission
+    thread that a link starts when packets are queued). Only available on POSIX systems.
+"""
+
+import os
+import logging
+import selectors
+from functools import partial
+from threading import Thread, Lock
+from .arducomm import ArduComm, BAUDRATE
+from .dispatcher import Dispatcher, QUEUE_SIZE, BLOCK
+
+
+class ArduCommHub(Thread):
+    """ Receive the packets of many ArduComm links in one thread, and send them by link name """
+
+    def __init__(self, message_callback=None, callback_workers=1, callback_queue_size=QUEUE_SIZE, callback_overflow=BLOCK):
+        """ message_callback(name, command, payload) is called for every packet received by any link.
+            It can be None if the packets are only processed by subscribers (see subscribe).
+
+            The callbacks of all the links run in a pool of callback_workers threads
+            (see ArduComm and Dispatcher). Packets with the same command are processed in order.
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.callback = message_callback
+        self.dispatcher = Dispatcher(None, callback_workers, callback_queue_size, callback_overflow)
+        self.links = {}
+        self.selector = selectors.DefaultSelector()
+        # The links are added and removed with the lock, and the pipe wakes up the thread to apply the changes
+        self.lock = Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+        self.running = True
+
+    def __getitem__(self, name):
+        return self.links[name]
+
+    def add_link(self, name, port, baudrate=BAUDRATE, **kwargs):
+        """ Connect a new link with the given name and return its ArduComm object.
+            kwargs are passed to ArduComm (window_size, fcs, flow_control, rtscts).
+            Links can be added before or after starting the hub.
+        """
+        if name in self.links:
+            raise ValueError(F"Link '{name}' already exists")
+        callback = partial(self.callback, name) if self.callback is not None else None
+        # The port is only read when the selector reports new bytes, so reads must not block
+        link = ArduComm(callback, port=port, baudrate=baudrate, read_timeout=0, dispatcher=self.dispatcher, **kwargs)
+        with self.lock:
+            self.links[name] = link
+            self.selector.register(link.ser.fileno(), selectors.EVENT_READ, link)
+        os.write(self.wake_write, b'\0')
+        return link
+
+    def remove_link(self, name):
+        """ Disconnect a link and close its port """
+        with self.lock:
+            link = self.links.pop(name)
+            self.unregister(link)
+        os.write(self.wake_write, b'\0')
+        link.stop()
+
+    def unregister(self, link):
+        try:
+            self.selector.unregister(link.ser.fileno())
+        except (KeyError, ValueError):
+            # Already unregistered (or the port is closed)
+            pass
+
+    def run(self):
+        """ Wait until some ports have new bytes and pass them to their links """
+        self.dispatcher.start()
+        while self.running:
+            events = self.selector.select()
+            links = []
+            with self.lock:
+                for key, mask in events:
+                    if key.data is None:
+                        # Woken up by the pipe
+                        os.read(self.wake_read, 1024)
+                    elif self.selector.get_map().get(key.fd) is key:
+                        # The link was not removed after select returned
+                        links.append(key.data)
+            # The links are read without the lock, so add_link and remove_link do not wait
+            # while a link is blocked (e.g. by a full callback queue)
+            for link in links:
+                self.read(link)
+
+    def read(self, link):
+        """ Read the bytes waiting in the port of a link and process them.
+            A link that fails is removed from the selector, and the rest keep working.
+        """
+        try:
+            chunk = link.ser.read(link.ser.in_waiting or 1)
+            link.receive(chunk)
+        except Exception:
+            if not any(other is link for other in list(self.links.values())):
+                # The link was removed (and its port closed) while it was being read
+                return
+            logging.exception(F"Could not read the serial port {link.ser.port}. Removing it from the hub.")
+            with self.lock:
+                self.unregister(link)
+
+    def stop(self):
+        """ Stop the thread and close all the links """
+        self.running = False
+        os.write(self.wake_write, b'\0')
+        if self.is_alive():
+            self.join()
+        self.dispatcher.stop()
+        for name in list(self.links):
+            self.remove_link(name)
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+    def send(self, name, command, payload=[], priority=0):
+        """ Send a packet through the given link (see ArduComm.send) """
+        return self.links[name].send(command, payload, priority)
+
+    def send_async(self, name, command, payload=[], priority=0):
+        """ Queue a packet in the given link and return its Future (see ArduComm.send_async) """
+        return self.links[name].send_async(command, payload, priority)
+
+    def subscribe(self, name, command, dtype, handler):
+        """ Call handler(data) for every packet received with the given command in the given link
+            (see ArduComm.subscribe)
+        """
+        self.links[name].subscribe(command, dtype, handler)
+
+    def unsubscribe(self, name, command, handler=None):
+        """ Remove a handler of the given command in the given link (see ArduComm.unsubscribe) """
+        self.links[name].unsubscribe(command, handler)
+
+    def flush(self, timeout=None):
+        """ Wait until the frames in the windows of all the links are acknowledged (see ArduComm.flush).
+            Return False if any frame could not be delivered.
+        """
+        return all([link.flush(timeout) for link in list(self.links.values())])
+
+    def stats(self):
+        """ Return a dict with the statistics of each link by name (see ArduComm.stats) """
+        return {name: link.stats() for name, link in list(self.links.items())}
@@ -1 +1,2 @@
 from .serialization import Serializable, serialize, parse
+from .batch import parse_many, numpy_dtype
@@ -0,0 +1,90 @@
+""" Batch parsing of homogeneous payloads with NumPy (optional dependency).
+
+    parse_many decodes many payloads of the same type (e.g. a log of Imu packets) with a single
+    np.frombuffer call. The layouts of arducomm.types and schema messages are mapped to NumPy
+    structured dtypes, so the result is a record array with the same field names:
+
+        imus = parse_many(payloads, Imu)
+        imus.angular_vel.z  # ndarray with the angular_vel.z of every payload
+"""
+
+from .serialization import Serializable, _NUM_FMT
+
+# NumPy dtype of each basic dtype
+_NUMPY_FMT = {
+    'uint8': '<u1',
+    'int8': '<i1',
+    'uint16': '<u2',
+    'int16': '<i2',
+    'uint32': '<u4',
+    'int32': '<i4',
+    'float': '<f4',
+}
+
+
+def _numpy():
+    """ Import NumPy only when it is used, so the rest of the library does not depend on it """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Batch parsing requires NumPy. Install it with: pip install arducomm[numpy]") from None
+    return numpy
+
+
+def _is_float_array(dtype):
+    # Imported when it is used, because arducomm.types depends on this package
+    from ..types import FloatArray
+    return isinstance(dtype, type) and issubclass(dtype, FloatArray)
+
+
+def numpy_dtype(dtype, length=None):
+    """ Return the NumPy dtype with the same layout of a basic dtype, a type with fixed fields
+        (arducomm.types and schema messages) or FloatArray. FloatArray has a variable size,
+        so the length (number of floats) must be given, and it is mapped to a float subarray.
+    """
+    np = _numpy()
+    if dtype in _NUMPY_FMT:
+        return np.dtype(_NUMPY_FMT[dtype])
+    if not (isinstance(dtype, type) and issubclass(dtype, Serializable)):
+        raise ValueError(F"Unknown dtype: '{dtype}'")
+    if hasattr(dtype, '_fields'):
+        return np.dtype([(name, numpy_dtype(field_dtype)) for name, field_dtype in dtype._fields])
+    if _is_float_array(dtype):
+        if length is None:
+            raise ValueError("The length of FloatArray is required")
+        return np.dtype((_NUMPY_FMT['float'], (length,)))
+    raise ValueError(F"{dtype.__name__} does not have a fixed layout")
+
+
+def parse_many(payloads, dtype):
+    """ Parse a batch of payloads of the same dtype with a single np.frombuffer call.
+        payloads can be an iterable of payloads or a bytes-like object with the payloads one
+        after another. Types with fields return a record array, and basic dtypes and FloatArray
+        (one row per payload) return a plain array.
+        The result is a copy, it does not keep references to the payloads.
+    """
+    np = _numpy()
+    if isinstance(payloads, (bytes, bytearray, memoryview)):
+        buffer = bytearray(payloads)
+        sizes = None
+    else:
+        payloads = list(payloads)
+        sizes = set(len(payload) for payload in payloads)
+        buffer = bytearray().join(payloads)
+    length = None
+    if dtype not in _NUM_FMT and _is_float_array(dtype):
+        # All the arrays must have the same length
+        if sizes is None or len(sizes) > 1:
+            raise ValueError("FloatArray payloads must be given separately and have the same size")
+        length = (sizes.pop() if sizes else 0) // 4
+        sizes = None
+        if length == 0:
+            # Empty arrays (NumPy can not read items of size 0 from a buffer)
+            return np.zeros((len(payloads), 0), dtype=_NUMPY_FMT['float'])
+    np_dtype = numpy_dtype(dtype, length)
+    if sizes is not None and sizes - {np_dtype.itemsize}:
+        raise ValueError(F"Payload sizes {sorted(sizes)} do not match the size of {dtype}: {np_dtype.itemsize}")
+    if len(buffer) % np_dtype.itemsize:
+        raise ValueError(F"Buffer size {len(buffer)} is not a multiple of the size of {dtype}: {np_dtype.itemsize}")
+    array = np.frombuffer(buffer, dtype=np_dtype)
+    return array if np_dtype.names is None else array.view(np.recarray)
@@ -0,0 +1,282 @@
+""" Declarative message schema.
+
+    A message type is declared once, as a class with annotated fields:
+
+        @message
+        class Odometry:
+            pose: Pose
+            linear_vel: Vector3
+            angular_vel: Vector3
+            timestamp: 'uint32'
+
+    Each field is a basic dtype (the numeric dtypes of serialization) or another message type
+    (another schema message or one of arducomm.types, except FloatArray). Nested messages are
+    flattened, so the generated class parses and serializes the whole payload with a single
+    precompiled struct. The class uses __slots__, and each instance gets its own nested objects
+    as defaults. Basic fields can set a default value in the declaration (e.g. w: 'float' = 1.0).
+
+    generate_header(...) returns the equivalent C++ class and Serializer specialization for
+    the Arduino library, so both ends always agree on the layout.
+"""
+
+import sys
+import math
+import struct
+from .serialization import Serializable, _NUM_FMT
+
+# C++ type of each basic dtype
+_CPP_TYPES = {
+    'uint8': 'uint8_t',
+    'int8': 'int8_t',
+    'uint16': 'uint16_t',
+    'int16': 'int16_t',
+    'uint32': 'uint32_t',
+    'int32': 'int32_t',
+    'float': 'float',
+}
+
+
+def is_message(dtype):
+    """ Check if dtype is a message type with a fixed layout (it declares its _fields) """
+    return isinstance(dtype, type) and issubclass(dtype, Serializable) and hasattr(dtype, '_fields')
+
+
+def flat_format(dtype):
+    """ Return the struct format (without byte order) of a basic dtype or message type """
+    if is_message(dtype):
+        return ''.join(flat_format(field_dtype) for name, field_dtype in dtype._fields)
+    return _NUM_FMT[dtype][1:]
+
+
+def _flat_paths(dtype, prefix):
+    """ Return the attribute path (e.g. 'self.pose.position.x') of each value in the flattened layout """
+    paths = []
+    for name, field_dtype in dtype._fields:
+        path = F"{prefix}.{name}"
+        paths += _flat_paths(field_dtype, path) if is_message(field_dtype) else [path]
+    return paths
+
+
+def _build_expr(dtype, values, namespace):
+    """ Return the expression that builds an object of dtype from the next flattened values
+        (names taken from the values iterator). Nested types are added to the namespace.
+    """
+    namespace[dtype.__name__] = dtype
+    args = []
+    for name, field_dtype in dtype._fields:
+        args.append(_build_expr(field_dtype, values, namespace) if is_message(field_dtype) else next(values))
+    return F"{dtype.__name__}({', '.join(args)})"
+
+
+def _resolve(dtype, cls):
+    """ Resolve a field dtype declared as a string (a basic dtype or the name of a message type) """
+    if isinstance(dtype, str) and dtype not in _NUM_FMT:
+        dtype = vars(sys.modules[cls.__module__]).get(dtype, dtype)
+    if dtype not in _NUM_FMT and not is_message(dtype):
+        raise ValueError(F"Invalid dtype for a message field: '{dtype}'")
+    return dtype
+
+
+def message(cls):
+    """ Class decorator that creates a message type from the annotated fields of cls """
+    fields = tuple((name, _resolve(dtype, cls)) for name, dtype in cls.__dict__.get('__annotations__', {}).items())
+    if not fields:
+        raise ValueError(F"Message {cls.__name__} does not have any fields")
+    layout = struct.Struct('<' + ''.join(flat_format(dtype) for name, dtype in fields))
+    if layout.size > 255:
+        raise ValueError(F"Message {cls.__name__} is too large for a payload: {layout.size} bytes (max. 255)")
+
+    # Generate the methods, so each field is accessed directly without loops
+    namespace = {'_struct': layout}
+    init_args = []
+    init_body = []
+    for name, dtype in fields:
+        if is_message(dtype):
+            init_args.append(F"{name}=None")
+            namespace[dtype.__name__] = dtype
+            init_body.append(F"    self.{name} = {dtype.__name__}() if {name} is None else {name}")
+        else:
+            default = cls.__dict__.get(name, 0.0 if dtype == 'float' else 0)
+            namespace[F"_default_{name}"] = default
+            init_args.append(F"{name}=_default_{name}")
+            init_body.append(F"    self.{name} = {name}")
+    paths = _flat_paths(type('', (), {'_fields': fields}), 'self')
+    values = [F"_v{i}" for i in range(len(paths))]
+    value_names = iter(values)
+    parse_body = [F"    self.{name} = {_build_expr(dtype, value_names, namespace) if is_message(dtype) else next(value_names)}"
+                  for name, dtype in fields]
+    source = '\n'.join([
+        F"def __init__(self, {', '.join(init_args)}):",
+        *init_body,
+        "def _values(self):",
+        F"    return ({', '.join(paths)},)",
+        "def serialize(self):",
+        F"    return _struct.pack({', '.join(paths)})",
+        "def parse(self, buffer, offset=0):",
+        F"    {', '.join(values)}, = _struct.unpack_from(buffer, offset)",
+        *parse_body,
+        "    return self",
+    ])
+    exec(source, namespace)
+
+    def __repr__(self):
+        return F"{cls.__name__}({', '.join(F'{name}={getattr(self, name)!r}' for name, dtype in fields)})"
+
+    def __eq__(self, other):
+        # Compared by payload, because the nested arducomm.types do not define __eq__, and the
+        # floats are only kept with the precision of the payload (float32)
+        if type(self) is not type(other):
+            return False
+        try:
+            return self.serialize() == other.serialize()
+        except struct.error:
+            # Some value does not fit in its field. Compare the values of the flattened layout.
+            return self._values() == other._values()
+
+    attributes = {key: value for key, value in cls.__dict__.items()
+                  if key not in ('__dict__', '__weakref__') and key not in dict(fields)}
+    attributes.update({
+        '__slots__': tuple(name for name, dtype in fields),
+        '__init__': namespace['__init__'],
+        '__repr__': __repr__,
+        '__eq__': __eq__,
+        '__hash__': None,
+        '_values': namespace['_values'],
+        'serialize': namespace['serialize'],
+        'parse': namespace['parse'],
+        '_fields': fields,
+        '_struct': layout,
+        'size': layout.size,
+    })
+    attributes['serialize'].__doc__ = """ Serialize the data contained in self.
+            Return a bytes-like object with the serialized data.
+        """
+    attributes['parse'].__doc__ = """ Parse (deserialize) the bytes from a buffer, starting at offset.
+            Update the instance object and return self.
+        """
+    return type(cls.__name__, (Serializable,), attributes)
+
+
+def _cpp_type(dtype):
+    return dtype.__name__ if is_message(dtype) else _CPP_TYPES[dtype]
+
+
+def _cpp_value(value):
+    """ Return the C++ literal of a default value """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NAN'
+        if math.isinf(value):
+            return 'INFINITY' if value > 0 else '-INFINITY'
+    return repr(value)
+
+
+def _nested_messages(dtype, found):
+    """ Add the message types used by dtype (dependencies first) to the found list """
+    for name, field_dtype in dtype._fields:
+        if is_message(field_dtype):
+            _nested_messages(field_dtype, found)
+            if field_dtype not in found:
+                found.append(field_dtype)
+
+
+def _cpp_class(dtype):
+    """ Return the C++ class and Serializer specialization of a message type """
+    name = dtype.__name__
+    fields = dtype._fields
+    members = '\n'.join(F"    {_cpp_type(f)} {n};" for n, f in fields)
+    default = dtype()
+    defaults = ', '.join(F"{n}()" if is_message(f) else F"{n}({_cpp_value(getattr(default, n))})" for n, f in fields)
+    args = ', '.join(F"const {_cpp_type(f)}& {n}" for n, f in fields)
+    inits = ', '.join(F"{n}({n})" for n, f in fields)
+    offsets = []
+    offset = '0'
+    for n, f in fields:
+        offsets.append((n, f, offset))
+        size = F"{_cpp_type(f)}::size" if is_message(f) else F"sizeof({_cpp_type(f)})"
+        offset = size if offset == '0' else F"{offset} + {size}"
+    serialize = '\n'.join(F"        Serializer<{_cpp_type(f)}>::serialize(msg.{n}, buffer{'' if o == '0' else ' + ' + o});"
+                          for n, f, o in offsets)
+    parse = '\n'.join(F"        Serializer<{_cpp_type(f)}>::parse(buffer{'' if o == '0' else ' + ' + o}, msg.{n});"
+                      for n, f, o in offsets)
+    return F"""class {name}
+{{
+public:
+{members}
+    // Payload size
+    static constexpr uint8_t size = {dtype.size};
+
+    {name}() : {defaults}
+    {{
+    }}
+
+    {name}({args}) : {inits}
+    {{
+    }}
+
+    ~{name}(){{}}
+}};
+
+namespace serialization
+{{
+
+template<>
+class Serializer<{name}>
+{{
+public:
+    inline static void serialize(const {name}& msg, uint8_t* buffer)
+    {{
+{serialize}
+    }}
+    inline static void parse(uint8_t* buffer, {name}& msg)
+    {{
+{parse}
+    }}
+    inline static {name} parse(uint8_t* buffer)
+    {{
+        {name} msg;
+        Serializer<{name}>::parse(buffer, msg);
+        return msg;
+    }}
+}};
+
+}} // namespace serialization
+"""
+
+
+def generate_header(*dtypes, guard=None):
+    """ Return the source of a C++ header with the given message types for the Arduino library.
+        The schema messages used by them are included in the same header, and the types of
+        arducomm.types are included from the library.
+    """
+    messages = []
+    for dtype in dtypes:
+        _nested_messages(dtype, messages)
+        if dtype not in messages:
+            messages.append(dtype)
+    library_types = [m for m in messages if m.__module__.startswith('arducomm.types')]
+    messages = [m for m in messages if m not in library_types]
+    guard = guard or F"ARDUCOMM__{dtypes[0].__name__.upper()}_H"
+    includes = '\n'.join(["#include <arducomm/serialization.h>"] +
+                         [F"#include <arducomm/types/{m.__module__.rsplit('.', 1)[-1]}.h>" for m in library_types])
+    classes = '\n'.join(_cpp_class(m) for m in messages)
+    return F"""/* Message types generated from the schema of the host library (arducomm.serialization.schema).
+*  Do not edit this file. Change the schema and generate it again.
+*/
+
+#ifndef {guard}
+#define {guard}
+
+{includes}
+
+{classes}
+#endif
+"""
+
+
+def write_header(path, *dtypes, guard=None):
+    """ Generate the C++ header with the given message types and write it in path """
+    with open(path, 'w') as f:
+        f.write(generate_header(*dtypes, guard=guard))
@@ -9,6 +9,9 @@ class Serializable(ABC):
         All classes meant to be serialized and sent whtough ArduComm must
         inherit from this base class and implement its abstract methods.
     """
+    # Empty, so subclasses can use __slots__ (subclasses without them still have a __dict__)
+    __slots__ = ()
+
     @abstractmethod
     def serialize(self):
         """ Serialize the data contained in self.
@@ -34,14 +37,16 @@ _NUM_FMT = {
     'int32': '<i',
     'float': '<f',
 }
+# Precompiled structs of each format
+_NUM_STRUCT = {dtype: struct.Struct(fmt) for dtype, fmt in _NUM_FMT.items()}
 
 def serialize_num(data, dtype):
     """ Convert a number into a bytes object """
-    return struct.pack(_NUM_FMT[dtype], data)
+    return _NUM_STRUCT[dtype].pack(data)
 
 def parse_num(buffer, dtype):
     """ Convert byte list into a number """
-    return struct.unpack(_NUM_FMT[dtype], bytes(buffer))[0]
+    return _NUM_STRUCT[dtype].unpack(bytes(buffer))[0]
 
 
 """ Serialization of chars and strings (null terminated) """
@@ -60,7 +65,7 @@ def parse_str(buffer):
     """ Convert the given byte list into a string (char array)
         The string data might be null terminated, but not necessary
     """
-    return buffer.decode('utf8').rstrip('\x00')
+    return str(buffer, 'utf8').rstrip('\x00')
 
 
 def serialize(data, dtype=Serializable):
@@ -0,0 +1,429 @@
+""" Simulated serial link with an ArduComm peer, to test and benchmark the host library without hardware.
+
+    LinkSimulator creates a pseudo-terminal (pty) pair. The host opens the slave side as a regular
+    serial port (ArduComm(port=sim.port)), and the simulator runs a Python port of the ArduCommT
+    class of the Arduino library on the other side, including its small serial input buffer.
+    Each direction of the line adds the transmission time at the given baudrate and a fixed latency,
+    and can corrupt bytes or drop whole frames. Only available on POSIX systems.
+
+    Example:
+        sim = LinkSimulator(handler=lambda command, payload: (command + 1, payload), corrupt=0.001)
+        sim.start()
+        comms = ArduComm(callback, port=sim.port)
+"""
+
+import os
+import tty
+import random
+import select
+from collections import deque
+from time import sleep, time
+from threading import Thread, Lock, Condition
+from .arducomm import (PacketFrame, ACKFrame, BAUDRATE, TIMEOUT, MAX_RETRIES, READ_TIMEOUT, ARDUINO_RX_BUFFER_SIZE,
+                       MAX_WINDOW_SIZE, ACK_COMMAND, ACK_UNSET, ACK_OK, ACK_RETRY, ACK_TYPE_PLAIN, ACK_TYPE_NACK,
+                       ACK_TYPE_WINDOW_REQUEST, ACK_TYPE_WINDOW_REPLY, ACK_TYPE_FLOW_REQUEST, ACK_TYPE_FLOW_REPLY,
+                       ACK_TYPE_CREDIT, ACK_TYPE_CREDIT_REQUEST, START_FLAG, ESCAPE_FLAG, invert_bit_5)
+from .checksum import fletcher16
+
+# Default size of the frame buffer of ArduCommT
+BUFFER_SIZE = 128
+# Time (seconds) without new bytes before reporting the bytes read that were not reported yet
+CREDIT_IDLE_TIME = 0.001
+
+# Errors returned by SimulatedArduComm.send (TXError in the Arduino library)
+NO_ERROR = 0
+TIMEOUT_ERROR = 1
+ACK_ERROR = 2
+
+# Position of the fields in the frame buffer (including the start flag)
+SEQ_NUMBER = 1
+COMMAND = 2
+PAYLOAD = 3
+
+
+class Line(object):
+    """ One direction of the serial line.
+        Bytes arrive after their transmission time (10 bits per byte) plus the latency.
+        Each byte can be corrupted (a random bit is inverted) with probability corrupt,
+        and each frame can be dropped (all the bytes between two flags) with probability drop.
+    """
+    def __init__(self, baudrate=BAUDRATE, latency=0.0, corrupt=0.0, drop=0.0, rng=None):
+        self.byte_time = 10.0 / baudrate if baudrate else 0.0
+        self.latency = latency
+        self.corrupt = corrupt
+        self.drop = drop
+        self.rng = rng or random.Random()
+        # Chunks of bytes in transit: (arrival time of the first byte, data)
+        self.queue = deque()
+        # Time when the line finishes transmitting the bytes in the queue
+        self.free_time = 0.0
+        self.in_frame = False
+        self.dropping = False
+        # Statistics
+        self.corrupted_bytes = 0
+        self.dropped_frames = 0
+
+    def push(self, data, now):
+        """ Start transmitting the data at the given time (or when the line is free) """
+        if self.corrupt or self.drop:
+            data = self.impair(data)
+        if not data:
+            return
+        start = max(now, self.free_time)
+        self.free_time = start + len(data) * self.byte_time
+        self.queue.append((start + self.byte_time + self.latency, data))
+
+    def impair(self, data):
+        """ Return the data after corrupting bytes and dropping frames """
+        rng = self.rng
+        impaired_data = bytearray()
+        for byte in data:
+            if self.corrupt and rng.random() < self.corrupt:
+                byte ^= 1 << rng.randrange(8)
+                self.corrupted_bytes += 1
+            if byte == START_FLAG:
+                # Flags are always kept, so the receiver sees an empty (ghost) frame
+                self.in_frame = False
+                self.dropping = False
+            elif not self.in_frame:
+                # First byte of a new frame
+                self.in_frame = True
+                self.dropping = self.drop and rng.random() < self.drop
+                if self.dropping:
+                    self.dropped_frames += 1
+            if not self.dropping:
+                impaired_data.append(byte)
+        return bytes(impaired_data)
+
+    def pop(self, now):
+        """ Return the bytes that have arrived by the given time """
+        arrived = bytearray()
+        while self.queue:
+            arrival, data = self.queue[0]
+            if arrival > now:
+                break
+            count = len(data) if not self.byte_time else min(len(data), int((now - arrival) / self.byte_time) + 1)
+            arrived += data[:count]
+            if count < len(data):
+                self.queue[0] = (arrival + count * self.byte_time, data[count:])
+                break
+            self.queue.popleft()
+        return bytes(arrived)
+
+    def next_arrival(self):
+        """ Arrival time of the next byte, or None if the line is empty """
+        return self.queue[0][0] if self.queue else None
+
+
+class SimulatedStream(object):
+    """ Serial port of the simulated Arduino (Stream interface).
+        Received bytes are stored in an input buffer of rx_buffer_size bytes. When the buffer is full,
+        new bytes are lost, the same as in the Arduino. Written bytes are passed to the write function.
+    """
+    def __init__(self, write, rx_buffer_size=ARDUINO_RX_BUFFER_SIZE):
+        self.write = write
+        self.rx_buffer_size = rx_buffer_size
+        self.rx_buffer = deque()
+        self.cond = Condition()
+        # Number of bytes lost because the input buffer was full
+        self.overflows = 0
+
+    def receive(self, data):
+        """ Add the bytes that arrived from the line to the input buffer """
+        with self.cond:
+            room = self.rx_buffer_size - len(self.rx_buffer)
+            if len(data) > room:
+                self.overflows += len(data) - room
+                data = data[:room]
+            self.rx_buffer.extend(data)
+            self.cond.notify_all()
+
+    def available(self):
+        return len(self.rx_buffer)
+
+    def read(self):
+        with self.cond:
+            return self.rx_buffer.popleft() if self.rx_buffer else -1
+
+    def wait(self, timeout=None):
+        """ Block until there are bytes in the input buffer or the timeout expires """
+        with self.cond:
+            self.cond.wait_for(lambda: self.rx_buffer, timeout)
+
+
+class SimulatedArduComm(object):
+    """ Python port of the ArduCommT class of the Arduino library (ArduComm.h).
+
+        handler(command, payload) is called for every packet received, like the subscriber callbacks.
+        It can return a (command, payload) tuple to send a reply. Replies are sent from loop(),
+        with Stop-and-Wait, the same as calling send() in the loop of a sketch.
+    """
+    def __init__(self, stream, buffer_size=BUFFER_SIZE, handler=None):
+        if not 6 <= buffer_size <= 255:
+            raise ValueError("The buffer size must be between 6 and 255 bytes")
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.handler = handler
+        self.in_buffer = bytearray(buffer_size)
+        self.buffer_index = 0
+        self.escape_received = False
+        self.sent_seq = 0
+        self.last_ack = ACK_UNSET
+        self.retries = 0
+        self.window_size = 0
+        self.expected_seq = 0
+        self.flow_control = False
+        self.read_count = 0
+        self.reported_count = 0
+        self.last_read_time = 0.0
+        self.replies = deque()
+        # Statistics
+        self.packets_received = 0
+        self.packets_sent = 0
+        self.send_errors = 0
+
+    def loop(self):
+        """ One iteration of the sketch loop: read the port and send the pending replies """
+        self.read()
+        while self.replies:
+            command, payload = self.replies.popleft()
+            if self.send(command, payload) == NO_ERROR:
+                self.packets_sent += 1
+            else:
+                self.send_errors += 1
+
+    def read(self):
+        """ Read the bytes in the input buffer until a frame is complete.
+            Return 1 if a new packet (or ACK) is available, else 0.
+        """
+        stream = self.stream
+        in_buffer = self.in_buffer
+        while stream.available():
+            if self.buffer_index >= self.buffer_size:
+                # The frame does not fit in the buffer. Drop it.
+                self.buffer_index = 0
+            in_buffer[self.buffer_index] = stream.read()
+            self.buffer_index += 1
+            if self.flow_control:
+                self.read_count = (self.read_count + 1) % 256
+                self.last_read_time = time()
+                if (self.read_count - self.reported_count) % 256 >= stream.rx_buffer_size // 2:
+                    self.send_credit(0)
+            last = in_buffer[self.buffer_index - 1]
+            if in_buffer[0] != START_FLAG:
+                # Broken frame. Drop bytes until a START_FLAG arrives
+                self.buffer_index = 0
+            elif last == ESCAPE_FLAG:
+                self.escape_received = True
+                self.buffer_index -= 1
+            elif last == START_FLAG:
+                if self.buffer_index > 3:
+                    return self.process_frame()
+                # Assume the last flag is the start of a frame, and not the end
+                self.buffer_index = 1
+            elif self.escape_received:
+                in_buffer[self.buffer_index - 1] = invert_bit_5(last)
+                self.escape_received = False
+        if self.flow_control and self.read_count != self.reported_count and time() - self.last_read_time >= CREDIT_IDLE_TIME:
+            # The host might be waiting for these credits to write the next frame
+            self.send_credit(0)
+        return 0
+
+    def process_frame(self):
+        """ Process the frame in the buffer and send its ACK """
+        in_buffer = self.in_buffer
+        size = self.buffer_index
+        seq_number = in_buffer[SEQ_NUMBER]
+        command = in_buffer[COMMAND]
+        ack_type = in_buffer[PAYLOAD] if size > 4 else ACK_TYPE_PLAIN
+        new_packet = 0
+        packet = None
+
+        if command == ACK_COMMAND and ack_type == ACK_TYPE_WINDOW_REQUEST:
+            self.window_size = min(in_buffer[PAYLOAD + 1], MAX_WINDOW_SIZE) if size > 5 else 0
+            self.expected_seq = seq_number
+            self.send_ack(self.expected_seq, ACK_TYPE_WINDOW_REPLY, [self.window_size])
+        elif command == ACK_COMMAND and ack_type == ACK_TYPE_FLOW_REQUEST:
+            self.flow_control = in_buffer[PAYLOAD + 1] != 0 if size > 5 else True
+            self.read_count = 0
+            self.reported_count = 0
+            self.send_ack(seq_number, ACK_TYPE_FLOW_REPLY, [self.stream.rx_buffer_size, self.buffer_size])
+        elif command == ACK_COMMAND and ack_type == ACK_TYPE_CREDIT_REQUEST:
+            self.send_credit(seq_number)
+        elif command == ACK_COMMAND:
+            self.last_ack = ACK_RETRY if seq_number == self.sent_seq else ACK_OK
+            new_packet = 1
+        else:
+            payload = bytes(in_buffer[PAYLOAD:size - 3]) if size > 6 else b''
+            received_checksum = (in_buffer[size - 3] << 8) | in_buffer[size - 2]
+            computed_checksum = fletcher16(bytes([seq_number, command]) + payload)
+            if self.window_size and seq_number != self.expected_seq:
+                # Go-Back-N: discard out of order frames and repeat the last ACK
+                self.send_ack(self.expected_seq)
+            elif received_checksum != computed_checksum:
+                if self.window_size:
+                    self.send_ack(self.expected_seq, ACK_TYPE_NACK)
+                else:
+                    self.send_ack(seq_number)
+            else:
+                new_packet = 1
+                self.expected_seq = (seq_number + 1) % 256
+                self.send_ack(self.expected_seq)
+                packet = (command, payload)
+
+        self.in_buffer[0] = 0
+        self.buffer_index = 0
+
+        if packet is not None:
+            self.packets_received += 1
+            if self.handler is not None:
+                reply = self.handler(*packet)
+                if reply is not None:
+                    self.replies.append(reply)
+        return new_packet
+
+    def send(self, command, payload=b''):
+        """ Send a packet and wait for its ACK (Stop-and-Wait). Return the TX error code. """
+        for retry in range(MAX_RETRIES):
+            self.sent_seq = (self.sent_seq + 1) % 256
+            self.last_ack = ACK_UNSET
+            self.stream.write(PacketFrame(self.sent_seq, command, payload).serialize())
+            if not self.wait_ack():
+                return TIMEOUT_ERROR
+            if self.last_ack == ACK_OK:
+                return NO_ERROR
+            # Retry with the same sequence number
+            self.sent_seq = (self.sent_seq - 1) % 256
+        return ACK_ERROR
+
+    def wait_ack(self, timeout=TIMEOUT):
+        """ Read until a new ACK arrives. Return False if the timeout expires. """
+        deadline = time() + timeout
+        while self.last_ack == ACK_UNSET:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            self.wait(remaining)
+            self.read()
+        return True
+
+    def wait(self, timeout):
+        """ Block until there are bytes to read, the timeout expires or the credits must be reported.
+            The Arduino reads the port in a busy loop, which reports them after the idle time.
+        """
+        if not self.stream.available():
+            unreported = self.read_count != self.reported_count
+            self.stream.wait(min(timeout, CREDIT_IDLE_TIME) if unreported else timeout)
+
+    def send_ack(self, seq_number, ack_type=ACK_TYPE_PLAIN, data=[]):
+        self.stream.write(ACKFrame(seq_number, ack_type, data).serialize())
+
+    def send_credit(self, seq_number):
+        """ Report the bytes read, protected with the FCS. seq_number is the request it replies to, or 0. """
+        self.reported_count = self.read_count
+        fcs = fletcher16(bytes([seq_number, ACK_COMMAND, ACK_TYPE_CREDIT, self.read_count]))
+        self.send_ack(seq_number, ACK_TYPE_CREDIT, [self.read_count, fcs >> 8, fcs & 0xFF])
+
+
+class LinkSimulator(Thread):
+    """ Serial link between the host and a simulated Arduino running ArduComm.
+
+        The host opens port (the slave side of a pty pair) as a regular serial port.
+        handler is the callback of the simulated Arduino (see SimulatedArduComm).
+        baudrate sets the transmission time of the bytes (None for an instant line) and latency
+        adds a fixed delay (seconds) in each direction. corrupt is the probability of corrupting
+        each byte and drop the probability of dropping each frame, in both directions.
+        rx_buffer_size and buffer_size are the sizes of the serial input buffer and the frame buffer
+        of the Arduino. loop_time is the time (seconds) that the sketch spends between calls to read().
+        seed makes the errors reproducible.
+    """
+    def __init__(self, handler=None, baudrate=BAUDRATE, latency=0.0, corrupt=0.0, drop=0.0,
+                 rx_buffer_size=ARDUINO_RX_BUFFER_SIZE, buffer_size=BUFFER_SIZE, loop_time=0.0, seed=None):
+        Thread.__init__(self)
+        self.daemon = True
+        rng = random.Random(seed)
+        self.to_arduino = Line(baudrate, latency, corrupt, drop, rng)
+        self.to_host = Line(baudrate, latency, corrupt, drop, rng)
+        self.line_lock = Lock()
+        self.stream = SimulatedStream(self.write_host, rx_buffer_size)
+        self.arduino = SimulatedArduComm(self.stream, buffer_size, handler)
+        self.loop_time = loop_time
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        # Pipe to wake up the line thread when the Arduino writes
+        self.wake_read, self.wake_write = os.pipe()
+        self.arduino_thread = Thread(target=self.run_arduino)
+        self.arduino_thread.daemon = True
+        self.running = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        Thread.start(self)
+        self.arduino_thread.start()
+
+    def stop(self):
+        """ Stop the simulation and close the pty """
+        self.running = False
+        os.write(self.wake_write, b'\0')
+        self.join()
+        self.arduino_thread.join(TIMEOUT)
+        for fd in (self.master, self.slave, self.wake_read, self.wake_write):
+            os.close(fd)
+
+    def run(self):
+        """ Move the bytes along the line in both directions """
+        while self.running:
+            with self.line_lock:
+                arrivals = [t for t in (self.to_arduino.next_arrival(), self.to_host.next_arrival()) if t is not None]
+            timeout = max(0.0, min(arrivals) - time()) if arrivals else None
+            ready, _, _ = select.select([self.master, self.wake_read], [], [], timeout)
+            if self.wake_read in ready:
+                os.read(self.wake_read, 1024)
+            now = time()
+            with self.line_lock:
+                if self.master in ready:
+                    try:
+                        self.to_arduino.push(os.read(self.master, 4096), now)
+                    except OSError:
+                        # No process has the port open
+                        pass
+                to_arduino = self.to_arduino.pop(now)
+                to_host = self.to_host.pop(now)
+            if to_arduino:
+                self.stream.receive(to_arduino)
+            if to_host:
+                os.write(self.master, to_host)
+
+    def run_arduino(self):
+        """ Sketch loop of the simulated Arduino """
+        while self.running:
+            self.arduino.loop()
+            if self.loop_time:
+                sleep(self.loop_time)
+            else:
+                self.arduino.wait(READ_TIMEOUT)
+
+    def write_host(self, data):
+        """ Send the bytes written by the Arduino to the host """
+        with self.line_lock:
+            self.to_host.push(data, time())
+        os.write(self.wake_write, b'\0')
+
+    def stats(self):
+        """ Return a dict with the statistics of the simulation """
+        return {
+            'packets_received': self.arduino.packets_received,
+            'packets_sent': self.arduino.packets_sent,
+            'send_errors': self.arduino.send_errors,
+            'rx_overflows': self.stream.overflows,
+            'corrupted_bytes': self.to_arduino.corrupted_bytes + self.to_host.corrupted_bytes,
+            'dropped_frames': self.to_arduino.dropped_frames + self.to_host.dropped_frames,
+        }
@@ -0,0 +1,267 @@
+""" Statistics of the ArduComm links.
+
+    Each link counts the frames, bytes and errors in a LinkStats object, updated in the receive
+    and transmit paths. The counters are plain integers, and most of them are updated without extra
+    locks: they are only updated by one thread (e.g. the receiving thread), by the thread that runs
+    the ARQ of the current mode, or while holding a lock of the link (e.g. the serial lock), so they
+    are cheap enough to stay enabled in production. tx_failed is counted by the transmission and
+    the window threads at the same time, so it is updated with the lock of the stats (count_failed).
+    The time measurements (ACK round-trip time, callback queue latency) are stored in
+    histograms with fixed buckets, so their percentiles can be estimated at any time.
+
+    comm.stats() returns a snapshot of all the values. They can also be exported:
+
+        StatsServer(comm, port=9100).start()        # Prometheus text format at /metrics
+        StatsReporter(hub.links, print).start()     # Call print(snapshots) every 10 seconds
+"""
+
+import logging
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event, Lock
+
+# Upper bounds (seconds) of the histogram buckets: 0.1 ms to 6.5 s, doubling each time
+TIME_BUCKETS = tuple(0.0001 * 2 ** i for i in range(17))
+# Percentiles included in the snapshots
+PERCENTILES = (50, 90, 99)
+# Seconds between reports (see StatsReporter)
+REPORT_INTERVAL = 10.0
+# Prefix of the Prometheus metrics
+METRIC_PREFIX = 'arducomm'
+
+# Monotonic counters of a link
+COUNTERS = (
+    'rx_bytes',             # Bytes read from the serial port
+    'rx_frames',            # Frames decoded (packets and ACKs, with or without errors)
+    'rx_packets',           # Packets accepted and passed to the callbacks
+    'rx_acks',              # ACK frames (any type)
+    'rx_escape_bytes',      # Escape bytes removed from the received frames
+    'rx_fast_frames',       # Frames without escaped bytes, decoded without unescaping them
+    'rx_checksum_errors',   # Packets rejected because the FCS did not match
+    'rx_broken_frames',     # Times that bytes received outside a frame were dropped (lost start flag)
+    'rx_short_frames',      # Frames too small to contain a sequence number and a command
+    'rx_out_of_order',      # Packets discarded by the windowed ARQ receiver
+    'tx_bytes',             # Bytes written to the serial port
+    'tx_frames',            # Frames written (packets, retransmissions and ACKs)
+    'tx_packets',           # Packets acknowledged by the peer
+    'tx_escape_bytes',      # Escape bytes added to the written frames
+    'tx_fast_frames',       # Frames written without escaping any byte
+    'tx_failed',            # Packets that could not be sent (max. number of retries or window full)
+    'retries',              # Retransmissions (a Go-Back-N retry counts each frame of the window)
+    'timeouts',             # ACKs that did not arrive before the retransmission timeout
+    'nacks',                # Packets rejected by the peer (checksum error)
+    'credit_timeouts',      # Flow control credits reset because the peer did not reply to the requests
+    'credit_requests',      # Credit reports requested because the credits ran out and no report arrived
+    'credit_errors',        # Credit reports rejected (FCS mismatch or more bytes than the ones written)
+)
+
+# Values of the link snapshots (see ArduComm.stats) that are not counted in LinkStats.
+# The callback queue is shared by all the links of an ArduCommHub.
+GAUGES = (
+    'rto',                  # Current retransmission timeout (seconds)
+    'tx_queue',             # Packets waiting in the transmission queue
+    'window',               # Packets in the window, waiting for their ACK
+    'callback_queue',       # Packets waiting in the callback queue
+)
+# 'callback_dropped': packets dropped because the callback queue was full (counter)
+# 'callback_latency': time (seconds) that the received packets wait in the callback queue (histogram)
+
+
+class Histogram(object):
+    """ Histogram with fixed buckets. bounds are the sorted upper bounds of the buckets,
+        and the values larger than the last one go to an extra bucket.
+        observe() only updates a counter, the sum and the max, so it is cheap enough for the hot paths.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the values of another histogram with the same buckets """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        return self
+
+    def copy(self):
+        return Histogram(self.bounds).merge(self)
+
+    def percentile(self, p):
+        """ Estimate the p-th percentile, interpolating inside its bucket. None if it is empty. """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        total = 0
+        for i, count in enumerate(self.counts):
+            if count and total + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - total) / count, self.max)
+            total += count
+        return self.max
+
+    def snapshot(self):
+        """ Return a dict with the count, the sum, the max, the percentiles and the cumulative
+            count of each bucket (as (upper bound, count) pairs, like Prometheus)
+        """
+        # Copied first, so all the values are consistent even if other thread is observing
+        histogram = self.copy()
+        snapshot = {'count': histogram.count, 'sum': histogram.sum, 'max': histogram.max}
+        for p in PERCENTILES:
+            snapshot[F"p{p}"] = histogram.percentile(p)
+        buckets = []
+        total = 0
+        for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+            total += count
+            buckets.append((bound, total))
+        snapshot['buckets'] = buckets
+        return snapshot
+
+
+class LinkStats(object):
+    """ Counters of a link (see COUNTERS) and the histogram of the ACK round-trip times (ack_rtt,
+        only measured for the packets transmitted once)
+    """
+    __slots__ = COUNTERS + ('ack_rtt', 'lock')
+
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self.ack_rtt = Histogram()
+        self.lock = Lock()
+
+    def count_failed(self, count=1):
+        """ Count packets that could not be sent (tx_failed) from any thread """
+        with self.lock:
+            self.tx_failed += count
+
+    def snapshot(self):
+        """ Return a dict with the value of every counter and the snapshot of the histogram """
+        snapshot = {name: getattr(self, name) for name in COUNTERS}
+        snapshot['ack_rtt'] = self.ack_rtt.snapshot()
+        return snapshot
+
+
+def collect(links):
+    """ Return the snapshot of a link (anything with a stats() method),
+        or a dict with the snapshots of a dict of links (e.g. ArduCommHub.links)
+    """
+    if isinstance(links, dict):
+        return {name: link.stats() for name, link in list(links.items())}
+    return links.stats()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(F'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def prometheus_text(snapshots, prefix=METRIC_PREFIX):
+    """ Format snapshots in the Prometheus text exposition format.
+        snapshots is a link snapshot, or a dict of snapshots by link name (labeled as link="name").
+        Histograms are exported in seconds, GAUGES as gauges and the rest of values as counters.
+    """
+    if 'rx_bytes' in snapshots:
+        snapshots = {None: snapshots}
+    if not snapshots:
+        return ''
+    lines = []
+    for name, value in next(iter(snapshots.values())).items():
+        if isinstance(value, dict):
+            metric = F"{prefix}_{name}_seconds"
+            lines.append(F"# TYPE {metric} histogram")
+        elif name in GAUGES:
+            metric = F"{prefix}_{name}"
+            lines.append(F"# TYPE {metric} gauge")
+        else:
+            metric = F"{prefix}_{name}_total"
+            lines.append(F"# TYPE {metric} counter")
+        for link, snapshot in snapshots.items():
+            labels = {'link': link} if link is not None else {}
+            value = snapshot[name]
+            if not isinstance(value, dict):
+                lines.append(F"{metric}{_labels(labels)} {value}")
+                continue
+            for bound, count in value['buckets']:
+                le = '+Inf' if bound == float('inf') else F"{bound:g}"
+                lines.append(F"{metric}_bucket{_labels(dict(labels, le=le))} {count}")
+            lines.append(F"{metric}_sum{_labels(labels)} {value['sum']}")
+            lines.append(F"{metric}_count{_labels(labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+class StatsServer(Thread):
+    """ HTTP server that exports the statistics of the links in the Prometheus text format.
+        links is an ArduComm object or a dict of them by name (e.g. ArduCommHub.links).
+        The snapshots are taken when the endpoint is scraped, in the server thread.
+        port=0 selects a free port (see self.port).
+    """
+    def __init__(self, links, port=9100, host='', path='/metrics'):
+        Thread.__init__(self)
+        self.daemon = True
+        self.links = links
+        self.path = path
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                body = prometheus_text(collect(server.links)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StatsReporter(Thread):
+    """ Call callback(snapshot) every interval seconds with the statistics of the links.
+        links is an ArduComm object or a dict of them by name, as in StatsServer.
+    """
+    def __init__(self, links, callback, interval=REPORT_INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self.links = links
+        self.callback = callback
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.callback(collect(self.links))
+            except Exception:
+                logging.exception("Exception in the stats callback")
+
+    def stop(self):
+        self.stopped.set()
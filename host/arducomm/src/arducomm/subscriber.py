@@ -0,0 +1,37 @@
+""" Subscriber class to process received messages in callbacks based on a type.
+
+    This class will handle the parsing of the received payload and provide the
+    handler functions with the parsed object, the same as the Arduino Subscriber class.
+"""
+
+import logging
+from .serialization import parse
+
+
+class Subscriber(object):
+    """ Parse the payload of a command with the given dtype and pass the result to all its handlers.
+        dtype can be a Serializable class or any dtype accepted by serialization.parse.
+        If dtype is None, the handlers receive the raw payload bytes.
+    """
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        # Tuple, so it can be replaced while the callback is iterating over it
+        self.handlers = ()
+
+    def add_handler(self, handler):
+        self.handlers = self.handlers + (handler,)
+
+    def remove_handler(self, handler):
+        self.handlers = tuple(h for h in self.handlers if h != handler)
+
+    def callback(self, payload):
+        """ Parse the payload once and call all the handlers with the result.
+            An exception in a handler is logged and does not skip the rest of them.
+        """
+        data = payload if self.dtype is None else parse(payload, dtype=self.dtype)
+        for handler in self.handlers:
+            try:
+                handler(data)
+            except Exception:
+                logging.exception(F"Exception in the handler {handler}")
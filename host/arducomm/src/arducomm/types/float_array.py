@@ -1,24 +1,56 @@
-from arducomm.serialization import Serializable, serialize, parse
+from arducomm.serialization import Serializable
+from array import array
 import struct
+import sys
+
+# Views cast to 'f' use the native byte order, and the payload is little endian
+_SWAP_BYTES = sys.byteorder != 'little'
+# Struct of each number of floats, so the format is not built on every call
+_STRUCTS = {}
+
+def _floats_struct(size):
+    float_struct = _STRUCTS.get(size)
+    if float_struct is None:
+        float_struct = _STRUCTS[size] = struct.Struct(F"<{size}f")
+    return float_struct
 
 class FloatArray(Serializable):
-    """ FloatArray type definition and serialization """
-    def __init__(self, data=[]):
-        self.data = data
-    
+    """ FloatArray type definition and serialization.
+        The values are stored in data as a list. toarray() returns them in an array('f')
+        (32-bit floats, like the payload).
+    """
+    # Attributes, stored without a __dict__ per instance
+    __slots__ = ('data',)
+
+    def __init__(self, data=None):
+        # New list by default, so instances do not share it
+        self.data = [] if data is None else data
+
     def __repr__(self):
         return self.data.__repr__()
 
+    def tolist(self):
+        """ Return a copy of data as a list """
+        return list(self.data)
+
+    def toarray(self):
+        """ Return the values of data in an array('f') """
+        return array('f', self.data)
+
     def serialize(self):
         """ Serialize the data contained in self.
             Return a bytes-like object with the serialized data.
         """
-        return struct.pack(F"<{len(self.data)}f", *self.data)
+        return _floats_struct(len(self.data)).pack(*self.data)
 
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
+    def parse(self, buffer, offset=0):
+        """ Parse (deserialize) the bytes from a buffer, starting at offset.
             Update the instance object and return self.
         """
-        size = int(len(buffer) / 4)
-        self.data = list(struct.unpack(F"<{size}f", buffer))
+        view = memoryview(buffer)[offset:]
+        if _SWAP_BYTES:
+            self.data = list(_floats_struct(len(view) // 4).unpack(view))
+        else:
+            # Read the floats directly from the buffer, without an intermediate tuple
+            self.data = view.cast('f').tolist()
         return self
@@ -1,16 +1,24 @@
-from arducomm.serialization import Serializable, serialize, parse
+from arducomm.serialization import Serializable
 from .vector3 import Vector3
 from .quaternion import Quaternion
+import struct
 
 class Imu(Serializable):
     """ Imu type definition and serialization """
+    # Fields and dtypes, to nest this type in schema messages (see serialization.schema)
+    _fields = (('orientation', Quaternion), ('angular_vel', Vector3), ('linear_accel', Vector3))
+    # Precompiled layout, flattened: orientation (x, y, z, w), angular_vel (x, y, z), linear_accel (x, y, z)
+    _struct = struct.Struct('<10f')
     # Size in bytes
-    size = Quaternion.size + 2*Vector3.size
+    size = _struct.size
+    # Attributes, stored without a __dict__ per instance
+    __slots__ = ('orientation', 'angular_vel', 'linear_accel')
 
-    def __init__(self, orientation=Quaternion(), angular_vel=Vector3(), linear_accel=Vector3()):
-        self.orientation = orientation
-        self.angular_vel = angular_vel
-        self.linear_accel = linear_accel
+    def __init__(self, orientation=None, angular_vel=None, linear_accel=None):
+        # New objects by default, so instances do not share them
+        self.orientation = Quaternion() if orientation is None else orientation
+        self.angular_vel = Vector3() if angular_vel is None else angular_vel
+        self.linear_accel = Vector3() if linear_accel is None else linear_accel
     
     def __repr__(self):
         return F"{self.orientation.__repr__()} | {self.angular_vel.__repr__()} | {self.linear_accel.__repr__()}]"
@@ -19,15 +27,17 @@ class Imu(Serializable):
         """ Serialize the data contained in self.
             Return a bytes-like object with the serialized data.
         """
-        return (serialize(self.orientation) +
-                serialize(self.angular_vel) +
-                serialize(self.linear_accel))
+        o = self.orientation
+        w = self.angular_vel
+        a = self.linear_accel
+        return self._struct.pack(o.x, o.y, o.z, o.w, w.x, w.y, w.z, a.x, a.y, a.z)
 
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
+    def parse(self, buffer, offset=0):
+        """ Parse (deserialize) the bytes from a buffer, starting at offset.
             Update the instance object and return self.
         """
-        self.orientation.parse(buffer[:Quaternion.size])
-        self.angular_vel.parse(buffer[Quaternion.size:(Quaternion.size + Vector3.size)])
-        self.linear_accel.parse(buffer[(Quaternion.size + Vector3.size):])
+        values = self._struct.unpack_from(buffer, offset)
+        self.orientation = Quaternion(*values[:4])
+        self.angular_vel = Vector3(*values[4:7])
+        self.linear_accel = Vector3(*values[7:])
         return self
@@ -1,15 +1,23 @@
-from arducomm.serialization import Serializable, serialize, parse
+from arducomm.serialization import Serializable
 from .vector3 import Vector3
 from .quaternion import Quaternion
+import struct
 
 class Pose(Serializable):
     """ Pose type definition and serialization """
+    # Fields and dtypes, to nest this type in schema messages (see serialization.schema)
+    _fields = (('position', Vector3), ('orientation', Quaternion))
+    # Precompiled layout, flattened: position (x, y, z), orientation (x, y, z, w)
+    _struct = struct.Struct('<7f')
     # Size in bytes
-    size = Vector3.size + Quaternion.size
+    size = _struct.size
+    # Attributes, stored without a __dict__ per instance
+    __slots__ = ('position', 'orientation')
 
-    def __init__(self, position=Vector3(), orientation=Quaternion()):
-        self.position = position
-        self.orientation = orientation
+    def __init__(self, position=None, orientation=None):
+        # New objects by default, so instances do not share them
+        self.position = Vector3() if position is None else position
+        self.orientation = Quaternion() if orientation is None else orientation
     
     def __repr__(self):
         return F"{self.position.__repr__()} | {self.orientation.__repr__()}"
@@ -18,12 +26,15 @@ class Pose(Serializable):
         """ Serialize the data contained in self.
             Return a bytes-like object with the serialized data.
         """
-        return serialize(self.position) + serialize(self.orientation)
+        p = self.position
+        o = self.orientation
+        return self._struct.pack(p.x, p.y, p.z, o.x, o.y, o.z, o.w)
 
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
+    def parse(self, buffer, offset=0):
+        """ Parse (deserialize) the bytes from a buffer, starting at offset.
             Update the instance object and return self.
         """
-        self.position.parse(buffer[:Vector3.size])
-        self.orientation.parse(buffer[Vector3.size:])
+        values = self._struct.unpack_from(buffer, offset)
+        self.position = Vector3(*values[:3])
+        self.orientation = Quaternion(*values[3:])
         return self
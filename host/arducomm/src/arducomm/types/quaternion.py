@@ -1,9 +1,16 @@
-from arducomm.serialization import Serializable, serialize, parse
+from arducomm.serialization import Serializable
+import struct
 
 class Quaternion(Serializable):
     """ Quaternion type definition and serialization """
+    # Fields and dtypes, to nest this type in schema messages (see serialization.schema)
+    _fields = (('x', 'float'), ('y', 'float'), ('z', 'float'), ('w', 'float'))
+    # Precompiled layout: x, y, z, w
+    _struct = struct.Struct('<4f')
     # Size in bytes
-    size = 16
+    size = _struct.size
+    # Attributes, stored without a __dict__ per instance
+    __slots__ = ('x', 'y', 'z', 'w')
 
     def __init__(self, x=0.0, y=0.0, z=0.0, w=1.0):
         self.x = x
@@ -18,17 +25,11 @@ class Quaternion(Serializable):
         """ Serialize the data contained in self.
             Return a bytes-like object with the serialized data.
         """
-        return (serialize(self.x, dtype='float') +
-                serialize(self.y, dtype='float') +
-                serialize(self.z, dtype='float') +
-                serialize(self.w, dtype='float'))
+        return self._struct.pack(self.x, self.y, self.z, self.w)
 
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
+    def parse(self, buffer, offset=0):
+        """ Parse (deserialize) the bytes from a buffer, starting at offset.
             Update the instance object and return self.
         """
-        self.x = parse(buffer[:4], dtype='float')
-        self.y = parse(buffer[4:8], dtype='float')
-        self.z = parse(buffer[8:12], dtype='float')
-        self.w = parse(buffer[12:], dtype='float')
+        self.x, self.y, self.z, self.w = self._struct.unpack_from(buffer, offset)
         return self
@@ -1,9 +1,16 @@
-from arducomm.serialization import Serializable, serialize, parse
+from arducomm.serialization import Serializable
+import struct
 
 class Vector2(Serializable):
     """ Vector2 type definition and serialization """
+    # Fields and dtypes, to nest this type in schema messages (see serialization.schema)
+    _fields = (('x', 'float'), ('y', 'float'))
+    # Precompiled layout: x, y
+    _struct = struct.Struct('<2f')
     # Size in bytes
-    size = 8
+    size = _struct.size
+    # Attributes, stored without a __dict__ per instance
+    __slots__ = ('x', 'y')
 
     def __init__(self, x=0, y=0):
         self.x = x
@@ -16,12 +23,11 @@ class Vector2(Serializable):
         """ Serialize the data contained in self.
             Return a bytes-like object with the serialized data.
         """
-        return serialize(self.x, dtype='float') + serialize(self.y, dtype='float')
+        return self._struct.pack(self.x, self.y)
 
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
+    def parse(self, buffer, offset=0):
+        """ Parse (deserialize) the bytes from a buffer, starting at offset.
             Update the instance object and return self.
         """
-        self.x = parse(buffer[:4], dtype='float')
-        self.y = parse(buffer[4:], dtype='float')
+        self.x, self.y = self._struct.unpack_from(buffer, offset)
         return self
@@ -1,9 +1,16 @@
-from arducomm.serialization import Serializable, serialize, parse
+from arducomm.serialization import Serializable
+import struct
 
 class Vector3(Serializable):
     """ Vector3 type definition and serialization """
+    # Fields and dtypes, to nest this type in schema messages (see serialization.schema)
+    _fields = (('x', 'float'), ('y', 'float'), ('z', 'float'))
+    # Precompiled layout: x, y, z
+    _struct = struct.Struct('<3f')
     # Size in bytes
-    size = 12
+    size = _struct.size
+    # Attributes, stored without a __dict__ per instance
+    __slots__ = ('x', 'y', 'z')
 
     def __init__(self, x=0.0, y=0.0, z=0.0):
         self.x = x
@@ -17,15 +24,11 @@ class Vector3(Serializable):
         """ Serialize the data contained in self.
             Return a bytes-like object with the serialized data.
         """
-        return (serialize(self.x, dtype='float') +
-                serialize(self.y, dtype='float') +
-                serialize(self.z, dtype='float'))
+        return self._struct.pack(self.x, self.y, self.z)
 
-    def parse(self, buffer):
-        """ Parse (deserialize) the bytes from a buffer.
+    def parse(self, buffer, offset=0):
+        """ Parse (deserialize) the bytes from a buffer, starting at offset.
             Update the instance object and return self.
         """
-        self.x = parse(buffer[:4], dtype='float')
-        self.y = parse(buffer[4:8], dtype='float')
-        self.z = parse(buffer[8:], dtype='float')
+        self.x, self.y, self.z = self._struct.unpack_from(buffer, offset)
         return self
@@ -1,22 +1,69 @@
+""" Check the FCS algorithms and compare their speed with the original per-byte implementations """
 from arducomm import PacketFrame
+from arducomm.checksum import CRC16_LUT, CRC16, fletcher16, crc16
+import random
 import struct
-from time import time
+from timeit import timeit
+
+NUM_RUNS = 10000
+
+
+def fletcher16_loop(data):
+    """ Original per-byte implementation of the 16bit Fletcher's checksum """
+    lsb = 0
+    msb = 0
+    for i in range(len(data)):
+        lsb += data[i]
+        msb += lsb
+        if i % 16 == 0:
+            # Do a reduction each 16 bytes
+            lsb = (lsb & 0xFF) + (lsb >> 8)
+            msb = (msb & 0xFF) + (msb >> 8)
+    # Last double reduction to add the carry
+    lsb = (lsb & 0xFF) + (lsb >> 8)
+    lsb = (lsb & 0xFF) + (lsb >> 8)
+    msb = (msb & 0xFF) + (msb >> 8)
+    msb = (msb & 0xFF) + (msb >> 8)
+    return (msb << 8) | lsb
+
+
+def crc16_loop(data):
+    """ Original per-byte implementation of the CRC-16 (CCITT) """
+    crc = 0xFFFF
+    for data_byte in data:
+        crc = (crc << 8) ^ CRC16_LUT[(crc >> 8) ^ data_byte]
+        crc &= 0xFFFF
+    return crc
+
+
+def time_us(function, data):
+    return timeit(lambda: function(data), number=NUM_RUNS) / NUM_RUNS * 1e6
+
 
 if __name__ == '__main__':
     packet = PacketFrame(1, 5, [i for i in range(5)])
-    t0 = time()
     cs_msb, cs_lsb = packet.checksum()
-    t1 = time()
-    print(F"Fletcher time: {t1 - t0}")
     cs = struct.unpack('>H', bytearray([cs_msb, cs_lsb]))
     print(F"Fletcher's checksum: {cs_msb}, {cs_lsb} -> {(cs_msb << 8) + cs_lsb}")
     print(cs)
-    t0 = time()
-    crc16 = packet.crc16()
-    t1 = time()
-    print(F"CRC16 time: {t1 - t0}")
-    crc16_bytes = struct.pack('>H', crc16)
-    print(F"CRC16-CCITT: {crc16}")
+    crc_packet = PacketFrame(1, 5, [i for i in range(5)], fcs=CRC16)
+    crc16_bytes = struct.pack('>H', crc_packet.crc16())
+    print(F"CRC16-CCITT: {crc_packet.crc16()}")
     print(F"CRC16-CCITT bytes: {[i for i in crc16_bytes]}")
-    # ser_packet = packet.serialize()
-    # print(ser_packet)
+    print(F"CRC16 frame checksum: {crc_packet.checksum()}")
+
+    # Check that the new implementations match the original ones
+    for i in range(1000):
+        data = bytes(random.randrange(256) for j in range(random.randint(0, 257)))
+        assert fletcher16(data) == fletcher16_loop(data), F"Fletcher mismatch: {data}"
+        assert crc16(data) == crc16_loop(data), F"CRC16 mismatch: {data}"
+    print("All checksums match the original implementations")
+
+    # Benchmark
+    for size in [6, 60, 257]:
+        data = bytes(random.randrange(256) for j in range(size))
+        print(F"Frame data: {size} bytes")
+        print(F"\tFletcher (per byte loop): {time_us(fletcher16_loop, data):.2f} us")
+        print(F"\tFletcher (block):         {time_us(fletcher16, data):.2f} us")
+        print(F"\tCRC16 (per byte loop):    {time_us(crc16_loop, data):.2f} us")
+        print(F"\tCRC16 (binascii):         {time_us(crc16, data):.2f} us")
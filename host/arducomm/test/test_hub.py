@@ -0,0 +1,74 @@
+from arducomm import ArduCommHub
+from arducomm.simulator import LinkSimulator
+from collections import Counter
+from threading import Thread, active_count
+from time import time, sleep
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+NUM_LINKS = 4
+NUM_PACKETS = 200
+PAYLOAD_SIZE = 16
+
+ECHO_COMMAND = 0x20
+
+
+def echo_handler(command, payload):
+    # The simulated Arduinos reply to the echo command with the same payload
+    if command == ECHO_COMMAND:
+        return command + 1, payload
+    return None
+
+
+def main(args):
+    sims = [LinkSimulator(echo_handler, baudrate=args.baudrate) for i in range(args.links)]
+    threads = active_count()
+    for sim in sims:
+        sim.start()
+    sim_threads = active_count() - threads
+
+    received = Counter()
+    hub = ArduCommHub(lambda name, command, payload: received.update([name]))
+    for i, sim in enumerate(sims):
+        hub.add_link(F"board_{i}", sim.port, window_size=args.window, flow_control=args.window > 1)
+    hub.start()
+    print(F"Links: {args.links}. Host threads: {active_count() - threads - sim_threads} (+{sim_threads} simulator threads)")
+
+    def send_packets(name):
+        payload = bytes(args.size)
+        sent = sum(hub.send(name, ECHO_COMMAND, payload) for i in range(args.num))
+        print(F"{name}: packets sent: {sent}/{args.num}")
+
+    senders = [Thread(target=send_packets, args=(name,)) for name in hub.links]
+    t1 = time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    flushed = hub.flush(10)
+    elapsed = time() - t1
+    # Wait for the last echoes
+    sleep(1)
+
+    print(F"Total throughput: {args.links * args.num / elapsed:.1f} packets/s (flush: {flushed})")
+    print(F"Echo packets received: {dict(received)}")
+    hub.stop()
+    for sim in sims:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Send packets to several simulated Arduinos through an ArduCommHub")
+    parser.add_argument("-l", "--links", default=NUM_LINKS, type=int,
+                        help=F"Number of links. Default: {NUM_LINKS}")
+    parser.add_argument("-b", "--baudrate", default=None, type=int,
+                        help="Baudrate of the simulated lines. Default: None (instant transmission)")
+    parser.add_argument("-n", "--num", default=NUM_PACKETS, type=int,
+                        help=F"Number of packets per link. Default: {NUM_PACKETS}")
+    parser.add_argument("-s", "--size", default=PAYLOAD_SIZE, type=int,
+                        help=F"Payload size. Default: {PAYLOAD_SIZE}")
+    parser.add_argument("-w", "--window", default=1, type=int,
+                        help="Window size (windowed ARQ). Default: 1 (Stop-and-Wait)")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,86 @@
+from arducomm import ArduComm
+from arducomm.simulator import LinkSimulator
+from time import time, sleep
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+BAUDRATE = 115200
+NUM_PACKETS = 200
+PAYLOAD_SIZE = 32
+
+ECHO_COMMAND = 0x20
+
+
+def echo_handler(command, payload):
+    # The simulated Arduino replies to the echo command with the same payload
+    if command == ECHO_COMMAND:
+        return command + 1, payload
+    return None
+
+
+def main(args):
+    print(F"Baudrate: {args.baudrate}, latency: {args.latency}, corrupt: {args.corrupt}, drop: {args.drop}")
+    sim = LinkSimulator(echo_handler if args.echo else None, baudrate=args.baudrate, latency=args.latency,
+                        corrupt=args.corrupt, drop=args.drop, loop_time=args.loop_time, seed=args.seed)
+    sim.start()
+
+    received = []
+    comm = ArduComm(lambda command, payload: received.append(payload), port=sim.port,
+                    window_size=args.window, flow_control=args.flow_control)
+    comm.start()
+
+    payload = bytes(i % 256 for i in range(args.size))
+    sent = 0
+    t1 = time()
+    for i in range(args.num):
+        sent += comm.send(ECHO_COMMAND, payload)
+    flushed = comm.flush(10)
+    elapsed = time() - t1
+    # Wait for the last echoes
+    sleep(1)
+
+    print(F"Packets sent: {sent}/{args.num} (flush: {flushed}) in {elapsed:.3f} seconds")
+    print(F"Throughput: {sent / elapsed:.1f} packets/s, {sent * args.size / elapsed:.1f} payload bytes/s")
+    if args.echo:
+        print(F"Echo packets received: {len(received)}")
+    stats = sim.stats()
+    print(F"Simulator stats: {stats}")
+    comm.stop()
+    sim.stop()
+    # The windowed mode used to overflow the Arduino buffer (-w 8 -s 48 -t 0.005)
+    return sent == args.num and flushed and stats['rx_overflows'] == 0
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Send packets to a simulated Arduino and measure the throughput")
+    parser.add_argument("-b", "--baudrate", default=BAUDRATE, type=int,
+                        help=F"Baudrate. Default: {BAUDRATE}")
+    parser.add_argument("-l", "--latency", default=0.0, type=float,
+                        help="Latency of the line (seconds). Default: 0")
+    parser.add_argument("-c", "--corrupt", default=0.0, type=float,
+                        help="Probability of corrupting each byte. Default: 0")
+    parser.add_argument("-d", "--drop", default=0.0, type=float,
+                        help="Probability of dropping each frame. Default: 0")
+    parser.add_argument("-t", "--loop-time", default=0.0, type=float,
+                        help="Time (seconds) between reads in the Arduino. Default: 0")
+    parser.add_argument("-n", "--num", default=NUM_PACKETS, type=int,
+                        help=F"Number of packets. Default: {NUM_PACKETS}")
+    parser.add_argument("-s", "--size", default=PAYLOAD_SIZE, type=int,
+                        help=F"Payload size. Default: {PAYLOAD_SIZE}")
+    parser.add_argument("-w", "--window", default=1, type=int,
+                        help="Window size (windowed ARQ). Default: 1 (Stop-and-Wait)")
+    parser.add_argument("-f", "--flow-control", action="store_true",
+                        help="Enable the credit-based flow control")
+    parser.add_argument("-e", "--echo", action="store_true",
+                        help="The Arduino replies to each packet with the same payload")
+    parser.add_argument("--seed", default=None, type=int,
+                        help="Seed of the random errors")
+    parser.add_argument("--check", action="store_true",
+                        help="Fail if any packet is lost or the Arduino buffer overflows")
+    args = parser.parse_args()
+    ok = main(args)
+    if args.check and not ok:
+        print("Check failed")
+        sys.exit(1)